@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+Embedding backend benchmark
+===========================
+
+Builds a reference index over a materials directory with each embedding
+backend and reports:
+
+- build time (embedding every chunk, with the on-disk cache bypassed)
+- query latency (embedding the query and searching, p50/p95)
+- retrieval quality: a passage taken from a random child chunk is used as the
+  query, and a hit means the chunk's parent is among the top k results
+  (hit@k and mean reciprocal rank)
+
+Searches use vector similarity only: BM25 fusion and MMR reranking are turned
+off (hybrid=False, mmr_lambda=1.0), so the scores compare the embeddings rather
+than the keyword index that every backend shares.
+
+Backends that cannot run here (no OPENAI_API_KEY, sentence-transformers not
+installed) are skipped.
+
+Example:
+    python embedding_benchmark.py --materials-dir reference_materials --backends hashing openai
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+# Ensure we can import from the current directory
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+# and the RAG modules shared with CourseDesigner (references/rag_shared)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rag_shared.embedding_backends import EMBEDDING_BACKENDS, create_embeddings
+from rag_shared.embedding_cache import CachedEmbeddings
+from rag_shared.reference_index import ReferenceIndex, ID_KEY
+
+
+def make_queries(index: ReferenceIndex, count: int, words: int, seed: int = 0):
+    """(query text, parent id) pairs taken from random child chunks."""
+    children = [child for _, child in index.vectorstore.chunks()]
+    rng = random.Random(seed)
+    queries = []
+    for child in rng.sample(children, min(count, len(children))):
+        tokens = child.page_content.split()
+        if len(tokens) < 4:
+            continue
+        start = rng.randint(0, max(0, len(tokens) - words))
+        queries.append((" ".join(tokens[start:start + words]), child.metadata[ID_KEY]))
+    return queries
+
+
+def benchmark_backend(backend: str, materials_dir: str, queries, k: int):
+    """Build an index with one backend and score it on (query, expected parent text) pairs."""
+    embeddings = create_embeddings(backend)
+    # Measure real embedding cost, not cache lookups
+    if isinstance(embeddings, CachedEmbeddings):
+        embeddings = embeddings.embeddings
+
+    index_dir = tempfile.mkdtemp(prefix=f"bench_{backend}_")
+    try:
+        # Pure vector search: keyword fusion and MMR would mask differences between the embeddings
+        index = ReferenceIndex(materials_dir, embeddings, index_dir=index_dir, read_only=False,
+                               hybrid=False, mmr_lambda=1.0)
+        start = time.perf_counter()
+        index.load_or_build()
+        build_time = time.perf_counter() - start
+        if index.vectorstore is None:
+            raise SystemExit(f"No documents found in {materials_dir}")
+
+        latencies = []
+        hits = 0
+        reciprocal_ranks = 0.0
+        for query, parent_text in queries:
+            start = time.perf_counter()
+            results = index.search(query, k=k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            texts = [doc.page_content for doc in results]
+            if parent_text in texts:
+                hits += 1
+                reciprocal_ranks += 1.0 / (texts.index(parent_text) + 1)
+
+        return {
+            "build_s": build_time,
+            "vectors": len(index.vectorstore),
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+            "hit_at_k": hits / len(queries),
+            "mrr": reciprocal_ranks / len(queries),
+        }
+    finally:
+        shutil.rmtree(index_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare embedding backends on a materials directory")
+    parser.add_argument("--materials-dir", default="reference_materials")
+    parser.add_argument("--backends", nargs="+", default=list(EMBEDDING_BACKENDS), choices=EMBEDDING_BACKENDS)
+    parser.add_argument("--queries", type=int, default=100, help="Number of sampled queries")
+    parser.add_argument("--query-words", type=int, default=12, help="Words per sampled query")
+    parser.add_argument("--k", type=int, default=3)
+    args = parser.parse_args()
+
+    # Sample the queries once, from a hashing index that costs nothing to build, so that
+    # every backend is asked the same questions; parent ids differ between builds, so
+    # each query is paired with the text of its parent chunk
+    sample_dir = tempfile.mkdtemp(prefix="bench_queries_")
+    try:
+        sampler = ReferenceIndex(args.materials_dir, create_embeddings("hashing"), index_dir=sample_dir,
+                                 read_only=False)
+        sampler.load_or_build()
+        if sampler.vectorstore is None:
+            raise SystemExit(f"No documents found in {args.materials_dir}")
+        sampled = make_queries(sampler, args.queries, args.query_words)
+        queries = [(query, sampler.docstore.mget([parent_id])[0].page_content) for query, parent_id in sampled]
+    finally:
+        shutil.rmtree(sample_dir, ignore_errors=True)
+
+    results = {}
+    for backend in args.backends:
+        if backend == "openai" and not os.getenv("OPENAI_API_KEY"):
+            print("Skipping openai: OPENAI_API_KEY is not set")
+            continue
+        try:
+            results[backend] = benchmark_backend(backend, args.materials_dir, queries, args.k)
+        except ImportError as e:
+            print(f"Skipping {backend}: {e}")
+
+    header = f"{'backend':<22} {'vectors':>8} {'build s':>8} {'p50 ms':>8} {'p95 ms':>8} {'hit@k':>7} {'MRR':>6}"
+    print(f"\n{len(queries)} queries, k={args.k}, vector search only (hybrid=False, mmr_lambda=1.0)\n")
+    print(header)
+    print("-" * len(header))
+    for backend, result in results.items():
+        print(f"{backend:<22} {result['vectors']:>8} {result['build_s']:>8.2f} {result['p50_ms']:>8.2f} "
+              f"{result['p95_ms']:>8.2f} {result['hit_at_k']:>7.2f} {result['mrr']:>6.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,14 @@
 import gradio as gr
 import os
+import sys
 import json
 import shutil
 from pathlib import Path
 
+# The RAG modules shared by CaseStrategy and CourseDesigner live in references/rag_shared
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rag_shared.material_loader import discover_materials
+
 # Default parameters - can be overridden
 target_industry = "general business"
 proposal_style = "professional"
@@ -31,8 +36,10 @@ focus_areas = [
 ]
 
 class ESGProposalGUI:
-    def __init__(self, graph, share=False, materials_dir="reference_materials", params_dir="proposal_parameters"):
+    def __init__(self, graph, share=False, materials_dir="reference_materials", params_dir="proposal_parameters", designer=None):
         self.graph = graph
+        # Optional ESGProposalDesigner whose live index is kept in sync with uploads and deletes
+        self.designer = designer
         self.share = share
         self.partial_message = ""
         self.response = {}
@@ -41,6 +48,8 @@ class ESGProposalGUI:
         self.threads = []
         self.thread_id = -1
         self.thread = {"configurable": {"thread_id": str(self.thread_id)}}
+        # Client index namespace (the target company of the loaded parameters) searched by new runs
+        self.namespace = None
         
         # Material uploader configuration
         self.materials_dir = Path(materials_dir)
@@ -122,6 +131,18 @@ class ESGProposalGUI:
                 shutil.copy2(file.name, dest_path)
                 
                 result.append(f"Successfully uploaded: {file.name}")
+                
+                # Add only the new file's chunks to the running index
+                if self.designer is not None:
+                    try:
+                        added = self.designer.add_reference_file(str(dest_path))
+                        if added is None:
+                            result.append(f"Reference index is still indexing; {dest_path.name} "
+                                          "will be indexed when it is ready")
+                        else:
+                            result.append(f"Indexed {added} chunks from: {dest_path.name}")
+                    except Exception as e:
+                        result.append(f"Error indexing {dest_path.name}: {e}")
             except Exception as e:
                 result.append(f"Error uploading {file.name}: {e}")
         
@@ -129,18 +150,30 @@ class ESGProposalGUI:
     
     def list_files(self):
         """List all files in the materials directory"""
-        files = []
-        for file_path in self.materials_dir.glob("**/*"):
-            if file_path.is_file():
-                # Get the relative path to the materials directory
-                rel_path = file_path.relative_to(self.materials_dir)
-                files.append(str(rel_path))
+        # Reuse the designer's latest walk of the tree, or make one scandir pass;
+        # paths relative to the materials directory
+        if self.designer is not None and Path(self.designer.materials_dir).resolve() == self.materials_dir.resolve():
+            materials = self.designer.material_files()
+        else:
+            materials = discover_materials(str(self.materials_dir))
+        files = [material.rel_path for material in materials]
         
         if not files:
             return "No files in the reference materials directory."
         
         return "\n".join(files)
     
+    def index_status(self):
+        """Whether the background index build has finished, and the cache and namespace statistics"""
+        if self.designer is None:
+            return "Reference index: not started"
+        status = [f"Reference index: {self.designer.retrieval_status}"]
+        if self.designer.reference_index is not None:
+            status.append(self.designer.reference_index.cache_stats_summary())
+        if self.designer.namespaces.loaded():
+            status.append(self.designer.namespaces.stats_summary())
+        return "\n".join(status)
+    
     def delete_file(self, file_name):
         """Delete a file from the materials directory"""
         try:
@@ -149,9 +182,31 @@ class ESGProposalGUI:
             if not file_path.exists():
                 return f"File not found: {file_name}"
             
+            # Remove the file's vectors from the running index first: if that fails the
+            # file is kept, so the index never points at a file that no longer exists
+            removed = None
+            deferred = False
+            if self.designer is not None:
+                try:
+                    removed = self.designer.remove_reference_file(str(file_path))
+                except Exception as e:
+                    return f"Error removing {file_name} from the index, file kept: {e}"
+                deferred = removed is None
+            
             # Delete the file
-            file_path.unlink()
+            try:
+                file_path.unlink()
+            except Exception as e:
+                if removed is None:
+                    raise
+                return (f"Removed {file_name} from the index ({removed} chunks) but could not delete the file: {e}. "
+                        "It will be indexed again on the next start")
             
+            if deferred:
+                return (f"Successfully deleted: {file_name} (the reference index is still indexing; "
+                        "its chunks are removed when it is ready)")
+            if removed is not None:
+                return f"Successfully deleted: {file_name} ({removed} chunks removed from index)"
             return f"Successfully deleted: {file_name}"
         except Exception as e:
             return f"Error deleting {file_name}: {e}"
@@ -190,6 +245,13 @@ class ESGProposalGUI:
             # Also prepare topic text for the main input
             proposal_title = params.get('proposal_title', '')
             
+            # New runs search the target company's own materials if it has an index namespace
+            target_company = params.get('target_company')
+            self.namespace = None
+            if self.designer is not None and target_company and self.designer.namespaces.exists(target_company):
+                self.namespace = target_company
+                display_text += f"\nReference materials: client namespace '{self.namespace}'\n"
+            
             return display_text, proposal_title
         except Exception as e:
             return f"Error loading parameters: {e}", ""
@@ -232,7 +294,8 @@ class ESGProposalGUI:
                     'draft': "no draft", 
                     'critique': "no critique", 
                     'count': 0,
-                    'retrieved_docs': []  # Initialize empty retrieved docs
+                    'retrieved_docs': [],  # Initialize empty retrieved docs
+                    'namespace': self.namespace
                 }
                 self.thread_id += 1  # new agent, new thread
                 self.threads.append(self.thread_id)
@@ -833,6 +896,7 @@ class ESGProposalGUI:
                 
                 with gr.Tab("Manage Materials"):
                     refresh_btn = gr.Button("Refresh File List")
+                    index_status = gr.Textbox(label="Reference Index Status", lines=3, interactive=False)
                     file_list = gr.Textbox(label="Available Files", lines=10)
                     
                     with gr.Row():
@@ -841,9 +905,11 @@ class ESGProposalGUI:
                     
                     delete_result = gr.Textbox(label="Delete Result")
                     
-                    refresh_btn.click(fn=self.list_files, inputs=[], outputs=[file_list])
+                    refresh_btn.click(fn=self.list_files, inputs=[], outputs=[file_list]).then(
+                                  fn=self.index_status, inputs=[], outputs=[index_status])
                     delete_btn.click(fn=self.delete_file, inputs=[file_to_delete], outputs=[delete_result]).then(
-                                  fn=self.list_files, inputs=[], outputs=[file_list])
+                                  fn=self.list_files, inputs=[], outputs=[file_list]).then(
+                                  fn=self.index_status, inputs=[], outputs=[index_status])
             
             with gr.Tab("Agent"):
                 gr.Markdown("""
@@ -1173,5 +1239,5 @@ if __name__ == "__main__":
     proposal_designer = ESGProposalDesigner(materials_dir="reference_materials")
     
     # Initialize and launch the GUI with reference material upload functionality
-    app = ESGProposalGUI(proposal_designer.graph, materials_dir="reference_materials")
+    app = ESGProposalGUI(proposal_designer.graph, materials_dir="reference_materials", designer=proposal_designer)
     app.launch()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""
+Recall@k vs. latency report for the approximate FAISS index types
+=================================================================
+
+Compares IVF-Flat, HNSW and IVF-PQ (at several nprobe/efSearch settings)
+against the exact flat index, so an index type can be chosen safely before
+setting RAG_INDEX_TYPE. It also times the MMR reranking of each query's
+fetch_k nearest neighbours, the step added to every cache-missing search.
+
+Vectors come from a persisted reference index (built by the application) or,
+to try corpus sizes you do not have yet, from a synthetic clustered set.
+A random sample of the vectors is held out and used as queries.
+
+Examples:
+    python index_benchmark.py --index-dir reference_materials_index
+    python index_benchmark.py --synthetic 200000 --dimension 1536 --k 5
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+# Ensure we can import from the current directory
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+# and the RAG modules shared with CourseDesigner (references/rag_shared)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_community.vectorstores.faiss import dependable_faiss_import
+
+from rag_shared.index_segments import SEGMENTS_DIR, IndexSegment
+from rag_shared.reference_index import default_index_dir, read_manifest
+from rag_shared.vector_index import DEFAULT_MMR_LAMBDA, build_index, configure_search, effective_index_type, mmr_order
+
+# (index type, query-time setting name, values to try)
+CONFIGURATIONS = [
+    ("ivf_flat", "nprobe", [1, 4, 8, 16, 32]),
+    ("hnsw", "ef_search", [16, 32, 64, 128]),
+    ("ivf_pq", "nprobe", [4, 8, 16, 32]),
+]
+
+
+def load_vectors(index_dir: str) -> np.ndarray:
+    """Read the live child vectors of a persisted reference index, from all of its segments."""
+    faiss = dependable_faiss_import()
+    manifest, _, _ = read_manifest(index_dir)
+    if manifest is None:
+        raise SystemExit(f"No index manifest in {index_dir}")
+    live_ids = {doc_id for entry in manifest.get("files", {}).values() for doc_id in entry.get("ids", [])}
+    parts = []
+    for name in manifest.get("segments", []):
+        segment = IndexSegment.load(os.path.join(index_dir, SEGMENTS_DIR, name), mmap=True)
+        if not isinstance(segment.index, faiss.IndexFlat):
+            raise SystemExit(f"{index_dir} holds an approximate index; benchmark against a flat index instead")
+        positions = [position for position, doc_id in enumerate(segment.ids) if doc_id in live_ids]
+        if positions:
+            parts.append(np.vstack([segment.index.reconstruct(position) for position in positions]))
+    if not parts:
+        return np.zeros((0, 0), dtype="float32")
+    return np.vstack(parts)
+
+
+def synthetic_vectors(count: int, dimension: int, seed: int = 0) -> np.ndarray:
+    """Clustered random vectors, closer to real embeddings than uniform noise."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(1, count // 100), dimension)).astype("float32")
+    vectors = centers[rng.integers(0, len(centers), count)] + 0.3 * rng.normal(size=(count, dimension))
+    return vectors.astype("float32")
+
+
+def measure(index, queries: np.ndarray, k: int):
+    """Run the queries one at a time, as the retriever does. Returns (results, latencies in ms)."""
+    results = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        _, ids = index.search(query.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append(ids[0])
+    return results, np.array(latencies)
+
+
+def recall_at_k(results, exact, k: int) -> float:
+    hits = sum(len(set(found[:k]) & set(truth[:k])) for found, truth in zip(results, exact))
+    return hits / (k * len(exact))
+
+
+def index_megabytes(index) -> float:
+    faiss = dependable_faiss_import()
+    return faiss.serialize_index(index).nbytes / (1 << 20)
+
+
+def measure_mmr(index, queries: np.ndarray, fetch_k: int, lambda_mult: float) -> np.ndarray:
+    """MMR reranking latency in ms of each query's fetch_k neighbours (search time excluded)."""
+    latencies = []
+    for query in queries:
+        _, ids = index.search(query.reshape(1, -1), fetch_k)
+        candidates = index.reconstruct_batch(ids[0][ids[0] >= 0])
+        start = time.perf_counter()
+        mmr_order(query, candidates, lambda_mult)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.array(latencies)
+
+
+def run(vectors: np.ndarray, k: int, query_count: int, fetch_k: int = 50,
+        mmr_lambda: float = DEFAULT_MMR_LAMBDA):
+    rng = np.random.default_rng(1)
+    order = rng.permutation(len(vectors))
+    queries = vectors[order[:query_count]]
+    base = vectors[order[query_count:]]
+    print(f"{len(base)} vectors of dimension {base.shape[1]}, {len(queries)} held-out queries, k={k}\n")
+
+    start = time.perf_counter()
+    flat = build_index(base, "flat")
+    flat_build = time.perf_counter() - start
+    exact, flat_latencies = measure(flat, queries, k)
+
+    header = f"{'index':<10} {'setting':<14} {'recall@k':>9} {'p50 ms':>8} {'p95 ms':>8} {'build s':>8} {'MB':>8}"
+    print(header)
+    print("-" * len(header))
+    print(f"{'flat':<10} {'-':<14} {1.0:>9.3f} {np.percentile(flat_latencies, 50):>8.3f} "
+          f"{np.percentile(flat_latencies, 95):>8.3f} {flat_build:>8.2f} {index_megabytes(flat):>8.1f}")
+    mmr_latencies = measure_mmr(flat, queries, fetch_k, mmr_lambda)
+    print(f"{'mmr':<10} {'fetch_k=' + str(fetch_k):<14} {'-':>9} {np.percentile(mmr_latencies, 50):>8.3f} "
+          f"{np.percentile(mmr_latencies, 95):>8.3f} {'-':>8} {'-':>8}")
+
+    for index_type, setting, values in CONFIGURATIONS:
+        built_type = effective_index_type(len(base), index_type)
+        if built_type != index_type:
+            print(f"{index_type:<10} too few vectors to train (would fall back to {built_type})")
+            continue
+        start = time.perf_counter()
+        index = build_index(base, index_type)
+        build_time = time.perf_counter() - start
+        size = index_megabytes(index)
+        for value in values:
+            configure_search(index, **{setting: value})
+            results, latencies = measure(index, queries, k)
+            print(f"{index_type:<10} {setting + '=' + str(value):<14} {recall_at_k(results, exact, k):>9.3f} "
+                  f"{np.percentile(latencies, 50):>8.3f} {np.percentile(latencies, 95):>8.3f} "
+                  f"{build_time:>8.2f} {size:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare approximate FAISS indexes with the flat baseline")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--index-dir", help="Persisted reference index (default: next to --materials-dir)")
+    source.add_argument("--synthetic", type=int, metavar="N", help="Benchmark N synthetic vectors instead")
+    parser.add_argument("--materials-dir", default="reference_materials")
+    parser.add_argument("--dimension", type=int, default=1536, help="Dimension of synthetic vectors")
+    parser.add_argument("--k", type=int, default=3, help="Neighbours per query (the retriever uses 4 * k)")
+    parser.add_argument("--queries", type=int, default=200, help="Number of held-out queries")
+    parser.add_argument("--fetch-k", type=int, default=50, help="Candidates reranked by MMR per query")
+    parser.add_argument("--mmr-lambda", type=float, default=DEFAULT_MMR_LAMBDA, help="MMR relevance/diversity trade-off")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        vectors = synthetic_vectors(args.synthetic, args.dimension)
+    else:
+        vectors = load_vectors(args.index_dir or default_index_dir(args.materials_dir))
+
+    query_count = min(args.queries, len(vectors) // 10)
+    if query_count < 1:
+        raise SystemExit("Not enough vectors to benchmark")
+    run(vectors, args.k, query_count, args.fetch_k, args.mmr_lambda)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+"""
+Per-client reference index namespaces.
+
+Each client's confidential materials get their own namespace, e.g. one per
+target company: a materials directory and a persisted ReferenceIndex of their
+own under RAG_NAMESPACES_DIR (default "client_materials"):
+
+    client_materials/<namespace>/materials/   the client's files
+    client_materials/<namespace>/index/       its vectors, docstore and manifest
+
+Namespaces share nothing (vectors, docstore, keyword postings, result caches),
+so a search in one namespace can never return another client's chunks.
+
+IndexNamespaces loads a namespace's index the first time it is searched and
+keeps loaded indexes in least-recently-used order. When their estimated
+memory exceeds RAG_NAMESPACE_MEMORY_MB (default 2048), or their number
+exceeds RAG_NAMESPACE_MAX_LOADED (default 0, no limit), the least recently
+used ones are dropped from memory; they stay on disk and load again on their
+next search, so one process can serve many more client corpora than fit in
+memory at once. Indexes held through use() (or acquire()) are not dropped
+until they are released. A dropped index is closed outside the namespaces
+lock, releasing its directory's writer lock; loading it again waits until it
+is closed, so the index loaded in its place is the directory's only writer.
+
+A name without a namespace directory is an error (KeyError), not a fallback to
+some other materials; get(name, create=True) creates an empty namespace. The
+directory name keeps only the letters and digits of the name, so the name
+that first uses a directory is recorded in it (namespace.json) and any other
+name mapping to the same directory ("acme-corp" after "Acme Corp") is
+rejected with a ValueError rather than sharing the client's materials.
+"""
+
+import os
+import sys
+import re
+import json
+import uuid
+import threading
+from contextlib import contextmanager
+from collections import Counter, OrderedDict
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# The RAG modules shared by CaseStrategy and CourseDesigner live in references/rag_shared
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rag_shared.reference_index import ReferenceIndex
+
+DEFAULT_NAMESPACES_DIR = os.getenv("RAG_NAMESPACES_DIR", "client_materials")
+DEFAULT_MEMORY_MB = float(os.getenv("RAG_NAMESPACE_MEMORY_MB", "2048"))
+DEFAULT_MAX_LOADED = int(os.getenv("RAG_NAMESPACE_MAX_LOADED", "0"))
+MATERIALS_DIR = "materials"
+INDEX_DIR = "index"
+# Records the name that owns a namespace directory
+NAME_FILE = "namespace.json"
+
+_UNSAFE = re.compile(r"[^a-z0-9]+")
+
+
+def namespace_key(name: str) -> str:
+    """The name as namespaces compare it: case-folded, with runs of whitespace collapsed."""
+    return " ".join(str(name).casefold().split())
+
+
+def namespace_slug(name: str) -> str:
+    """
+    Directory name of a namespace: lower-case letters and digits joined by dashes.
+    Different names can share a slug; IndexNamespaces rejects the second one.
+    """
+    slug = _UNSAFE.sub("-", namespace_key(name)).strip("-")
+    if not slug:
+        raise ValueError(f"Invalid index namespace {name!r}")
+    return slug
+
+
+def _collision(name: str, owner: str) -> ValueError:
+    return ValueError(f"Index namespace {name!r} would share the directory of namespace {owner!r}; "
+                      "choose a name that differs in more than punctuation")
+
+
+class IndexNamespaces:
+    """Named reference indexes, loaded on demand and evicted least recently used first."""
+
+    def __init__(self, index_factory: Callable[[str, str], ReferenceIndex], root: Optional[str] = None,
+                 memory_limit_mb: Optional[float] = None, max_loaded: Optional[int] = None):
+        """
+        Args:
+            index_factory: Creates the (not yet loaded) ReferenceIndex of a namespace
+                from its materials directory and index directory
+            root (str, optional): Directory holding the namespaces (defaults to RAG_NAMESPACES_DIR)
+            memory_limit_mb (float, optional): Estimated memory the loaded indexes may use
+                together (defaults to RAG_NAMESPACE_MEMORY_MB or 2048)
+            max_loaded (int, optional): Maximum number of loaded indexes; 0 means no limit
+                (defaults to RAG_NAMESPACE_MAX_LOADED)
+        """
+        self.index_factory = index_factory
+        self.root = root or DEFAULT_NAMESPACES_DIR
+        self.memory_limit = int((DEFAULT_MEMORY_MB if memory_limit_mb is None else memory_limit_mb) * (1 << 20))
+        self.max_loaded = DEFAULT_MAX_LOADED if max_loaded is None else max_loaded
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self._loaded = OrderedDict()  # slug -> ReferenceIndex, least recently used first
+        self._sizes = {}  # slug -> (index version, estimated bytes)
+        self._in_use = Counter()  # slug -> callers between acquire() and release()
+        self._slug_locks = {}  # slug -> lock held while the namespace loads or its dropped index closes
+        self._owners = {}  # slug -> name key recorded in the namespace directory
+        self._lock = threading.Lock()
+
+    def materials_dir(self, name: str) -> str:
+        return os.path.join(self.root, namespace_slug(name), MATERIALS_DIR)
+
+    def index_dir(self, name: str) -> str:
+        return os.path.join(self.root, namespace_slug(name), INDEX_DIR)
+
+    def exists(self, name: str) -> bool:
+        """True if the namespace has a materials directory that no other name owns."""
+        try:
+            self.check(name)
+        except (KeyError, ValueError):
+            return False
+        return True
+
+    def check(self, name: str):
+        """
+        Raises:
+            KeyError: If the namespace has no materials directory
+            ValueError: If another name owns the namespace's directory
+        """
+        if not os.path.isdir(self.materials_dir(name)):
+            raise KeyError(f"Unknown index namespace {name!r}")
+        owner = self._owner(namespace_slug(name))
+        if owner is not None and namespace_key(owner) != namespace_key(name):
+            raise _collision(name, owner)
+
+    def _owner(self, slug: str) -> Optional[str]:
+        """Name recorded in a namespace directory, or None if no name has used it yet."""
+        with self._lock:
+            owner = self._owners.get(slug)
+        if owner is not None:
+            return owner
+        try:
+            with open(os.path.join(self.root, slug, NAME_FILE), "r", encoding="utf-8") as f:
+                owner = json.load(f)["name"]
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            self._owners[slug] = owner
+        return owner
+
+    def _claim(self, name: str):
+        """
+        Record the name in its namespace directory if no name is recorded yet.
+
+        Raises:
+            ValueError: If another name owns the directory
+        """
+        slug = namespace_slug(name)
+        path = os.path.join(self.root, slug, NAME_FILE)
+        if not os.path.exists(path):
+            tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({"name": str(name)}, f)
+                try:
+                    # Fails if another process recorded its name first
+                    os.link(tmp_path, path)
+                except FileExistsError:
+                    pass
+                finally:
+                    os.remove(tmp_path)
+            except OSError as e:
+                # e.g. a namespace on a read-only share; it is still searched
+                print(f"Could not record the name of index namespace {name!r}: {e}")
+        owner = self._owner(slug)
+        if owner is not None and namespace_key(owner) != namespace_key(name):
+            raise _collision(name, owner)
+
+    def names(self) -> List[str]:
+        """Slugs of the namespaces on disk."""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(entry.name for entry in os.scandir(self.root)
+                      if os.path.isdir(os.path.join(entry.path, MATERIALS_DIR)))
+
+    def loaded(self) -> List[str]:
+        """Slugs of the namespaces in memory, least recently used first."""
+        with self._lock:
+            return list(self._loaded)
+
+    def get(self, name: str, create: bool = False) -> ReferenceIndex:
+        """
+        The namespace's index, loading (and if needed building) it on first use. It
+        may be unloaded by a later load; use() keeps it loaded while it is used.
+
+        Args:
+            name: Namespace name, e.g. the target company
+            create: Create the namespace's materials directory if it does not exist
+
+        Raises:
+            KeyError: If the namespace does not exist and create is False
+            ValueError: If another name owns the namespace's directory
+        """
+        return self._get(name, create, acquire=False)
+
+    def acquire(self, name: str, create: bool = False) -> ReferenceIndex:
+        """get(), keeping the index loaded until a matching release(name)."""
+        return self._get(name, create, acquire=True)
+
+    def release(self, name: str):
+        """End an acquire(); the index may be unloaded from now on."""
+        slug = namespace_slug(name)
+        with self._lock:
+            self._in_use[slug] -= 1
+            if self._in_use[slug] <= 0:
+                del self._in_use[slug]
+            # Limits that were exceeded while the index was in use are enforced now
+            evicted = self._evict()
+        self._close(evicted)
+
+    @contextmanager
+    def use(self, name: str, create: bool = False) -> Iterator[ReferenceIndex]:
+        """Context manager around acquire() and release()."""
+        index = self.acquire(name, create)
+        try:
+            yield index
+        finally:
+            self.release(name)
+
+    def _get(self, name: str, create: bool, acquire: bool) -> ReferenceIndex:
+        slug = namespace_slug(name)
+        with self._lock:
+            index = self._touch(name, slug, acquire)
+            if index is not None:
+                return index
+            slug_lock = self._slug_locks.setdefault(slug, threading.Lock())
+
+        # Concurrent searches of a namespace that is not loaded wait for a single load,
+        # and a load waits until the namespace's previous index is closed
+        with slug_lock:
+            with self._lock:
+                index = self._touch(name, slug, acquire)
+                if index is not None:
+                    return index
+
+            materials_dir = self.materials_dir(name)
+            if create:
+                os.makedirs(materials_dir, exist_ok=True)
+            else:
+                self.check(name)
+            self._claim(name)
+            index = self.index_factory(materials_dir, self.index_dir(name))
+            index.load_or_build()
+
+            with self._lock:
+                self._loaded[slug] = index
+                self.loads += 1
+                if acquire:
+                    self._in_use[slug] += 1
+                evicted = self._evict()
+        self._close(evicted)
+        return index
+
+    def _touch(self, name: str, slug: str, acquire: bool) -> Optional[ReferenceIndex]:
+        index = self._loaded.get(slug)
+        if index is not None:
+            # Loaded by the name that owns the directory (recorded by _claim)
+            owner = self._owners.get(slug)
+            if owner is not None and namespace_key(owner) != namespace_key(name):
+                raise _collision(name, owner)
+            self._loaded.move_to_end(slug)
+            self.hits += 1
+            if acquire:
+                self._in_use[slug] += 1
+        return index
+
+    def _size(self, slug: str) -> int:
+        index = self._loaded[slug]
+        cached = self._sizes.get(slug)
+        if cached is None or cached[0] != index.index_version:
+            cached = (index.index_version, index.memory_bytes())
+            self._sizes[slug] = cached
+        return cached[1]
+
+    def _evict(self) -> List[Tuple[str, ReferenceIndex, int]]:
+        """
+        Drop least recently used indexes until the limits hold (caller holds the lock);
+        the most recent one and those in use stay. Returns the dropped (slug, index,
+        size) for _close(), which the caller runs once it has released the lock.
+        """
+        total = sum(self._size(slug) for slug in self._loaded)
+        evicted = []
+        for slug in [slug for slug in list(self._loaded)[:-1] if slug not in self._in_use]:
+            if total <= self.memory_limit and not (self.max_loaded and len(self._loaded) > self.max_loaded):
+                break
+            index = self._loaded.pop(slug)
+            size = self._sizes.pop(slug)[1]
+            total -= size
+            self.evictions += 1
+            evicted.append((slug, index, size))
+        return evicted
+
+    def _close(self, evicted: List[Tuple[str, ReferenceIndex, int]]):
+        """Close dropped indexes (waiting for their background compactions) without the namespaces lock."""
+        for slug, index, size in evicted:
+            with self._lock:
+                slug_lock = self._slug_locks.setdefault(slug, threading.Lock())
+            with slug_lock:
+                index.close()
+            print(f"Evicted index namespace {slug} ({size / (1 << 20):.1f} MB) from memory")
+
+    def trim(self):
+        """Re-check the limits, e.g. after files were added to a loaded namespace."""
+        with self._lock:
+            evicted = self._evict()
+        self._close(evicted)
+
+    def evict(self, name: str) -> bool:
+        """Drop a namespace's index from memory. Returns False if it was not loaded or is in use."""
+        slug = namespace_slug(name)
+        with self._lock:
+            if slug not in self._loaded or slug in self._in_use:
+                return False
+            index = self._loaded.pop(slug)
+            size = self._sizes.pop(slug, (None, 0))[1]
+        self._close([(slug, index, size)])
+        return True
+
+    def memory_bytes(self) -> int:
+        """Estimated memory of the loaded indexes."""
+        with self._lock:
+            return sum(self._size(slug) for slug in self._loaded)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "loaded": len(self._loaded),
+                "memory_mb": sum(self._size(slug) for slug in self._loaded) / (1 << 20),
+                "memory_limit_mb": self.memory_limit / (1 << 20),
+                "hits": self.hits,
+                "loads": self.loads,
+                "evictions": self.evictions
+            }
+
+    def stats_summary(self) -> str:
+        stats = self.stats()
+        return (f"Namespaces: {stats['loaded']} loaded, {stats['memory_mb']:.1f}/{stats['memory_limit_mb']:.0f} MB, "
+                f"{stats['loads']} loads, {stats['evictions']} evictions")
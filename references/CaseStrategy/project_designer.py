@@ -2,35 +2,37 @@ import warnings
 warnings.filterwarnings("ignore", message=".*TqdmWarning.*")
 from dotenv import load_dotenv
 import os
+import sys
 import json
 import re
 import pandas as pd
-import glob
 from pathlib import Path
 
 _ = load_dotenv()
 
 from langgraph.graph import StateGraph, END
-from typing import TypedDict, Annotated, List, Dict, Any, Optional
+from typing import TypedDict, Annotated, List, Dict, Any, Optional, Iterator, AsyncIterator
 import operator
-from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.checkpoint.memory import MemorySaver
 from langchain_core.messages import SystemMessage, HumanMessage
+from langchain_core.runnables import RunnableLambda
 from langchain_openai import ChatOpenAI
-import sqlite3
-
-# Added imports for document handling
-from langchain_community.document_loaders import (
-    PyPDFLoader, 
-    Docx2txtLoader, 
-    UnstructuredPowerPointLoader,
-    UnstructuredHTMLLoader,
-    TextLoader
-)
+import asyncio
+import threading
+from contextlib import contextmanager, asynccontextmanager
+
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain.retrievers import ParentDocumentRetriever
-from langchain.storage import InMemoryStore
+
+# The RAG modules shared by CaseStrategy and CourseDesigner live in references/rag_shared
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rag_shared.reference_index import ReferenceIndex, SearchResults
+from index_namespaces import IndexNamespaces
+from rag_shared.material_loader import LOADERS, MaterialFile, discover_materials
+from rag_shared.materials_watcher import MaterialsWatcher, watch_default
+from rag_shared.embedding_cache import CachedEmbeddings
+from rag_shared.embedding_backends import create_embeddings
+from rag_shared.context_packer import ContextPacker, PackedContext
 
 # Default parameters - can be overridden
 target_industry = "general business"
@@ -70,21 +72,71 @@ class AgentState(TypedDict):
     company_status_notes: Optional[str]  # Notes from first client meeting
     selected_esg_project_type: Optional[str]  # Selected ESG project type
     retrieved_docs: Optional[List[Dict[str, Any]]]  # Store retrieved documents
+    retrieval_filters: Optional[Dict[str, Any]]  # Metadata filters for retrieval, e.g. {"folder": "acme"}
+    context_dropped: Optional[List[Dict[str, Any]]]  # Retrieved documents trimmed or left out of the plan prompt
+    context_tokens: Optional[int]  # Tokens of retrieved documents in the plan prompt
+    namespace: Optional[str]  # Client index namespace searched instead of the shared materials, e.g. the target company
+    index_version: Optional[int]  # Reference index snapshot the planner's documents came from
 
 class ESGProposalDesigner:
-    def __init__(self, materials_dir: str = "reference_materials"):
+    def __init__(self, materials_dir: str = "reference_materials", load_workers: Optional[int] = None,
+                 ingest_window: Optional[int] = None,
+                 background_init: bool = True, retrieval_timeout: Optional[float] = None,
+                 read_only_index: Optional[bool] = None, embedding_backend: Optional[str] = None,
+                 context_tokens: Optional[int] = None, namespaces_dir: Optional[str] = None,
+                 namespace_memory_mb: Optional[float] = None, watch_materials: Optional[bool] = None):
         """
         Initialize the ESG proposal designer with RAG capabilities.
         
         Args:
             materials_dir (str): Directory containing reference materials
+            load_workers (int, optional): Number of processes used to parse materials
+                (defaults to RAG_LOAD_WORKERS or one per CPU)
+            ingest_window (int, optional): Number of files loaded and embedded together
+                while indexing (defaults to RAG_INGEST_WINDOW or 16)
+            background_init (bool): Build the retrieval index on a background thread so the
+                graph (and the UI) are available immediately
+            retrieval_timeout (float, optional): Seconds retrieval, uploads and deletes wait for the
+                index to be ready; retrieval then continues without documents and file changes are
+                applied once the index is built (defaults to RAG_RETRIEVAL_TIMEOUT or 30)
+            read_only_index (bool, optional): Open the persisted index read-only and memory-mapped
+                so several processes share one copy; uploads are not indexed (defaults to RAG_INDEX_READ_ONLY)
+            embedding_backend (str, optional): "openai", "hashing" (CPU-only, offline) or
+                "sentence_transformers" (defaults to EMBEDDING_BACKEND or "openai")
+            context_tokens (int, optional): Token budget for retrieved documents in the plan
+                prompt (defaults to RAG_CONTEXT_TOKENS or 3000)
+            namespaces_dir (str, optional): Directory of the per-client index namespaces
+                (defaults to RAG_NAMESPACES_DIR or "client_materials")
+            namespace_memory_mb (float, optional): Memory the loaded client indexes may use before the
+                least recently used are unloaded (defaults to RAG_NAMESPACE_MEMORY_MB or 2048)
+            watch_materials (bool, optional): Watch the materials directory and index files copied
+                into it directly, in the background (defaults to RAG_WATCH_MATERIALS, off)
         """
         self.model = ChatOpenAI(model="gpt-4o", temperature=0.7)
         self.materials_dir = materials_dir
+        self.load_workers = load_workers
+        self.ingest_window = ingest_window
+        self.read_only_index = read_only_index
+        self.embedding_backend = embedding_backend
+        # Retrieved documents are fitted into a token budget before they go into the plan prompt
+        self.context_packer = ContextPacker(context_tokens, model=self.model.model_name)
+        self.retrieval_timeout = (retrieval_timeout if retrieval_timeout is not None
+                                  else float(os.getenv("RAG_RETRIEVAL_TIMEOUT", "30")))
         self.vector_store = None
+        self.reference_index = None
+        # Files dropped into the materials directory directly (e.g. over SMB) are picked up by a watcher
+        self.watch_materials = watch_default() if watch_materials is None else watch_materials
+        self.materials_watcher = None
+        # Last walk of the materials directory, shared by the index refresh and the GUI's file list;
+        # None once an upload, delete or applied change may have made it stale
+        self._material_files = None
+        # Per-client indexes, loaded on first use and unloaded least recently used first
+        self.namespaces = IndexNamespaces(self._create_namespace_index, namespaces_dir, namespace_memory_mb)
+        self._namespace_embeddings = None
+        self._namespace_lock = threading.Lock()
         
         # Initialize the document retrieval system
-        self._initialize_retrieval_system()
+        self._start_retrieval_warm_up(background_init)
         
         # System prompts for each node
         self.PLAN_PROMPT = (
@@ -155,9 +207,11 @@ class ESGProposalDesigner:
         builder = StateGraph(AgentState)
         
         # Add nodes
-        builder.add_node("planner", self.plan_node)
-        builder.add_node("drafter", self.draft_node)
-        builder.add_node("finalizer", self.finalize_node)
+        # Each node has a sync and an async implementation, so the same graph serves
+        # graph.invoke from the GUI and graph.ainvoke for many threads on one event loop
+        builder.add_node("planner", RunnableLambda(self.plan_node, afunc=self.aplan_node, name="planner"))
+        builder.add_node("drafter", RunnableLambda(self.draft_node, afunc=self.adraft_node, name="drafter"))
+        builder.add_node("finalizer", RunnableLambda(self.finalize_node, afunc=self.afinalize_node, name="finalizer"))
         
         # Set entry point
         builder.set_entry_point("planner")
@@ -172,8 +226,8 @@ class ESGProposalDesigner:
         builder.add_edge("planner", "drafter")
         builder.add_edge("finalizer", "drafter")
         
-        # Set up memory
-        memory = SqliteSaver(conn=sqlite3.connect(":memory:", check_same_thread=False))
+        # Set up memory (in-process, supports both the sync and the async graph API)
+        memory = MemorySaver()
         
         # Compile graph
         self.graph = builder.compile(
@@ -181,6 +235,132 @@ class ESGProposalDesigner:
             interrupt_after=['planner', 'drafter', 'finalizer']
         )
 
+    def _start_retrieval_warm_up(self, background: bool = True):
+        """Build the retrieval system, by default on a background thread."""
+        # Readiness state: "building", "ready", "empty" (no documents) or "failed"
+        self.retrieval_status = "building"
+        self.retrieval_error = None
+        self._retrieval_ready = threading.Event()
+        # Files uploaded or deleted while the index was building, applied once it is built
+        self._deferred_paths = []
+        self._deferred_lock = threading.Lock()
+        
+        if background:
+            self._retrieval_thread = threading.Thread(
+                target=self._warm_up_retrieval, name="retrieval-warm-up", daemon=True)
+            self._retrieval_thread.start()
+        else:
+            self._warm_up_retrieval()
+
+    def _warm_up_retrieval(self):
+        try:
+            self._initialize_retrieval_system()
+            self.retrieval_status = "ready" if self._index_has_documents() else "empty"
+        except Exception as e:
+            self.retrieval_error = str(e)
+            self.retrieval_status = "failed"
+            print(f"Error initializing retrieval system: {e}")
+        finally:
+            with self._deferred_lock:
+                self._retrieval_ready.set()
+                deferred, self._deferred_paths = self._deferred_paths, []
+        if deferred:
+            try:
+                self.apply_material_changes(deferred)
+            except Exception as e:
+                print(f"Error indexing files changed while the index was building: {e}")
+        if self.watch_materials:
+            self._start_materials_watcher()
+
+    def _start_materials_watcher(self):
+        """Keep the index in sync with files added, changed or deleted outside the app."""
+        if self.reference_index is not None and self.reference_index.read_only:
+            print("Read-only index: the materials directory is not watched")
+            return
+        if not os.path.isdir(self.materials_dir):
+            return
+        self.materials_watcher = MaterialsWatcher(self.materials_dir, self.apply_material_changes,
+                                                  self._changed_material_paths)
+        self.materials_watcher.start()
+
+    def apply_material_changes(self, paths: List[str]) -> Dict[str, int]:
+        """
+        Apply a batch of added, modified and deleted files to the live index at once;
+        searches see the whole batch or none of it.
+        
+        Args:
+            paths: Paths inside the materials directory
+            
+        Returns:
+            Counts of indexed, removed, unchanged and failed files (empty if the index was built instead)
+        """
+        self.wait_for_retrieval()
+        self._material_files = None
+        
+        if self.reference_index is None:
+            # Nothing was indexed at start-up (the directory was missing): build the index now
+            self._initialize_retrieval_system()
+            self.retrieval_status = "ready" if self._index_has_documents() else "empty"
+            return {}
+        
+        result = self.reference_index.apply_changes(paths)
+        
+        # The first files added to an empty index make it searchable
+        if self.retrieval_status == "empty" and self._index_has_documents():
+            self.retrieval_status = "ready"
+        return result
+
+    def _changed_material_paths(self) -> List[str]:
+        """Paths that differ from the index; every material if there is no index yet."""
+        files = self._discover_material_files()
+        if self.reference_index is None:
+            return [material.path for material in files if material.extension in LOADERS]
+        return self.reference_index.changed_paths(files)
+
+    def _discover_material_files(self) -> List[MaterialFile]:
+        """Walk the materials directory once and keep the result for material_files()."""
+        self._material_files = discover_materials(self.materials_dir)
+        return self._material_files
+
+    def material_files(self, refresh: bool = False) -> List[MaterialFile]:
+        """
+        Every file in the materials directory, e.g. for the GUI's file list.
+        
+        The last walk (at start-up or by the watcher's latest scan) is reused while the
+        watcher keeps it current and no upload or delete has made it stale.
+        
+        Args:
+            refresh: Walk the directory again, e.g. after files were copied into it
+        """
+        files = self._material_files
+        if refresh or files is None or self.materials_watcher is None:
+            files = self._discover_material_files()
+        return files
+
+    def is_retrieval_ready(self) -> bool:
+        """True once the retrieval system has finished building (successfully or not)."""
+        return self._retrieval_ready.is_set()
+
+    def wait_for_retrieval(self, timeout: Optional[float] = None) -> bool:
+        """Block until the retrieval system is built. Returns False on timeout."""
+        return self._retrieval_ready.wait(timeout)
+
+    def _defer_until_ready(self, path: str) -> bool:
+        """
+        Wait up to retrieval_timeout for the index to be built. If it still is not,
+        queue the path to be brought up to date (indexed or removed) once it is, and
+        return True.
+        """
+        if self.wait_for_retrieval(self.retrieval_timeout):
+            return False
+        with self._deferred_lock:
+            # The build may have finished, and taken the queue, since the wait timed out
+            if self._retrieval_ready.is_set():
+                return False
+            self._deferred_paths.append(path)
+        print(f"Reference index still {self.retrieval_status}; {path} is updated once it is ready")
+        return True
+
     def _initialize_retrieval_system(self):
         """Initialize the document retrieval system with reference materials."""
         # Create the materials directory if it doesn't exist
@@ -190,114 +370,361 @@ class ESGProposalDesigner:
             print(f"Please add your reference materials (PDFs, DOCXs, PPTs, HTMLs) to this directory")
             return
 
-        # Get all documents from the materials directory
-        documents = []
-        
-        # Load different file types
-        pdf_files = glob.glob(os.path.join(self.materials_dir, "**/*.pdf"), recursive=True)
-        docx_files = glob.glob(os.path.join(self.materials_dir, "**/*.docx"), recursive=True)
-        pptx_files = glob.glob(os.path.join(self.materials_dir, "**/*.pptx"), recursive=True)
-        html_files = glob.glob(os.path.join(self.materials_dir, "**/*.html"), recursive=True)
-        txt_files = glob.glob(os.path.join(self.materials_dir, "**/*.txt"), recursive=True)
-        
-        print(f"Found {len(pdf_files)} PDFs, {len(docx_files)} DOCXs, {len(pptx_files)} PPTs, {len(html_files)} HTMLs, {len(txt_files)} TXTs")
-        
-        # Process each file type
-        for pdf in pdf_files:
-            try:
-                loader = PyPDFLoader(pdf)
-                documents.extend(loader.load())
-            except Exception as e:
-                print(f"Error loading PDF {pdf}: {e}")
-        
-        for docx in docx_files:
-            try:
-                loader = Docx2txtLoader(docx)
-                documents.extend(loader.load())
-            except Exception as e:
-                print(f"Error loading DOCX {docx}: {e}")
-        
-        for pptx in pptx_files:
-            try:
-                loader = UnstructuredPowerPointLoader(pptx)
-                documents.extend(loader.load())
-            except Exception as e:
-                print(f"Error loading PPTX {pptx}: {e}")
+        # Set up vector store
+        embeddings = self._create_embeddings()
         
-        for html in html_files:
-            try:
-                loader = UnstructuredHTMLLoader(html)
-                documents.extend(loader.load())
-            except Exception as e:
-                print(f"Error loading HTML {html}: {e}")
-                
-        for txt in txt_files:
-            try:
-                loader = TextLoader(txt)
-                documents.extend(loader.load())
-            except Exception as e:
-                print(f"Error loading TXT {txt}: {e}")
+        # Load the persisted index, re-embedding only files that changed since the last run
+        self.reference_index = self._create_reference_index(embeddings)
+        vectorstore = self.reference_index.load_or_build(self._discover_material_files())
+        if isinstance(embeddings, CachedEmbeddings):
+            print(embeddings.stats_summary())
         
-        if not documents:
+        if vectorstore is None:
             print("No documents found in the reference directory. Vector store not initialized.")
             return
         
+        print(f"Successfully initialized retrieval system with {self.reference_index.parent_count()} parent chunks "
+              f"and {self.reference_index.document_count()} child vectors")
+
+    def _create_embeddings(self):
+        """Embeddings of the configured backend; OpenAI ones are batched, rate limited and cached on disk."""
+        return create_embeddings(self.embedding_backend)
+
+    def _create_reference_index(self, embeddings, materials_dir: Optional[str] = None,
+                                index_dir: Optional[str] = None):
+        """Two-level index: small child chunks are embedded, parent chunks are kept in a disk-backed docstore."""
         # Set up text splitter for chunking
         parent_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200)
         child_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
         
-        # Set up vector store
-        embeddings = OpenAIEmbeddings()
-        
-        # Set up parent document retriever with in-memory store
-        parent_store = InMemoryStore()
-        self.retriever = ParentDocumentRetriever(
-            vectorstore=FAISS.from_documents(documents, embeddings),
-            docstore=parent_store,
+        return ReferenceIndex(
+            materials_dir or self.materials_dir,
+            embeddings,
+            index_dir=index_dir,
+            load_workers=self.load_workers,
+            ingest_window=self.ingest_window,
             parent_splitter=parent_splitter,
-            child_splitter=child_splitter
+            child_splitter=child_splitter,
+            read_only=self.read_only_index
         )
+
+    def _create_namespace_index(self, materials_dir: str, index_dir: str):
+        """Index of a client namespace; all namespaces share one embeddings object."""
+        with self._namespace_lock:
+            if self._namespace_embeddings is None:
+                self._namespace_embeddings = self._create_embeddings()
+        return self._create_reference_index(self._namespace_embeddings, materials_dir, index_dir)
+
+    def _index_has_documents(self) -> bool:
+        """True once the shared reference index has published documents to search."""
+        return self.reference_index is not None and self.reference_index.snapshot().vectorstore is not None
+
+    def add_reference_file(self, path: str, namespace: Optional[str] = None) -> Optional[int]:
+        """
+        Add a newly uploaded or modified file to the live index.
+        
+        Args:
+            path: Path of the file inside the materials directory (of the namespace, if given)
+            namespace: Client namespace the file belongs to; created if it does not exist
+            
+        Returns:
+            Number of vectors added for the file, or None if the index is still being built
+            after retrieval_timeout seconds; the file is then indexed once the build finishes
+        """
+        if namespace:
+            # Kept loaded while the file is added; once released, the grown index may
+            # unload others if they no longer fit together
+            with self.namespaces.use(namespace, create=True) as index:
+                return index.add_file(path)
+        
+        # Let a running warm-up finish first; it may already pick the file up
+        self._material_files = None
+        if self._defer_until_ready(path):
+            return None
+        
+        if self.reference_index is None:
+            self.reference_index = self._create_reference_index(self._create_embeddings())
+        
+        added = self.reference_index.add_file(path)
+        
+        # The first file added to an empty index makes it searchable
+        if self.retrieval_status == "empty" and self._index_has_documents():
+            self.retrieval_status = "ready"
+        
+        return added
+
+    def remove_reference_file(self, path: str, namespace: Optional[str] = None) -> Optional[int]:
+        """
+        Remove a deleted file's vectors from the live index.
+        
+        Args:
+            path: Path of the file inside the materials directory (of the namespace, if given)
+            namespace: Client namespace the file belongs to
+            
+        Returns:
+            Number of vectors removed, or None if the index is still being built after
+            retrieval_timeout seconds; the file is then removed once the build finishes
+        """
+        if namespace:
+            if not self.namespaces.exists(namespace):
+                return 0
+            with self.namespaces.use(namespace) as index:
+                return index.remove_file(path)
+        
+        self._material_files = None
+        if self._defer_until_ready(path):
+            return None
+        
+        if self.reference_index is None:
+            return 0
+        return self.reference_index.remove_file(path)
+
+    @contextmanager
+    def _search_index(self, namespace: Optional[str] = None) -> Iterator[Optional[ReferenceIndex]]:
+        """
+        The index a retrieval searches, as a context manager: the client namespace's own
+        index if a namespace is given, kept loaded until the block ends, otherwise the
+        shared one once it is built. None if there is none.
+        
+        Raises:
+            KeyError: If the namespace does not exist; a client's search never falls back
+                to the shared materials
+            ValueError: If another namespace name owns its directory
+        """
+        if namespace:
+            index = self._acquire_namespace(namespace)
+            try:
+                yield index
+            finally:
+                if index is not None:
+                    self.namespaces.release(namespace)
+            return
+        yield self._shared_search_index()
+
+    def _acquire_namespace(self, namespace: str) -> Optional[ReferenceIndex]:
+        self._check_namespace(namespace)
+        try:
+            return self.namespaces.acquire(namespace)
+        except Exception as e:
+            print(f"Error loading index namespace {namespace!r}: {e}")
+            return None
+
+    def _shared_search_index(self) -> Optional[ReferenceIndex]:
+        # Degrade gracefully while the index is still being built
+        if not self.wait_for_retrieval(self.retrieval_timeout):
+            print(f"Retrieval system still {self.retrieval_status} after {self.retrieval_timeout}s. "
+                  "Continuing without retrieved documents.")
+            return None
+        
+        if not self._index_has_documents():
+            print("Reference index is empty. No documents will be retrieved.")
+            return None
+        return self.reference_index
+
+    def _check_namespace(self, namespace: str):
+        try:
+            self.namespaces.check(namespace)
+        except KeyError:
+            raise KeyError(f"Unknown index namespace {namespace!r}; add its materials "
+                           f"to {self.namespaces.materials_dir(namespace)} first") from None
+
+    @asynccontextmanager
+    async def _asearch_index(self, namespace: Optional[str] = None) -> AsyncIterator[Optional[ReferenceIndex]]:
+        """Async _search_index; loading a namespace and waiting for the build run off the event loop."""
+        if namespace:
+            self._check_namespace(namespace)
+            index = await asyncio.to_thread(self._acquire_namespace, namespace)
+            try:
+                yield index
+            finally:
+                if index is not None:
+                    # May close unloaded indexes, which waits for their compactions
+                    await asyncio.to_thread(self.namespaces.release, namespace)
+            return
         
-        print(f"Successfully initialized retrieval system with {len(documents)} documents")
+        if not await self._await_retrieval():
+            yield None
+        elif not self._index_has_documents():
+            print("Reference index is empty. No documents will be retrieved.")
+            yield None
+        else:
+            yield self.reference_index
 
-    def retrieve_relevant_documents(self, task: str, k: int = 3) -> List[Dict[str, Any]]:
+    def retrieve_relevant_documents(self, task: str, k: int = 3, filters: Optional[Dict[str, Any]] = None,
+                                    namespace: Optional[str] = None) -> List[Dict[str, Any]]:
         """
         Retrieve relevant documents based on the task.
         
         Args:
             task: The proposal topic to search for
             k: Number of documents to retrieve
+            filters: Only search files matching these metadata filters
+                (file_type, source, folder, uploaded_after, uploaded_before)
+            namespace: Search this client's own materials instead of the shared ones;
+                KeyError if the namespace does not exist, ValueError if its name
+                collides with another namespace's
             
         Returns:
             List of retrieved documents
         """
-        if not self.retriever:
-            print("Retriever not initialized. No documents will be retrieved.")
+        with self._search_index(namespace) as index:
+            if index is None:
+                return []
+            
+            try:
+                # Match child chunks and return the k parent chunks they belong to
+                docs = index.search(task, k=k, filters=filters)
+                return self._format_documents(docs)
+            except Exception as e:
+                print(f"Error retrieving documents: {e}")
+                return []
+
+    def retrieve_many(self, queries: List[str], k: int = 3, dedup: bool = False,
+                      filters: Optional[Dict[str, Any]] = None,
+                      namespace: Optional[str] = None) -> List[List[Dict[str, Any]]]:
+        """
+        Retrieve documents for several queries (e.g. one per section or focus area) at once.
+        
+        The queries are embedded in one batch and the index is searched once for all of them.
+        
+        Args:
+            queries: Texts to search for
+            k: Number of documents to retrieve per query
+            dedup: Return each document only for the first query that finds it
+            filters: Only search files matching these metadata filters
+            namespace: Search this client's own materials instead of the shared ones;
+                KeyError if the namespace does not exist, ValueError if its name
+                collides with another namespace's
+            
+        Returns:
+            One list of retrieved documents per query
+        """
+        if not queries:
             return []
         
-        try:
-            # Retrieve relevant documents
-            docs = self.retriever.get_relevant_documents(task, k=k)
+        with self._search_index(namespace) as index:
+            if index is None:
+                return [[] for _ in queries]
+            
+            try:
+                results = index.search_many(queries, k=k, dedup=dedup, filters=filters)
+                return [self._format_documents(docs) for docs in results]
+            except Exception as e:
+                print(f"Error retrieving documents: {e}")
+                return [[] for _ in queries]
+
+    async def _await_retrieval(self) -> bool:
+        """Async wait_for_retrieval; the event loop keeps running while the index builds."""
+        if self.is_retrieval_ready():
+            return True
+        if await asyncio.to_thread(self.wait_for_retrieval, self.retrieval_timeout):
+            return True
+        print(f"Retrieval system still {self.retrieval_status} after {self.retrieval_timeout}s. "
+              "Continuing without retrieved documents.")
+        return False
+
+    async def aretrieve_relevant_documents(self, task: str, k: int = 3, filters: Optional[Dict[str, Any]] = None,
+                                           namespace: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Async retrieve_relevant_documents: query embedding is awaited and the index
+        search runs in a worker thread.
+        
+        Args:
+            task: The proposal topic to search for
+            k: Number of documents to retrieve
+            filters: Only search files matching these metadata filters
+                (file_type, source, folder, uploaded_after, uploaded_before)
+            namespace: Search this client's own materials instead of the shared ones;
+                KeyError if the namespace does not exist, ValueError if its name
+                collides with another namespace's
             
-            # Format the documents as a list of dictionaries
-            formatted_docs = []
-            for doc in docs:
-                source = doc.metadata.get("source", "Unknown source")
-                formatted_docs.append({
-                    "content": doc.page_content,
-                    "source": Path(source).name if isinstance(source, str) else "Unknown",
-                    "metadata": doc.metadata
-                })
+        Returns:
+            List of retrieved documents
+        """
+        async with self._asearch_index(namespace) as index:
+            if index is None:
+                return []
             
-            return formatted_docs
-        except Exception as e:
-            print(f"Error retrieving documents: {e}")
+            try:
+                docs = await index.asearch(task, k=k, filters=filters)
+                return self._format_documents(docs)
+            except Exception as e:
+                print(f"Error retrieving documents: {e}")
+                return []
+
+    async def aretrieve_many(self, queries: List[str], k: int = 3, dedup: bool = False,
+                             filters: Optional[Dict[str, Any]] = None,
+                             namespace: Optional[str] = None) -> List[List[Dict[str, Any]]]:
+        """
+        Async retrieve_many.
+        
+        Args:
+            queries: Texts to search for
+            k: Number of documents to retrieve per query
+            dedup: Return each document only for the first query that finds it
+            filters: Only search files matching these metadata filters
+            namespace: Search this client's own materials instead of the shared ones;
+                KeyError if the namespace does not exist, ValueError if its name
+                collides with another namespace's
+            
+        Returns:
+            One list of retrieved documents per query
+        """
+        if not queries:
             return []
+        
+        async with self._asearch_index(namespace) as index:
+            if index is None:
+                return [[] for _ in queries]
+            
+            try:
+                results = await index.asearch_many(queries, k=k, dedup=dedup, filters=filters)
+                return [self._format_documents(docs) for docs in results]
+            except Exception as e:
+                print(f"Error retrieving documents: {e}")
+                return [[] for _ in queries]
+
+    def _format_documents(self, docs) -> SearchResults:
+        """Format retrieved documents as a list of dictionaries, keeping the searched index version."""
+        formatted_docs = []
+        for doc in docs:
+            source = doc.metadata.get("source", "Unknown source")
+            formatted_docs.append({
+                "content": doc.page_content,
+                "source": Path(source).name if isinstance(source, str) else "Unknown",
+                "metadata": doc.metadata
+            })
+        return SearchResults(formatted_docs, getattr(docs, "index_version", None))
 
     def plan_node(self, state: AgentState):
         # Retrieve relevant documents for the task
+        retrieved_docs = self.retrieve_relevant_documents(state.get('task', ""),
+                                                          filters=state.get('retrieval_filters'),
+                                                          namespace=state.get('namespace'))
+        context = self._pack_context(retrieved_docs)
+        response = self.model.invoke(self._plan_messages(state, context.documents))
+        return self._plan_update(state, context, response.content, retrieved_docs)
+
+    async def aplan_node(self, state: AgentState):
+        """Async plan_node: retrieval and the model call run without blocking the event loop."""
+        retrieved_docs = await self.aretrieve_relevant_documents(state.get('task', ""),
+                                                                 filters=state.get('retrieval_filters'),
+                                                                 namespace=state.get('namespace'))
+        context = self._pack_context(retrieved_docs)
+        response = await self.model.ainvoke(self._plan_messages(state, context.documents))
+        return self._plan_update(state, context, response.content, retrieved_docs)
+
+    def _pack_context(self, retrieved_docs: List[Dict[str, Any]]) -> PackedContext:
+        context = self.context_packer.pack(retrieved_docs)
+        if context.dropped:
+            trimmed = sum(1 for item in context.dropped if item["reason"] == "trimmed")
+            print(f"Context packing: {len(context.documents)} of {len(retrieved_docs)} documents in "
+                  f"{context.tokens}/{context.budget} tokens ({trimmed} trimmed, "
+                  f"{len(context.dropped) - trimmed} dropped)")
+        return context
+
+    def _plan_messages(self, state: AgentState, retrieved_docs: List[Dict[str, Any]]):
         task = state.get('task', "")
-        retrieved_docs = self.retrieve_relevant_documents(task)
         
         # Get company status notes and selected ESG project type
         company_status_notes = state.get('company_status_notes', "No status notes provided")
@@ -318,16 +745,16 @@ class ESGProposalDesigner:
         # Combine the task and context for the planner
         prompt = f"{task}\n\n{context}" if context else task
         
-        messages = [
+        return [
             SystemMessage(content=self.PLAN_PROMPT),
             HumanMessage(content=prompt)
         ]
-        
-        response = self.model.invoke(messages)
-        
+
+    def _plan_update(self, state: AgentState, context: PackedContext, plan: str,
+                     retrieved_docs: List[Dict[str, Any]]):
         # Return a complete state with all required keys and default values
         return {
-            "plan": response.content,
+            "plan": plan,
             "lnode": "planner",
             "draft": state.get('draft', "no draft yet"),
             "critique": state.get('critique', "no critique yet"),
@@ -335,108 +762,110 @@ class ESGProposalDesigner:
             "max_revisions": state.get('max_revisions', 2),
             "count": 1,
             "task": state.get('task', ""),
-            "company_status_notes": company_status_notes,
-            "selected_esg_project_type": selected_esg_project_type,
-            "retrieved_docs": retrieved_docs  # Store the retrieved documents in the state
+            "company_status_notes": state.get('company_status_notes', "No status notes provided"),
+            "selected_esg_project_type": state.get('selected_esg_project_type', "No ESG project type selected"),
+            "retrieved_docs": context.documents,  # Store the documents the planner saw in the state
+            "context_dropped": context.dropped,
+            "context_tokens": context.tokens,
+            # The snapshot that was searched, even if it returned nothing; None if no index was searched
+            "index_version": getattr(retrieved_docs, "index_version", None)
         }
 
     def draft_node(self, state: AgentState):
         try:
-            # Safely access state with defaults
-            task = state.get('task', "")
-            plan = state.get('plan', "No plan available")
-            company_status_notes = state.get('company_status_notes', "No status notes provided")
-            selected_esg_project_type = state.get('selected_esg_project_type', "No ESG project type selected")
-            
-            # Format draft prompt with the company status notes and selected ESG project type
-            formatted_draft_prompt = self.DRAFT_PROMPT.format(
-                company_status_notes=company_status_notes,
-                selected_esg_project_type=selected_esg_project_type
-            )
-            
-            user_message = HumanMessage(
-                content=f"{task}\n\nHere is my strategic management proposal plan:\n\n{plan}")
-            
-            messages = [
-                SystemMessage(content=formatted_draft_prompt),
-                user_message
-            ]
-            
-            # If there's critique, add it to the context
-            if state.get('critique'):
-                messages.append(HumanMessage(content=f"Here is feedback on my previous draft:\n\n{state['critique']}"))
-            
-            response = self.model.invoke(messages)
-            
-            # Return complete state with all required keys
-            return {
-                "draft": response.content,
-                "plan": state.get('plan', ""),
-                "critique": state.get('critique', "no critique yet"),
-                "task": state.get('task', ""),
-                "company_status_notes": company_status_notes,
-                "selected_esg_project_type": selected_esg_project_type,
-                "revision_number": state.get("revision_number", 0) + 1,
-                "max_revisions": state.get("max_revisions", 2),
-                "lnode": "drafter",
-                "count": state.get("count", 0) + 1,
-                "retrieved_docs": state.get("retrieved_docs", [])  # Preserve retrieved docs
-            }
+            response = self.model.invoke(self._draft_messages(state))
+            return self._draft_update(state, response.content)
         except Exception as e:
             print(f"Error in draft_node: {e}")
-            # Return a minimal valid state in case of error
-            return {
-                "draft": "Error occurred during content generation.",
-                "plan": state.get('plan', ""),
-                "critique": state.get('critique', ""),
-                "task": state.get('task', ""),
-                "company_status_notes": state.get('company_status_notes', "No status notes provided"),
-                "selected_esg_project_type": state.get('selected_esg_project_type', "No ESG project type selected"),
-                "revision_number": state.get("revision_number", 0) + 1,
-                "max_revisions": state.get("max_revisions", 2),
-                "lnode": "drafter",
-                "count": state.get("count", 0) + 1,
-                "retrieved_docs": state.get("retrieved_docs", [])  # Preserve retrieved docs
-            }
+            return self._draft_update(state, "Error occurred during content generation.", failed=True)
+
+    async def adraft_node(self, state: AgentState):
+        """Async draft_node."""
+        try:
+            response = await self.model.ainvoke(self._draft_messages(state))
+            return self._draft_update(state, response.content)
+        except Exception as e:
+            print(f"Error in adraft_node: {e}")
+            return self._draft_update(state, "Error occurred during content generation.", failed=True)
+
+    def _draft_messages(self, state: AgentState):
+        # Safely access state with defaults
+        task = state.get('task', "")
+        plan = state.get('plan', "No plan available")
+        
+        # Format draft prompt with the company status notes and selected ESG project type
+        formatted_draft_prompt = self.DRAFT_PROMPT.format(
+            company_status_notes=state.get('company_status_notes', "No status notes provided"),
+            selected_esg_project_type=state.get('selected_esg_project_type', "No ESG project type selected")
+        )
+        
+        user_message = HumanMessage(
+            content=f"{task}\n\nHere is my strategic management proposal plan:\n\n{plan}")
+        
+        messages = [
+            SystemMessage(content=formatted_draft_prompt),
+            user_message
+        ]
+        
+        # If there's critique, add it to the context
+        if state.get('critique'):
+            messages.append(HumanMessage(content=f"Here is feedback on my previous draft:\n\n{state['critique']}"))
+        return messages
+
+    def _draft_update(self, state: AgentState, draft: str, failed: bool = False):
+        # Return complete state with all required keys; a failed draft still counts as a revision
+        return {
+            "draft": draft,
+            "plan": state.get('plan', ""),
+            "critique": state.get('critique', "" if failed else "no critique yet"),
+            "task": state.get('task', ""),
+            "company_status_notes": state.get('company_status_notes', "No status notes provided"),
+            "selected_esg_project_type": state.get('selected_esg_project_type', "No ESG project type selected"),
+            "revision_number": state.get("revision_number", 0) + 1,
+            "max_revisions": state.get("max_revisions", 2),
+            "lnode": "drafter",
+            "count": state.get("count", 0) + 1,
+            "retrieved_docs": state.get("retrieved_docs", [])  # Preserve retrieved docs
+        }
     
     def finalize_node(self, state: AgentState):
         try:
-            # Safely access state with default
-            draft = state.get('draft', "No content available")
-            
-            messages = [
-                SystemMessage(content=self.FINALIZE_PROMPT), 
-                HumanMessage(content=draft)
-            ]
-            
-            response = self.model.invoke(messages)
-            
-            # Return complete state with all required keys
-            return {
-                "critique": response.content,
-                "draft": state.get('draft', ""),
-                "plan": state.get('plan', ""),
-                "task": state.get('task', ""),
-                "revision_number": state.get("revision_number", 0),
-                "max_revisions": state.get("max_revisions", 2),
-                "lnode": "finalizer",
-                "count": state.get("count", 0) + 1,
-                "retrieved_docs": state.get("retrieved_docs", [])  # Preserve retrieved docs
-            }
+            response = self.model.invoke(self._finalize_messages(state))
+            return self._finalize_update(state, response.content)
         except Exception as e:
             print(f"Error in finalize_node: {e}")
-            # Return a minimal valid state in case of error
-            return {
-                "critique": "Error occurred during finalization.",
-                "draft": state.get('draft', ""),
-                "plan": state.get('plan', ""),
-                "task": state.get('task', ""),
-                "revision_number": state.get("revision_number", 0),
-                "max_revisions": state.get("max_revisions", 2),
-                "lnode": "finalizer",
-                "count": state.get("count", 0) + 1,
-                "retrieved_docs": state.get("retrieved_docs", [])  # Preserve retrieved docs
-            }
+            return self._finalize_update(state, "Error occurred during finalization.")
+
+    async def afinalize_node(self, state: AgentState):
+        """Async finalize_node."""
+        try:
+            response = await self.model.ainvoke(self._finalize_messages(state))
+            return self._finalize_update(state, response.content)
+        except Exception as e:
+            print(f"Error in afinalize_node: {e}")
+            return self._finalize_update(state, "Error occurred during finalization.")
+
+    def _finalize_messages(self, state: AgentState):
+        # Safely access state with default
+        draft = state.get('draft', "No content available")
+        return [
+            SystemMessage(content=self.FINALIZE_PROMPT), 
+            HumanMessage(content=draft)
+        ]
+
+    def _finalize_update(self, state: AgentState, critique: str):
+        # Return complete state with all required keys
+        return {
+            "critique": critique,
+            "draft": state.get('draft', ""),
+            "plan": state.get('plan', ""),
+            "task": state.get('task', ""),
+            "revision_number": state.get("revision_number", 0),
+            "max_revisions": state.get("max_revisions", 2),
+            "lnode": "finalizer",
+            "count": state.get("count", 0) + 1,
+            "retrieved_docs": state.get("retrieved_docs", [])  # Preserve retrieved docs
+        }
     
     def should_continue(self, state):
         try:
@@ -816,5 +1245,5 @@ if __name__ == "__main__":
     proposal_designer = ESGProposalDesigner(materials_dir="reference_materials")
     # Import here to avoid circular import
     from gui import ESGProposalGUI
-    app = ESGProposalGUI(proposal_designer.graph)
+    app = ESGProposalGUI(proposal_designer.graph, designer=proposal_designer)
     app.launch() 
@@ -2,10 +2,10 @@ import warnings
 warnings.filterwarnings("ignore", message=".*TqdmWarning.*")
 from dotenv import load_dotenv
 import os
+import sys
 import json
 import re
 import pandas as pd
-import glob
 from pathlib import Path
 import csv
 import openpyxl
@@ -15,24 +15,26 @@ _ = load_dotenv()
 from langgraph.graph import StateGraph, END
 from typing import TypedDict, Annotated, List, Dict, Any, Optional
 import operator
-from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.checkpoint.memory import MemorySaver
 from langchain_core.messages import SystemMessage, HumanMessage
+from langchain_core.runnables import RunnableLambda
 from langchain_openai import ChatOpenAI
-import sqlite3
+import asyncio
+import threading
 
+# The RAG modules shared by CaseStrategy and CourseDesigner live in references/rag_shared
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 # Added imports for document handling
-from langchain_community.document_loaders import (
-    PyPDFLoader, 
-    Docx2txtLoader, 
-    UnstructuredPowerPointLoader,
-    UnstructuredHTMLLoader,
-    TextLoader
+from rag_shared.reference_index import ReferenceIndex, SearchResults, default_index_dir
+from rag_shared.material_loader import (
+    LOADERS, LoadReport, MaterialFile, ExtractedTextCache, iter_extracted_texts, discover_materials
 )
+from rag_shared.materials_watcher import MaterialsWatcher, watch_default
+from rag_shared.embedding_cache import CachedEmbeddings
+from rag_shared.embedding_backends import create_embeddings
+from rag_shared.context_packer import ContextPacker, PackedContext
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
-from langchain.retrievers import ParentDocumentRetriever
-from langchain.storage import InMemoryStore
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.vectorstores import FAISS
 from langchain.embeddings import OpenAIEmbeddings
@@ -49,20 +51,22 @@ class TeachingMaterialsRAGTool:
         documents = []
         
         # Load all supported files from materials directory
-        for file_path in self.materials_dir.glob("**/*"):
-            if file_path.is_file() and file_path.suffix.lower() in ['.txt', '.md', '.pdf', '.docx']:
-                try:
-                    # Load content (simplified - would need proper loaders per file type)
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    
-                    # Add to documents with metadata
-                    documents.append({
-                        'content': content,
-                        'source': str(file_path.name)
-                    })
-                except Exception as e:
-                    print(f"Error loading {file_path}: {e}")
+        material_files = discover_materials(str(self.materials_dir), ['.txt', '.md', '.pdf', '.docx'])
+        
+        # Extract text with the same format-specific loaders as the retriever; unchanged
+        # files are served from the extracted-text cache instead of being parsed again
+        text_cache = ExtractedTextCache(os.path.join(default_index_dir(str(self.materials_dir)), "extracted_text.sqlite"))
+        evicted = text_cache.retain(material.path for material in material_files)
+        if evicted:
+            print(f"Dropped the cached text of {evicted} files no longer in {self.materials_dir}")
+        report = LoadReport()
+        for path, content in iter_extracted_texts(material_files, text_cache, report=report):
+            # Add to documents with metadata
+            documents.append({
+                'content': content,
+                'source': Path(path).name
+            })
+        print(report.summary())
         
         # Split documents into chunks
         text_splitter = RecursiveCharacterTextSplitter(
@@ -79,9 +83,11 @@ class TeachingMaterialsRAGTool:
                 texts.extend(chunks)
                 metadatas.extend([{'source': doc['source']}] * len(chunks))
             
-            # Create vector store
-            embeddings = OpenAIEmbeddings()
+            # Create vector store with the configured embedding backend (EMBEDDING_BACKEND)
+            embeddings = create_embeddings()
             self.vectorstore = FAISS.from_texts(texts, embeddings, metadatas=metadatas)
+            if isinstance(embeddings, CachedEmbeddings):
+                print(embeddings.stats_summary())
     
     def search_materials(self, query):
         """Search teaching materials for relevant content."""
@@ -125,22 +131,61 @@ class AgentState(TypedDict):
     max_revisions: int
     count: Annotated[int, operator.add]
     retrieved_docs: Optional[List[Dict[str, Any]]]  # Added to store retrieved documents
+    retrieval_filters: Optional[Dict[str, Any]]  # Metadata filters for retrieval, e.g. {"file_type": "pdf"}
+    context_dropped: Optional[List[Dict[str, Any]]]  # Retrieved documents trimmed or left out of the plan prompt
+    context_tokens: Optional[int]  # Tokens of retrieved documents in the plan prompt
+    index_version: Optional[int]  # Reference index snapshot the planner's documents came from
 
 
 class SimplifiedCourseWriter:
-    def __init__(self, materials_dir: str = "teaching_materials"):
+    def __init__(self, materials_dir: str = "teaching_materials", load_workers: Optional[int] = None,
+                 ingest_window: Optional[int] = None,
+                 background_init: bool = True, retrieval_timeout: Optional[float] = None,
+                 read_only_index: Optional[bool] = None, embedding_backend: Optional[str] = None,
+                 context_tokens: Optional[int] = None, watch_materials: Optional[bool] = None):
         """
         Initialize the course writer with RAG capabilities.
         
         Args:
             materials_dir (str): Directory containing teaching materials
+            load_workers (int, optional): Number of processes used to parse materials
+                (defaults to RAG_LOAD_WORKERS or one per CPU)
+            ingest_window (int, optional): Number of files loaded and embedded together
+                while indexing (defaults to RAG_INGEST_WINDOW or 16)
+            background_init (bool): Build the retrieval index on a background thread so the
+                graph (and the UI) are available immediately
+            retrieval_timeout (float, optional): Seconds retrieval waits for the index to be
+                ready before continuing without documents (defaults to RAG_RETRIEVAL_TIMEOUT or 30)
+            read_only_index (bool, optional): Open the persisted index read-only and memory-mapped
+                so several processes share one copy; uploads are not indexed (defaults to RAG_INDEX_READ_ONLY)
+            embedding_backend (str, optional): "openai", "hashing" (CPU-only, offline) or
+                "sentence_transformers" (defaults to EMBEDDING_BACKEND or "openai")
+            context_tokens (int, optional): Token budget for retrieved documents in the plan
+                prompt (defaults to RAG_CONTEXT_TOKENS or 3000)
+            watch_materials (bool, optional): Watch the materials directory and index files copied
+                into it directly, in the background (defaults to RAG_WATCH_MATERIALS, off)
         """
         self.model = ChatOpenAI(model="gpt-4o", temperature=0.8)
         self.materials_dir = materials_dir
+        self.load_workers = load_workers
+        self.ingest_window = ingest_window
+        self.read_only_index = read_only_index
+        self.embedding_backend = embedding_backend
+        # Retrieved documents are fitted into a token budget before they go into the plan prompt
+        self.context_packer = ContextPacker(context_tokens, model=self.model.model_name)
+        self.retrieval_timeout = (retrieval_timeout if retrieval_timeout is not None
+                                  else float(os.getenv("RAG_RETRIEVAL_TIMEOUT", "30")))
         self.vector_store = None
+        self.reference_index = None
+        # Files dropped into the materials directory directly (e.g. over SMB) are picked up by a watcher
+        self.watch_materials = watch_default() if watch_materials is None else watch_materials
+        self.materials_watcher = None
+        # Last walk of the materials directory, shared by the index refresh and the GUI's file list;
+        # None once an upload, delete or applied change may have made it stale
+        self._material_files = None
         
         # Initialize the document retrieval system
-        self._initialize_retrieval_system()
+        self._start_retrieval_warm_up(background_init)
         
         # System prompts for each node
         self.PLAN_PROMPT = (
@@ -229,9 +274,12 @@ class SimplifiedCourseWriter:
         builder = StateGraph(AgentState)
         
         # Add nodes
-        builder.add_node("planner", self.plan_node)
-        builder.add_node("course designer", self.writer_node)
-        builder.add_node("reflect", self.reflection_node)
+        # Each node has a sync and an async implementation, so the same graph serves
+        # graph.invoke from the GUI and graph.ainvoke for many threads on one event loop
+        builder.add_node("planner", RunnableLambda(self.plan_node, afunc=self.aplan_node, name="planner"))
+        builder.add_node("course designer",
+                         RunnableLambda(self.writer_node, afunc=self.awriter_node, name="course designer"))
+        builder.add_node("reflect", RunnableLambda(self.reflection_node, afunc=self.areflection_node, name="reflect"))
         
         # Set entry point
         builder.set_entry_point("planner")
@@ -246,8 +294,8 @@ class SimplifiedCourseWriter:
         builder.add_edge("planner", "course designer")
         builder.add_edge("reflect", "course designer")
         
-        # Set up memory
-        memory = SqliteSaver(conn=sqlite3.connect(":memory:", check_same_thread=False))
+        # Set up memory (in-process, supports both the sync and the async graph API)
+        memory = MemorySaver()
         
         # Compile graph
         self.graph = builder.compile(
@@ -255,6 +303,106 @@ class SimplifiedCourseWriter:
             interrupt_after=['planner', 'course designer', 'reflect']
         )
 
+    def _start_retrieval_warm_up(self, background: bool = True):
+        """Build the retrieval system, by default on a background thread."""
+        # Readiness state: "building", "ready", "empty" (no documents) or "failed"
+        self.retrieval_status = "building"
+        self.retrieval_error = None
+        self._retrieval_ready = threading.Event()
+        
+        if background:
+            self._retrieval_thread = threading.Thread(
+                target=self._warm_up_retrieval, name="retrieval-warm-up", daemon=True)
+            self._retrieval_thread.start()
+        else:
+            self._warm_up_retrieval()
+
+    def _warm_up_retrieval(self):
+        try:
+            self._initialize_retrieval_system()
+            self.retrieval_status = "ready" if self._index_has_documents() else "empty"
+        except Exception as e:
+            self.retrieval_error = str(e)
+            self.retrieval_status = "failed"
+            print(f"Error initializing retrieval system: {e}")
+        finally:
+            self._retrieval_ready.set()
+        if self.watch_materials:
+            self._start_materials_watcher()
+
+    def _start_materials_watcher(self):
+        """Keep the index in sync with files added, changed or deleted outside the app."""
+        if self.reference_index is not None and self.reference_index.read_only:
+            print("Read-only index: the materials directory is not watched")
+            return
+        if not os.path.isdir(self.materials_dir):
+            return
+        self.materials_watcher = MaterialsWatcher(self.materials_dir, self.apply_material_changes,
+                                                  self._changed_material_paths)
+        self.materials_watcher.start()
+
+    def apply_material_changes(self, paths: List[str]) -> Dict[str, int]:
+        """
+        Apply a batch of added, modified and deleted files to the live index at once;
+        searches see the whole batch or none of it.
+        
+        Args:
+            paths: Paths inside the materials directory
+            
+        Returns:
+            Counts of indexed, removed, unchanged and failed files (empty if the index was built instead)
+        """
+        self.wait_for_retrieval()
+        self._material_files = None
+        
+        if self.reference_index is None:
+            # Nothing was indexed at start-up (the directory was missing): build the index now
+            self._initialize_retrieval_system()
+            self.retrieval_status = "ready" if self._index_has_documents() else "empty"
+            return {}
+        
+        result = self.reference_index.apply_changes(paths)
+        
+        # The first files added to an empty index make it searchable
+        if self.retrieval_status == "empty" and self._index_has_documents():
+            self.retrieval_status = "ready"
+        return result
+
+    def _changed_material_paths(self) -> List[str]:
+        """Paths that differ from the index; every material if there is no index yet."""
+        files = self._discover_material_files()
+        if self.reference_index is None:
+            return [material.path for material in files if material.extension in LOADERS]
+        return self.reference_index.changed_paths(files)
+
+    def _discover_material_files(self) -> List[MaterialFile]:
+        """Walk the materials directory once and keep the result for material_files()."""
+        self._material_files = discover_materials(self.materials_dir)
+        return self._material_files
+
+    def material_files(self, refresh: bool = False) -> List[MaterialFile]:
+        """
+        Every file in the materials directory, e.g. for the GUI's file list.
+        
+        The last walk (at start-up or by the watcher's latest scan) is reused while the
+        watcher keeps it current and no upload or delete has made it stale.
+        
+        Args:
+            refresh: Walk the directory again, e.g. after files were copied into it
+        """
+        files = self._material_files
+        if refresh or files is None or self.materials_watcher is None:
+            files = self._discover_material_files()
+        return files
+
+    def is_retrieval_ready(self) -> bool:
+        """True once the retrieval system has finished building (successfully or not)."""
+        return self._retrieval_ready.is_set()
+
+    def wait_for_retrieval(self, timeout: Optional[float] = None) -> bool:
+        """Block until the retrieval system is built. Returns False on timeout."""
+        return self._retrieval_ready.wait(timeout)
+
     def _initialize_retrieval_system(self):
         """Initialize the document retrieval system with teaching materials."""
         # Create the materials directory if it doesn't exist
@@ -264,114 +412,215 @@ class SimplifiedCourseWriter:
             print(f"Please add your teaching materials (PDFs, DOCXs, PPTs, HTMLs) to this directory")
             return
 
-        # Get all documents from the materials directory
-        documents = []
-        
-        # Load different file types
-        pdf_files = glob.glob(os.path.join(self.materials_dir, "**/*.pdf"), recursive=True)
-        docx_files = glob.glob(os.path.join(self.materials_dir, "**/*.docx"), recursive=True)
-        pptx_files = glob.glob(os.path.join(self.materials_dir, "**/*.pptx"), recursive=True)
-        html_files = glob.glob(os.path.join(self.materials_dir, "**/*.html"), recursive=True)
-        txt_files = glob.glob(os.path.join(self.materials_dir, "**/*.txt"), recursive=True)
-        
-        print(f"Found {len(pdf_files)} PDFs, {len(docx_files)} DOCXs, {len(pptx_files)} PPTs, {len(html_files)} HTMLs, {len(txt_files)} TXTs")
-        
-        # Process each file type
-        for pdf in pdf_files:
-            try:
-                loader = PyPDFLoader(pdf)
-                documents.extend(loader.load())
-            except Exception as e:
-                print(f"Error loading PDF {pdf}: {e}")
-        
-        for docx in docx_files:
-            try:
-                loader = Docx2txtLoader(docx)
-                documents.extend(loader.load())
-            except Exception as e:
-                print(f"Error loading DOCX {docx}: {e}")
-        
-        for pptx in pptx_files:
-            try:
-                loader = UnstructuredPowerPointLoader(pptx)
-                documents.extend(loader.load())
-            except Exception as e:
-                print(f"Error loading PPTX {pptx}: {e}")
-        
-        for html in html_files:
-            try:
-                loader = UnstructuredHTMLLoader(html)
-                documents.extend(loader.load())
-            except Exception as e:
-                print(f"Error loading HTML {html}: {e}")
-                
-        for txt in txt_files:
-            try:
-                loader = TextLoader(txt)
-                documents.extend(loader.load())
-            except Exception as e:
-                print(f"Error loading TXT {txt}: {e}")
-        
-        if not documents:
-            print("No documents found in the materials directory. Vector store not initialized.")
-            return
+        # Set up vector store; cached chunks are reused and the rest are embedded in concurrent batches
+        embeddings = create_embeddings(self.embedding_backend)
         
         # Set up text splitter for chunking
         parent_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200)
         child_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
         
-        # Set up vector store
-        embeddings = OpenAIEmbeddings()
-        
-        # Set up parent document retriever with in-memory store
-        parent_store = InMemoryStore()
-        self.retriever = ParentDocumentRetriever(
-            vectorstore=FAISS.from_documents(documents, embeddings),
-            docstore=parent_store,
+        # Two-level index: child chunks are embedded, parent chunks live in a disk-backed docstore.
+        # Files are streamed through it a window at a time and only changed files are re-embedded.
+        self.reference_index = ReferenceIndex(
+            self.materials_dir,
+            embeddings,
+            load_workers=self.load_workers,
+            ingest_window=self.ingest_window,
             parent_splitter=parent_splitter,
-            child_splitter=child_splitter
+            child_splitter=child_splitter,
+            read_only=self.read_only_index
         )
+        vectorstore = self.reference_index.load_or_build(self._discover_material_files())
+        if isinstance(embeddings, CachedEmbeddings):
+            print(embeddings.stats_summary())
+        
+        if vectorstore is None:
+            print("No documents found in the materials directory. Vector store not initialized.")
+            return
         
-        print(f"Successfully initialized retrieval system with {len(documents)} documents")
+        print(f"Successfully initialized retrieval system with {self.reference_index.parent_count()} parent chunks "
+              f"and {self.reference_index.document_count()} child vectors")
 
-    def retrieve_relevant_documents(self, task: str, k: int = 3) -> List[Dict[str, Any]]:
+    def _index_has_documents(self) -> bool:
+        """True once the shared reference index has published documents to search."""
+        return self.reference_index is not None and self.reference_index.snapshot().vectorstore is not None
+
+    def retrieve_relevant_documents(self, task: str, k: int = 3,
+                                    filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
         """
         Retrieve relevant documents based on the task.
         
         Args:
             task: The course topic to search for
             k: Number of documents to retrieve
+            filters: Only search files matching these metadata filters
+                (file_type, source, folder, uploaded_after, uploaded_before)
+            
+        Returns:
+            List of retrieved documents
+        """
+        # Degrade gracefully while the index is still being built
+        if not self.wait_for_retrieval(self.retrieval_timeout):
+            print(f"Retrieval system still {self.retrieval_status} after {self.retrieval_timeout}s. "
+                  "Continuing without retrieved documents.")
+            return []
+        
+        if not self._index_has_documents():
+            print("Reference index is empty. No documents will be retrieved.")
+            return []
+        
+        try:
+            # Match child chunks and return the k parent chunks they belong to
+            docs = self.reference_index.search(task, k=k, filters=filters)
+            return self._format_documents(docs)
+        except Exception as e:
+            print(f"Error retrieving documents: {e}")
+            return []
+
+    def retrieve_many(self, queries: List[str], k: int = 3, dedup: bool = False,
+                      filters: Optional[Dict[str, Any]] = None) -> List[List[Dict[str, Any]]]:
+        """
+        Retrieve documents for several queries (e.g. one per section or focus area) at once.
+        
+        The queries are embedded in one batch and the index is searched once for all of them.
+        
+        Args:
+            queries: Texts to search for
+            k: Number of documents to retrieve per query
+            dedup: Return each document only for the first query that finds it
+            filters: Only search files matching these metadata filters
+            
+        Returns:
+            One list of retrieved documents per query
+        """
+        if not queries:
+            return []
+        
+        if not self.wait_for_retrieval(self.retrieval_timeout):
+            print(f"Retrieval system still {self.retrieval_status} after {self.retrieval_timeout}s. "
+                  "Continuing without retrieved documents.")
+            return [[] for _ in queries]
+        
+        if not self._index_has_documents():
+            print("Reference index is empty. No documents will be retrieved.")
+            return [[] for _ in queries]
+        
+        try:
+            results = self.reference_index.search_many(queries, k=k, dedup=dedup, filters=filters)
+            return [self._format_documents(docs) for docs in results]
+        except Exception as e:
+            print(f"Error retrieving documents: {e}")
+            return [[] for _ in queries]
+
+    async def _await_retrieval(self) -> bool:
+        """Async wait_for_retrieval; the event loop keeps running while the index builds."""
+        if self.is_retrieval_ready():
+            return True
+        if await asyncio.to_thread(self.wait_for_retrieval, self.retrieval_timeout):
+            return True
+        print(f"Retrieval system still {self.retrieval_status} after {self.retrieval_timeout}s. "
+              "Continuing without retrieved documents.")
+        return False
+
+    async def aretrieve_relevant_documents(self, task: str, k: int = 3,
+                                           filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """
+        Async retrieve_relevant_documents: query embedding is awaited and the index
+        search runs in a worker thread.
+        
+        Args:
+            task: The course topic to search for
+            k: Number of documents to retrieve
+            filters: Only search files matching these metadata filters
+                (file_type, source, folder, uploaded_after, uploaded_before)
             
         Returns:
             List of retrieved documents
         """
-        if not self.retriever:
-            print("Retriever not initialized. No documents will be retrieved.")
+        if not await self._await_retrieval():
+            return []
+        
+        if not self._index_has_documents():
+            print("Reference index is empty. No documents will be retrieved.")
             return []
         
         try:
-            # Retrieve relevant documents
-            docs = self.retriever.get_relevant_documents(task, k=k)
-            
-            # Format the documents as a list of dictionaries
-            formatted_docs = []
-            for doc in docs:
-                source = doc.metadata.get("source", "Unknown source")
-                formatted_docs.append({
-                    "content": doc.page_content,
-                    "source": Path(source).name if isinstance(source, str) else "Unknown",
-                    "metadata": doc.metadata
-                })
-            
-            return formatted_docs
+            docs = await self.reference_index.asearch(task, k=k, filters=filters)
+            return self._format_documents(docs)
         except Exception as e:
             print(f"Error retrieving documents: {e}")
             return []
 
+    async def aretrieve_many(self, queries: List[str], k: int = 3, dedup: bool = False,
+                             filters: Optional[Dict[str, Any]] = None) -> List[List[Dict[str, Any]]]:
+        """
+        Async retrieve_many.
+        
+        Args:
+            queries: Texts to search for
+            k: Number of documents to retrieve per query
+            dedup: Return each document only for the first query that finds it
+            filters: Only search files matching these metadata filters
+            
+        Returns:
+            One list of retrieved documents per query
+        """
+        if not queries:
+            return []
+        
+        if not await self._await_retrieval():
+            return [[] for _ in queries]
+        
+        if not self._index_has_documents():
+            print("Reference index is empty. No documents will be retrieved.")
+            return [[] for _ in queries]
+        
+        try:
+            results = await self.reference_index.asearch_many(queries, k=k, dedup=dedup, filters=filters)
+            return [self._format_documents(docs) for docs in results]
+        except Exception as e:
+            print(f"Error retrieving documents: {e}")
+            return [[] for _ in queries]
+
+    def _format_documents(self, docs) -> SearchResults:
+        """Format retrieved documents as a list of dictionaries, keeping the searched index version."""
+        formatted_docs = []
+        for doc in docs:
+            source = doc.metadata.get("source", "Unknown source")
+            formatted_docs.append({
+                "content": doc.page_content,
+                "source": Path(source).name if isinstance(source, str) else "Unknown",
+                "metadata": doc.metadata
+            })
+        return SearchResults(formatted_docs, getattr(docs, "index_version", None))
+
     def plan_node(self, state: AgentState):
         # Retrieve relevant documents for the task
+        retrieved_docs = self.retrieve_relevant_documents(state.get('task', ""),
+                                                          filters=state.get('retrieval_filters'))
+        context = self._pack_context(retrieved_docs)
+        response = self.model.invoke(self._plan_messages(state, context.documents))
+        return self._plan_update(state, context, response.content, retrieved_docs)
+
+    async def aplan_node(self, state: AgentState):
+        """Async plan_node: retrieval and the model call run without blocking the event loop."""
+        retrieved_docs = await self.aretrieve_relevant_documents(state.get('task', ""),
+                                                                 filters=state.get('retrieval_filters'))
+        context = self._pack_context(retrieved_docs)
+        response = await self.model.ainvoke(self._plan_messages(state, context.documents))
+        return self._plan_update(state, context, response.content, retrieved_docs)
+
+    def _pack_context(self, retrieved_docs: List[Dict[str, Any]]) -> PackedContext:
+        context = self.context_packer.pack(retrieved_docs)
+        if context.dropped:
+            trimmed = sum(1 for item in context.dropped if item["reason"] == "trimmed")
+            print(f"Context packing: {len(context.documents)} of {len(retrieved_docs)} documents in "
+                  f"{context.tokens}/{context.budget} tokens ({trimmed} trimmed, "
+                  f"{len(context.dropped) - trimmed} dropped)")
+        return context
+
+    def _plan_messages(self, state: AgentState, retrieved_docs: List[Dict[str, Any]]):
         task = state.get('task', "")
-        retrieved_docs = self.retrieve_relevant_documents(task)
         
         # Construct a context message from the retrieved documents
         context = ""
@@ -384,16 +633,16 @@ class SimplifiedCourseWriter:
         # Combine the task and context for the planner
         prompt = f"{task}\n\n{context}" if context else task
         
-        messages = [
+        return [
             SystemMessage(content=self.PLAN_PROMPT), 
             HumanMessage(content=prompt)
         ]
-        
-        response = self.model.invoke(messages)
-        
+
+    def _plan_update(self, state: AgentState, context: PackedContext, plan: str,
+                     retrieved_docs: List[Dict[str, Any]]):
         # Return a complete state with all required keys and default values
         return {
-            "plan": response.content,
+            "plan": plan,
             "lnode": "planner",
             "draft": state.get('draft', "no draft yet"),
             "critique": state.get('critique', "no critique yet"),
@@ -401,94 +650,100 @@ class SimplifiedCourseWriter:
             "max_revisions": state.get('max_revisions', 2),
             "count": 1,
             "task": state.get('task', ""),
-            "retrieved_docs": retrieved_docs  # Store the retrieved documents in the state
+            "retrieved_docs": context.documents,  # Store the documents the planner saw in the state
+            "context_dropped": context.dropped,
+            "context_tokens": context.tokens,
+            # The snapshot that was searched, even if it returned nothing; None if no index was searched
+            "index_version": getattr(retrieved_docs, "index_version", None)
         }
     
     def writer_node(self, state: AgentState):
         try:
-            # Safely access state with defaults
-            task = state.get('task', "")
-            plan = state.get('plan', "No plan available")
-            
-            user_message = HumanMessage(
-                content=f"{task}\n\nHere is my plan:\n\n{plan}")
-            
-            messages = [
-                SystemMessage(content=self.WRITER_PROMPT),
-                user_message
-            ]
-            
-            # If there's critique, add it to the context
-            if state.get('critique'):
-                messages.append(HumanMessage(content=f"Here is feedback on my previous draft:\n\n{state['critique']}"))
-            
-            response = self.model.invoke(messages)
-            
-            # Return complete state with all required keys
-            return {
-                "draft": response.content,
-                "plan": state.get('plan', ""),
-                "critique": state.get('critique', "no critique yet"),
-                "task": state.get('task', ""),
-                "revision_number": state.get("revision_number", 0) + 1,
-                "max_revisions": state.get("max_revisions", 2),
-                "lnode": "course designer",
-                "count": state.get("count", 0) + 1,
-                "retrieved_docs": state.get("retrieved_docs", [])  # Preserve retrieved docs
-            }
+            response = self.model.invoke(self._writer_messages(state))
+            return self._writer_update(state, response.content)
         except Exception as e:
             print(f"Error in writer_node: {e}")
-            # Return a minimal valid state in case of error
-            return {
-                "draft": "Error occurred during content generation.",
-                "plan": state.get('plan', ""),
-                "critique": state.get('critique', ""),
-                "task": state.get('task', ""),
-                "revision_number": state.get("revision_number", 0) + 1,
-                "max_revisions": state.get("max_revisions", 2),
-                "lnode": "course designer",
-                "count": state.get("count", 0) + 1,
-                "retrieved_docs": state.get("retrieved_docs", [])  # Preserve retrieved docs
-            }
+            return self._writer_update(state, "Error occurred during content generation.", failed=True)
+
+    async def awriter_node(self, state: AgentState):
+        """Async writer_node."""
+        try:
+            response = await self.model.ainvoke(self._writer_messages(state))
+            return self._writer_update(state, response.content)
+        except Exception as e:
+            print(f"Error in awriter_node: {e}")
+            return self._writer_update(state, "Error occurred during content generation.", failed=True)
+
+    def _writer_messages(self, state: AgentState):
+        # Safely access state with defaults
+        task = state.get('task', "")
+        plan = state.get('plan', "No plan available")
+        
+        user_message = HumanMessage(
+            content=f"{task}\n\nHere is my plan:\n\n{plan}")
+        
+        messages = [
+            SystemMessage(content=self.WRITER_PROMPT),
+            user_message
+        ]
+        
+        # If there's critique, add it to the context
+        if state.get('critique'):
+            messages.append(HumanMessage(content=f"Here is feedback on my previous draft:\n\n{state['critique']}"))
+        return messages
+
+    def _writer_update(self, state: AgentState, draft: str, failed: bool = False):
+        # Return complete state with all required keys; a failed draft still counts as a revision
+        return {
+            "draft": draft,
+            "plan": state.get('plan', ""),
+            "critique": state.get('critique', "" if failed else "no critique yet"),
+            "task": state.get('task', ""),
+            "revision_number": state.get("revision_number", 0) + 1,
+            "max_revisions": state.get("max_revisions", 2),
+            "lnode": "course designer",
+            "count": state.get("count", 0) + 1,
+            "retrieved_docs": state.get("retrieved_docs", [])  # Preserve retrieved docs
+        }
     
     def reflection_node(self, state: AgentState):
         try:
-            # Safely access state with default
-            draft = state.get('draft', "No content available")
-            
-            messages = [
-                SystemMessage(content=self.REFLECTION_PROMPT), 
-                HumanMessage(content=draft)
-            ]
-            
-            response = self.model.invoke(messages)
-            
-            # Return complete state with all required keys
-            return {
-                "critique": response.content,
-                "draft": state.get('draft', ""),
-                "plan": state.get('plan', ""),
-                "task": state.get('task', ""),
-                "revision_number": state.get("revision_number", 0),
-                "max_revisions": state.get("max_revisions", 2),
-                "lnode": "reflect",
-                "count": state.get("count", 0) + 1,
-                "retrieved_docs": state.get("retrieved_docs", [])  # Preserve retrieved docs
-            }
+            response = self.model.invoke(self._reflection_messages(state))
+            return self._reflection_update(state, response.content)
         except Exception as e:
             print(f"Error in reflection_node: {e}")
-            # Return a minimal valid state in case of error
-            return {
-                "critique": "Error occurred during reflection.",
-                "draft": state.get('draft', ""),
-                "plan": state.get('plan', ""),
-                "task": state.get('task', ""),
-                "revision_number": state.get("revision_number", 0),
-                "max_revisions": state.get("max_revisions", 2),
-                "lnode": "reflect",
-                "count": state.get("count", 0) + 1,
-                "retrieved_docs": state.get("retrieved_docs", [])  # Preserve retrieved docs
-            }
+            return self._reflection_update(state, "Error occurred during reflection.")
+
+    async def areflection_node(self, state: AgentState):
+        """Async reflection_node."""
+        try:
+            response = await self.model.ainvoke(self._reflection_messages(state))
+            return self._reflection_update(state, response.content)
+        except Exception as e:
+            print(f"Error in areflection_node: {e}")
+            return self._reflection_update(state, "Error occurred during reflection.")
+
+    def _reflection_messages(self, state: AgentState):
+        # Safely access state with default
+        draft = state.get('draft', "No content available")
+        return [
+            SystemMessage(content=self.REFLECTION_PROMPT), 
+            HumanMessage(content=draft)
+        ]
+
+    def _reflection_update(self, state: AgentState, critique: str):
+        # Return complete state with all required keys
+        return {
+            "critique": critique,
+            "draft": state.get('draft', ""),
+            "plan": state.get('plan', ""),
+            "task": state.get('task', ""),
+            "revision_number": state.get("revision_number", 0),
+            "max_revisions": state.get("max_revisions", 2),
+            "lnode": "reflect",
+            "count": state.get("count", 0) + 1,
+            "retrieved_docs": state.get("retrieved_docs", [])  # Preserve retrieved docs
+        }
     
     def should_continue(self, state):
         try:
@@ -813,5 +1068,5 @@ if __name__ == "__main__":
     essay_writer = SimplifiedCourseWriter(materials_dir="teaching_materials")
     # Import here to avoid circular import
     from simplified_gui_rag import EnhancedCSGUI
-    app = EnhancedCSGUI(essay_writer.graph)
+    app = EnhancedCSGUI(essay_writer.graph, designer=essay_writer)
     app.launch()
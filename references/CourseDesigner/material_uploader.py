@@ -1,8 +1,13 @@
 import gradio as gr
 import os
+import sys
 import shutil
 from pathlib import Path
 
+# The RAG modules shared by CaseStrategy and CourseDesigner live in references/rag_shared
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rag_shared.material_loader import discover_materials
+
 class MaterialUploadManager:
     def __init__(self, materials_dir="./teaching_materials"):
         self.materials_dir = Path(materials_dir)
@@ -29,12 +34,8 @@ class MaterialUploadManager:
     
     def list_files(self):
         """List all files in the materials directory"""
-        files = []
-        for file_path in self.materials_dir.glob("**/*"):
-            if file_path.is_file():
-                # Get the relative path to the materials directory
-                rel_path = file_path.relative_to(self.materials_dir)
-                files.append(str(rel_path))
+        # One scandir pass over the tree, paths relative to the materials directory
+        files = [material.rel_path for material in discover_materials(str(self.materials_dir))]
         
         if not files:
             return "No files in the materials directory."
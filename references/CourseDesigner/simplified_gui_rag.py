@@ -2,6 +2,7 @@ import warnings
 warnings.filterwarnings("ignore", message=".*TqdmWarning.*")
 import shutil
 import os
+import sys
 import json
 from pathlib import Path
 import gradio as gr
@@ -10,9 +11,17 @@ import traceback
 import pandas as pd  # Add this for Excel export
 import csv  # Add this for CSV export
 
+# The RAG modules shared by CaseStrategy and CourseDesigner live in references/rag_shared
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rag_shared.material_loader import discover_materials
+
 class EnhancedCSGUI:
-    def __init__(self, graph, share=False, materials_dir="teaching_materials",params_dir="course_parameters"):
+    def __init__(self, graph, share=False, materials_dir="teaching_materials",params_dir="course_parameters", designer=None):
         self.graph = graph
+        # Optional SimplifiedCourseWriter whose latest walk of the materials directory the file list reuses
+        self.designer = designer
+        # Set by uploads and deletes, which the designer does not see, until the list walks the directory again
+        self._materials_changed = False
         self.share = share
         self.partial_message = ""
         self.response = {}
@@ -66,6 +75,7 @@ class EnhancedCSGUI:
                 shutil.copy2(file.name, dest_path)
                 
                 result.append(f"Successfully uploaded: {file.name}")
+                self._materials_changed = True
             except Exception as e:
                 result.append(f"Error uploading {file.name}: {e}")
         
@@ -73,12 +83,14 @@ class EnhancedCSGUI:
     
     def list_files(self):
         """List all files in the materials directory"""
-        files = []
-        for file_path in self.materials_dir.glob("**/*"):
-            if file_path.is_file():
-                # Get the relative path to the materials directory
-                rel_path = file_path.relative_to(self.materials_dir)
-                files.append(str(rel_path))
+        # Reuse the designer's latest walk of the tree, or make one scandir pass;
+        # paths relative to the materials directory
+        if self.designer is not None and Path(self.designer.materials_dir).resolve() == self.materials_dir.resolve():
+            materials = self.designer.material_files(refresh=self._materials_changed)
+            self._materials_changed = False
+        else:
+            materials = discover_materials(str(self.materials_dir))
+        files = [material.rel_path for material in materials]
         
         if not files:
             return "No files in the materials directory."
@@ -95,6 +107,7 @@ class EnhancedCSGUI:
             
             # Delete the file
             file_path.unlink()
+            self._materials_changed = True
             
             return f"Successfully deleted: {file_name}"
         except Exception as e:
@@ -1271,5 +1284,5 @@ if __name__ == "__main__":
     essay_writer = SimplifiedCourseWriter(materials_dir="teaching_materials")
     
     # Initialize and launch the enhanced GUI with material upload functionality
-    app = EnhancedCSGUI(essay_writer.graph, materials_dir="teaching_materials")
+    app = EnhancedCSGUI(essay_writer.graph, materials_dir="teaching_materials", designer=essay_writer)
     app.launch()
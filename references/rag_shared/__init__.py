@@ -0,0 +1,6 @@
+"""
+Retrieval modules shared by the CaseStrategy and CourseDesigner applications.
+
+The applications add references/ to sys.path and import the modules from here,
+e.g. ``from rag_shared.embedding_cache import CachedEmbeddings``.
+"""
@@ -0,0 +1,209 @@
+"""
+Duplicate and near-duplicate detection for parent chunks at ingest time.
+
+Materials folders tend to hold several versions of the same deck or handout.
+Embedding every copy costs money, bloats the index and lets copies of one
+passage take several of the k result slots. Before a parent chunk is stored,
+DuplicateDetector checks it against every chunk already in the index:
+
+- exact duplicates: same text after lower-casing and collapsing whitespace
+  (sha1 of the normalised text)
+- near duplicates: MinHash signatures over word 5-gram shingles, with LSH
+  banding to find candidates; a candidate counts as a duplicate when the
+  estimated Jaccard similarity reaches RAG_DEDUP_THRESHOLD (default 0.85)
+
+A duplicate is not stored or embedded again. ReferenceIndex records it in the
+manifest as a reference to the canonical chunk, so every file still has
+provenance and the canonical chunk survives until the last file containing
+it is removed.
+"""
+
+import os
+import re
+import zlib
+import hashlib
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+DEFAULT_THRESHOLD = float(os.getenv("RAG_DEDUP_THRESHOLD", "0.85"))
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 5
+# Smallest prime above 2^32; a * x + b stays below 2^64 for a < 2^31, x < 2^32
+PRIME = np.uint64(4294967311)
+SIGNATURES_FILE = "dedup.npz"
+
+_WHITESPACE = re.compile(r"\s+")
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(1, 1 << 31, size=NUM_PERM).astype(np.uint64)
+_PERM_B = _rng.randint(0, 1 << 31, size=NUM_PERM).astype(np.uint64)
+
+
+def dedup_default() -> bool:
+    """Whether duplicate parent chunks are skipped at ingest (RAG_DEDUP_CHUNKS, on by default)."""
+    return os.getenv("RAG_DEDUP_CHUNKS", "1").lower() in ("1", "true", "yes")
+
+
+def exact_hash(text: str) -> str:
+    return hashlib.sha1(_WHITESPACE.sub(" ", text.lower()).strip().encode("utf-8")).hexdigest()
+
+
+def minhash_signature(text: str) -> np.ndarray:
+    """NUM_PERM MinHash values over the word shingles of a text."""
+    tokens = _TOKEN.findall(text.lower())
+    if len(tokens) <= SHINGLE_SIZE:
+        shingles = {" ".join(tokens)}
+    else:
+        shingles = {" ".join(tokens[i:i + SHINGLE_SIZE]) for i in range(len(tokens) - SHINGLE_SIZE + 1)}
+    hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles),
+                         dtype=np.uint64, count=len(shingles))
+    return ((_PERM_A[:, None] * hashes[None, :] + _PERM_B[:, None]) % PRIME).min(axis=1)
+
+
+class DuplicateDetector:
+    """Exact-hash and MinHash LSH index over the parent chunks of a reference index."""
+
+    def __init__(self, threshold: Optional[float] = None):
+        """
+        Args:
+            threshold (float, optional): Estimated Jaccard similarity from which a chunk
+                is a near duplicate (defaults to RAG_DEDUP_THRESHOLD or 0.85)
+        """
+        self.threshold = DEFAULT_THRESHOLD if threshold is None else threshold
+        self.reset()
+
+    def reset(self):
+        self._exact = {}  # normalised text hash -> parent id
+        self._hashes = {}  # parent id -> normalised text hash
+        self._signatures = {}  # parent id -> MinHash signature
+        self._buckets = {}  # (band, band values) -> set of parent ids
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    def parent_ids(self) -> Set[str]:
+        return set(self._signatures)
+
+    def memory_bytes(self) -> int:
+        """Approximate memory held by the signatures, hashes and LSH buckets."""
+        # A signature plus roughly 100 bytes per dictionary or bucket entry referring to it
+        return len(self._signatures) * (NUM_PERM * 8 + (BANDS + 3) * 100)
+
+    def _band_keys(self, signature: np.ndarray):
+        return [(band, signature[band * ROWS:(band + 1) * ROWS].tobytes()) for band in range(BANDS)]
+
+    def find(self, text: str) -> Tuple[Optional[str], Optional[str], str, np.ndarray]:
+        """
+        Look a chunk up.
+
+        Returns:
+            (canonical parent id or None, "exact" / "near" / None, text hash, signature);
+            the hash and signature can be passed to add() if the chunk is new
+        """
+        digest = exact_hash(text)
+        if digest in self._exact:
+            return self._exact[digest], "exact", digest, None
+        signature = minhash_signature(text)
+        candidates = set()
+        for key in self._band_keys(signature):
+            candidates |= self._buckets.get(key, set())
+        best, best_similarity = None, self.threshold
+        for parent_id in candidates:
+            similarity = float(np.mean(self._signatures[parent_id] == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = parent_id, similarity
+        return best, ("near" if best else None), digest, signature
+
+    def add(self, parent_id: str, text: str, digest: Optional[str] = None, signature: Optional[np.ndarray] = None):
+        digest = digest or exact_hash(text)
+        signature = minhash_signature(text) if signature is None else signature
+        self._exact.setdefault(digest, parent_id)
+        self._hashes[parent_id] = digest
+        self._signatures[parent_id] = signature
+        for key in self._band_keys(signature):
+            self._buckets.setdefault(key, set()).add(parent_id)
+
+    def remove(self, parent_ids):
+        for parent_id in parent_ids:
+            signature = self._signatures.pop(parent_id, None)
+            if signature is None:
+                continue
+            digest = self._hashes.pop(parent_id)
+            if self._exact.get(digest) == parent_id:
+                del self._exact[digest]
+            for key in self._band_keys(signature):
+                bucket = self._buckets.get(key)
+                if bucket is not None:
+                    bucket.discard(parent_id)
+                    if not bucket:
+                        del self._buckets[key]
+
+    def save(self, path: str, parent_ids: Optional[Iterable[str]] = None):
+        """
+        Write the hashes and signatures to a new .npz file.
+
+        Args:
+            parent_ids: Only write these parents (those without a signature are skipped);
+                defaults to all of them
+        """
+        rows = []
+        for parent_id in (list(self._signatures) if parent_ids is None else parent_ids):
+            # Looked up one at a time: a background merge saves while the writer adds and removes
+            digest, signature = self._hashes.get(parent_id), self._signatures.get(parent_id)
+            if digest is not None and signature is not None:
+                rows.append((parent_id, digest, signature))
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                parent_ids=np.array([row[0] for row in rows], dtype=str),
+                hashes=np.array([row[1] for row in rows], dtype=str),
+                signatures=(np.stack([row[2] for row in rows]) if rows
+                            else np.zeros((0, NUM_PERM), dtype=np.uint64))
+            )
+
+    def load(self, path: str) -> bool:
+        """Add the signatures saved in a .npz file. Returns False if there is none."""
+        if not os.path.exists(path):
+            return False
+        with np.load(path) as data:
+            for parent_id, digest, signature in zip(data["parent_ids"], data["hashes"], data["signatures"]):
+                self.add(str(parent_id), "", str(digest), signature)
+        return True
+
+
+class DedupReport:
+    """Summary of the duplicate chunks skipped during an indexing run."""
+
+    def __init__(self):
+        self.parents = 0
+        self.exact = 0
+        self.near = 0
+        self.files = {}  # rel_path -> {"parents", "duplicates", "canonical_files"}
+
+    def add_file(self, rel_path: str, parents: int, exact: int, near: int, canonical_files: List[str]):
+        self.parents += parents
+        self.exact += exact
+        self.near += near
+        if exact or near:
+            self.files[rel_path] = {
+                "parents": parents,
+                "duplicates": exact + near,
+                "canonical_files": sorted(set(canonical_files))
+            }
+
+    def summary(self) -> str:
+        """Return a human readable summary, listing the files that duplicate others."""
+        duplicates = self.exact + self.near
+        text = (f"Deduplication: {duplicates} of {self.parents} parent chunks were duplicates "
+                f"({self.exact} exact, {self.near} near-duplicate) and were not embedded again")
+        for rel_path, info in sorted(self.files.items()):
+            text += (f"\n  - {rel_path}: {info['duplicates']}/{info['parents']} chunks duplicate "
+                     f"{', '.join(info['canonical_files'])}")
+        return text
+
+    def as_dict(self) -> Dict[str, object]:
+        return {"parents": self.parents, "exact": self.exact, "near": self.near, "files": self.files}
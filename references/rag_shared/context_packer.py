@@ -0,0 +1,123 @@
+"""
+Token-budgeted packing of retrieved documents into a prompt.
+
+Retrieved parent chunks (and whole PDF pages from older indexes) vary a lot
+in size, and pasting all of them in full makes prompt length, latency and
+cost unpredictable. ContextPacker fills a token budget (RAG_CONTEXT_TOKENS)
+with documents in relevance order: a document that fits is kept whole, the
+first one that does not fit is trimmed at a sentence boundary if a useful
+part of it still fits, and the rest are dropped. What was trimmed or dropped
+is reported so that it can be recorded in the graph state.
+"""
+
+import os
+import re
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+DEFAULT_CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "3000"))
+# A document that does not fit is trimmed only if at least this many of its tokens fit
+DEFAULT_MIN_TRIM_TOKENS = int(os.getenv("RAG_CONTEXT_MIN_TRIM_TOKENS", "120"))
+TRIM_MARKER = " [...]"
+
+_SENTENCE_END = re.compile(r"[.!?;:\n]\s")
+
+
+def default_header(number: int, document: Dict[str, Any]) -> str:
+    """The line that introduces a document in the plan prompt."""
+    return f"Document {number} - Source: {document['source']}\n"
+
+
+class PackedContext(NamedTuple):
+    documents: List[Dict[str, Any]]  # kept documents, trimmed ones marked "truncated"
+    dropped: List[Dict[str, Any]]  # {"source", "tokens", "kept_tokens", "reason"} per trimmed or dropped document
+    tokens: int  # tokens used by the kept documents, headers included
+    budget: int
+
+
+class ContextPacker:
+    """Fits retrieved documents into a token budget by relevance."""
+
+    def __init__(self, max_tokens: Optional[int] = None, model: str = "gpt-4o",
+                 min_trim_tokens: Optional[int] = None,
+                 header: Callable[[int, Dict[str, Any]], str] = default_header):
+        """
+        Args:
+            max_tokens (int, optional): Token budget for the documents (defaults to RAG_CONTEXT_TOKENS or 3000)
+            model (str): Chat model whose tokenizer is used for counting
+            min_trim_tokens (int, optional): Smallest useful part of a trimmed document
+                (defaults to RAG_CONTEXT_MIN_TRIM_TOKENS or 120)
+            header: Formats the line placed before each document, counted against the budget
+        """
+        self.max_tokens = max_tokens or DEFAULT_CONTEXT_TOKENS
+        self.min_trim_tokens = DEFAULT_MIN_TRIM_TOKENS if min_trim_tokens is None else min_trim_tokens
+        self.header = header
+
+        self._encoding = None
+        if tiktoken is not None:
+            try:
+                self._encoding = tiktoken.encoding_for_model(model)
+            except Exception:
+                self._encoding = None
+
+    def count_tokens(self, text: str) -> int:
+        """Token count of a text (tiktoken when available, otherwise ~4 characters per token)."""
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return max(1, len(text) // 4)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Cut a text to at most max_tokens, preferably after a sentence, and mark the cut."""
+        max_tokens -= self.count_tokens(TRIM_MARKER)
+        if self._encoding is not None:
+            cut = self._encoding.decode(self._encoding.encode(text, disallowed_special=())[:max_tokens])
+        else:
+            cut = text[:max_tokens * 4]
+        # Back off to the last sentence end, unless that throws away most of the text
+        ends = [match.start() + 1 for match in _SENTENCE_END.finditer(cut)]
+        if ends and ends[-1] >= len(cut) // 2:
+            cut = cut[:ends[-1]]
+        return cut.rstrip() + TRIM_MARKER
+
+    def pack(self, documents: List[Dict[str, Any]]) -> PackedContext:
+        """
+        Keep documents in the given (relevance) order until the budget is spent.
+
+        Args:
+            documents: Retrieved documents with "content" and "source", most relevant first
+
+        Returns:
+            PackedContext with the kept documents and what was trimmed or dropped
+        """
+        kept, dropped = [], []
+        used = 0
+        for document in documents:
+            header_tokens = self.count_tokens(self.header(len(kept) + 1, document))
+            content_tokens = self.count_tokens(document["content"])
+            remaining = self.max_tokens - used - header_tokens
+            if content_tokens <= remaining:
+                kept.append(document)
+                used += header_tokens + content_tokens
+                continue
+
+            if remaining >= self.min_trim_tokens:
+                content = self.truncate(document["content"], remaining)
+                kept_tokens = self.count_tokens(content)
+                kept.append(dict(document, content=content, truncated=True))
+                used += header_tokens + kept_tokens
+                reason = "trimmed"
+            else:
+                # Too little room for a useful part; a smaller, less relevant document may still fit
+                kept_tokens = 0
+                reason = "over budget"
+            dropped.append({
+                "source": document.get("source", "Unknown"),
+                "tokens": content_tokens,
+                "kept_tokens": kept_tokens,
+                "reason": reason
+            })
+        return PackedContext(kept, dropped, used, self.max_tokens)
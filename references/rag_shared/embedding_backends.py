@@ -0,0 +1,112 @@
+"""
+Pluggable embedding backends for the reference and teaching-material indexes.
+
+The backend is chosen with EMBEDDING_BACKEND:
+
+    openai                 OpenAI embeddings (default), batched by the scheduler
+                           and cached on disk
+    hashing                CPU-only feature-hashing vectorizer; no network, no
+                           model download, suitable for air-gapped deployments
+    sentence_transformers  local sentence-transformers model (EMBEDDING_LOCAL_MODEL),
+                           if the sentence-transformers package is installed
+
+Every backend reports a distinct model name, so switching backends makes the
+persisted index rebuild instead of mixing incompatible vectors.
+Use embedding_benchmark.py to compare build time, query latency and retrieval
+quality of the backends on your own materials.
+"""
+
+import os
+import re
+import math
+import zlib
+from typing import List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+from .embedding_cache import CachedEmbeddings
+from .embedding_scheduler import ScheduledEmbeddings
+
+EMBEDDING_BACKENDS = ("openai", "hashing", "sentence_transformers")
+
+DEFAULT_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai").lower()
+DEFAULT_HASHING_DIMENSION = int(os.getenv("EMBEDDING_HASHING_DIMENSION", "1024"))
+DEFAULT_LOCAL_MODEL = os.getenv("EMBEDDING_LOCAL_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Stateless bag-of-words embeddings using the hashing trick.
+
+    Lower-cased word unigrams and bigrams are hashed (crc32, stable across
+    processes) into a fixed number of signed buckets, term counts are damped
+    with log(1 + tf) and the vector is L2-normalised. Nothing is fitted, so
+    new files can be added to an index without re-embedding the old ones.
+    """
+
+    def __init__(self, dimension: Optional[int] = None):
+        self.dimension = dimension or DEFAULT_HASHING_DIMENSION
+        self.model = f"hashing-{self.dimension}"
+
+    def _features(self, text: str) -> List[str]:
+        words = TOKEN_PATTERN.findall(text.lower())
+        return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+    def _embed(self, text: str) -> List[float]:
+        counts = {}
+        for feature in self._features(text):
+            digest = zlib.crc32(feature.encode("utf-8"))
+            bucket = digest % self.dimension
+            # The top bit picks the sign so colliding features tend to cancel out
+            counts[bucket] = counts.get(bucket, 0) + (1 if digest & 0x80000000 else -1)
+
+        vector = [0.0] * self.dimension
+        for bucket, count in counts.items():
+            vector[bucket] = math.copysign(math.log1p(abs(count)), count)
+        norm = math.sqrt(sum(value * value for value in vector))
+        if norm:
+            vector = [value / norm for value in vector]
+        return vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+def create_embeddings(backend: Optional[str] = None, cache_path: Optional[str] = None) -> Embeddings:
+    """
+    Create the embeddings object for a backend.
+
+    Args:
+        backend (str, optional): One of EMBEDDING_BACKENDS (defaults to EMBEDDING_BACKEND or "openai")
+        cache_path (str, optional): Embedding cache file for the backends that use it
+
+    Returns:
+        Embeddings object; remote and model-based backends sit behind the on-disk
+        CachedEmbeddings, the hashing backend is cheaper to recompute than to look up
+    """
+    backend = (backend or DEFAULT_BACKEND).lower()
+
+    if backend == "openai":
+        from langchain_openai import OpenAIEmbeddings
+        # Retries are handled by the scheduler, which adds jitter across concurrent batches
+        return CachedEmbeddings(ScheduledEmbeddings(OpenAIEmbeddings(max_retries=0)), cache_path)
+
+    if backend == "hashing":
+        return HashingEmbeddings()
+
+    if backend == "sentence_transformers":
+        try:
+            from langchain_community.embeddings import HuggingFaceEmbeddings
+            embeddings = HuggingFaceEmbeddings(model_name=DEFAULT_LOCAL_MODEL)
+        except ImportError as e:
+            raise ImportError(
+                "The sentence_transformers embedding backend needs the sentence-transformers package"
+            ) from e
+        return CachedEmbeddings(embeddings, cache_path)
+
+    raise ValueError(f"Unknown embedding backend {backend!r}; expected one of {', '.join(EMBEDDING_BACKENDS)}")
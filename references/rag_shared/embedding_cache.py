@@ -0,0 +1,126 @@
+"""
+Content-addressed embedding cache shared by CaseStrategy and CourseDesigner.
+
+Vectors are stored in a local SQLite file keyed by sha256(model name + chunk
+text), so identical chunks are embedded once no matter which application or
+which run asks for them.
+"""
+
+import os
+import sqlite3
+import hashlib
+import threading
+from array import array
+from typing import List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+# references/.embedding_cache, next to both applications, so they share one cache file
+DEFAULT_CACHE_PATH = os.getenv(
+    "EMBEDDING_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".embedding_cache", "embeddings.sqlite")
+)
+
+
+def embedding_model_name(embeddings) -> str:
+    """Best-effort name of the model behind an embeddings object."""
+    return str(getattr(embeddings, "model", None) or getattr(embeddings, "model_name", None)
+               or type(embeddings).__name__)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that looks chunks up in a SQLite cache before calling
+    the underlying embeddings object.
+    """
+
+    def __init__(self, embeddings, cache_path: Optional[str] = None):
+        """
+        Initialize the cache.
+
+        Args:
+            embeddings: The embeddings object to put the cache in front of
+            cache_path (str, optional): SQLite file. Defaults to EMBEDDING_CACHE_PATH
+                or references/.embedding_cache/embeddings.sqlite
+        """
+        self.embeddings = embeddings
+        self.model = embedding_model_name(embeddings)
+        self.cache_path = cache_path or DEFAULT_CACHE_PATH
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.cache_path, check_same_thread=False, timeout=30)
+        # WAL lets both applications read and write the cache at the same time
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._conn.commit()
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\0{text}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, keys: List[str]) -> dict:
+        found = {}
+        with self._lock:
+            # Stay well below SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+        return found
+
+    def _store(self, items: List[tuple]):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, array("f", vector).tobytes()) for key, vector in items]
+            )
+            self._conn.commit()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed documents, only sending cache misses to the underlying model."""
+        keys = [self._key(text) for text in texts]
+        cached = self._lookup(list(set(keys)))
+
+        # Embed each distinct missing text once, even if it appears several times
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_items = list(zip(missing.keys(), vectors))
+            self._store(new_items)
+            cached.update(new_items)
+
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        """Queries are not cached here; they go straight to the underlying model."""
+        return self.embeddings.embed_query(text)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self.embeddings.aembed_query(text)
+
+    def stats(self) -> dict:
+        """Hit/miss counters for this process."""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+    def stats_summary(self) -> str:
+        stats = self.stats()
+        return (f"Embedding cache: {stats['hits']} hits, {stats['misses']} misses "
+                f"({stats['hit_rate']:.0%} hit rate)")
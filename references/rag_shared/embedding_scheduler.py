@@ -0,0 +1,173 @@
+"""
+Batched, concurrent embedding scheduler with rate-limit awareness.
+
+Texts are packed into token-bounded batches, several batches are sent to the
+embedding provider at once, and a token bucket keeps the request stream under
+the provider's tokens-per-minute limit. Rate-limited (429) and transient
+server errors are retried with exponential backoff and full jitter.
+"""
+
+import os
+import time
+import asyncio
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+DEFAULT_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", "20000"))
+DEFAULT_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "512"))
+DEFAULT_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+DEFAULT_TOKENS_PER_MINUTE = int(os.getenv("EMBEDDING_TOKENS_PER_MINUTE", "1000000"))
+DEFAULT_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "6"))
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at tokens_per_minute / 60 per second."""
+
+    def __init__(self, tokens_per_minute: int):
+        self.capacity = float(tokens_per_minute)
+        self.rate = tokens_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int):
+        """Block until `tokens` tokens are available, then take them."""
+        tokens = min(float(tokens), self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """True for rate-limit (429), server (5xx) and connection/timeout errors."""
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    name = type(error).__name__
+    return "RateLimit" in name or "Timeout" in name or "Connection" in name
+
+
+class ScheduledEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that controls batch size, concurrency and backoff
+    instead of relying on whatever batching the vector store does internally.
+    """
+
+    def __init__(self, embeddings, max_batch_tokens: Optional[int] = None, max_batch_size: Optional[int] = None,
+                 max_concurrency: Optional[int] = None, tokens_per_minute: Optional[int] = None,
+                 max_retries: Optional[int] = None):
+        """
+        Initialize the scheduler.
+
+        Args:
+            embeddings: The embeddings object that talks to the provider
+            max_batch_tokens (int, optional): Token budget of one request
+            max_batch_size (int, optional): Maximum number of texts in one request
+            max_concurrency (int, optional): Number of requests in flight
+            tokens_per_minute (int, optional): Provider token rate limit
+            max_retries (int, optional): Retries per batch on retryable errors
+        """
+        self.embeddings = embeddings
+        self.model = str(getattr(embeddings, "model", None) or type(embeddings).__name__)
+        self.max_batch_tokens = max_batch_tokens or DEFAULT_BATCH_TOKENS
+        self.max_batch_size = max_batch_size or DEFAULT_BATCH_SIZE
+        self.max_concurrency = max_concurrency or DEFAULT_CONCURRENCY
+        self.max_retries = DEFAULT_MAX_RETRIES if max_retries is None else max_retries
+        self.bucket = TokenBucket(tokens_per_minute or DEFAULT_TOKENS_PER_MINUTE)
+        self.retries = 0
+
+        self._encoding = None
+        if tiktoken is not None:
+            try:
+                self._encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception:
+                self._encoding = None
+
+    def count_tokens(self, text: str) -> int:
+        """Token count of a text (tiktoken when available, otherwise ~4 characters per token)."""
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return max(1, len(text) // 4)
+
+    def make_batches(self, texts: List[str]) -> List[tuple]:
+        """
+        Pack texts into batches bounded by max_batch_tokens and max_batch_size.
+
+        Returns:
+            List of (start index, texts, token count) tuples in input order
+        """
+        batches = []
+        start = 0
+        current = []
+        current_tokens = 0
+        for i, text in enumerate(texts):
+            tokens = self.count_tokens(text)
+            if current and (current_tokens + tokens > self.max_batch_tokens or len(current) >= self.max_batch_size):
+                batches.append((start, current, current_tokens))
+                start, current, current_tokens = i, [], 0
+            current.append(text)
+            current_tokens += tokens
+        if current:
+            batches.append((start, current, current_tokens))
+        return batches
+
+    def _embed_batch(self, texts: List[str], tokens: int) -> List[List[float]]:
+        attempt = 0
+        while True:
+            self.bucket.acquire(tokens)
+            try:
+                return self.embeddings.embed_documents(texts)
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable_error(e):
+                    raise
+                # Exponential backoff with full jitter so parallel batches do not retry in lockstep
+                delay = random.uniform(0, min(60.0, 2 ** attempt))
+                attempt += 1
+                self.retries += 1
+                print(f"Embedding batch of {len(texts)} texts hit {type(e).__name__}; "
+                      f"retry {attempt}/{self.max_retries} in {delay:.1f}s")
+                time.sleep(delay)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts in token-bounded batches with several requests in flight."""
+        if not texts:
+            return []
+
+        batches = self.make_batches(texts)
+        vectors = [None] * len(texts)
+
+        if len(batches) == 1 or self.max_concurrency <= 1:
+            results = [self._embed_batch(batch, tokens) for _, batch, tokens in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+                futures = [executor.submit(self._embed_batch, batch, tokens) for _, batch, tokens in batches]
+                results = [future.result() for future in futures]
+
+        for (start, batch, _), batch_vectors in zip(batches, results):
+            vectors[start:start + len(batch)] = batch_vectors
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        self.bucket.acquire(self.count_tokens(text))
+        return self.embeddings.embed_query(text)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        # Waiting for the token bucket must not block the event loop
+        await asyncio.to_thread(self.bucket.acquire, self.count_tokens(text))
+        return await self.embeddings.aembed_query(text)
@@ -0,0 +1,76 @@
+"""
+Compaction of a reference index: garbage collection of orphaned entries.
+
+Deleting a file tombstones its child vectors and their keyword postings in
+their segments (index_segments.py), and some entries can outlive the files
+they belonged to:
+
+- parent chunks whose deletion was deferred while older snapshots were being
+  searched, when the process exits before they are purged
+- parent chunks and duplicate-detection signatures written for a file whose
+  embedding then failed
+- child vectors left behind by an interrupted update, and tombstoned ones
+
+None of them can be returned by a search, but the docstore keeps growing and
+every search and save pays for them. ReferenceIndex.compact() finds the
+entries the manifest no longer references ("tombstones"), merges the vector
+segments without them, rewrites the signatures, publishes the result as a
+new index snapshot and purges the orphaned parents from disk. Counting all
+the tombstones walks the whole docstore, so it is done when the index is
+loaded and after a change that failed half way; tombstoned vectors are
+counted on every save. If they make up RAG_COMPACT_THRESHOLD (default 0.2)
+of the stored entries, compaction runs in a background thread. 0 turns
+automatic compaction off.
+"""
+
+import os
+from typing import Any, Dict
+
+DEFAULT_THRESHOLD = float(os.getenv("RAG_COMPACT_THRESHOLD", "0.2"))
+# Random query vectors (and chunk texts) timed before and after a compaction
+LATENCY_PROBES = 20
+
+
+def directory_bytes(path: str) -> int:
+    """Total size of the files below a directory (0 if it does not exist)."""
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+class CompactionReport:
+    """What a compaction removed, and the index size and search latency before and after it."""
+
+    def __init__(self, garbage: Dict[str, Any], before: Dict[str, float]):
+        self.garbage = garbage
+        self.before = before
+        self.after = None
+        self.seconds = 0.0
+
+    @property
+    def removed(self) -> int:
+        return (self.garbage["orphan_parents"] + self.garbage["orphan_vectors"]
+                + self.garbage["orphan_signatures"])
+
+    def summary(self) -> str:
+        """Return a human readable summary of the compaction."""
+        garbage = self.garbage
+        text = (f"Compaction: removed {garbage['orphan_parents']} orphaned parent chunks, "
+                f"{garbage['orphan_vectors']} child vectors and "
+                f"{garbage['orphan_signatures']} signatures (tombstone ratio {garbage['tombstone_ratio']:.1%}) "
+                f"in {self.seconds:.1f}s")
+        if self.after is not None:
+            for key, label, unit in (("docstore_mb", "docstore", " MB"), ("memory_mb", "memory", " MB"),
+                                     ("search_ms", "search p50", " ms")):
+                before, after = self.before.get(key), self.after.get(key)
+                if before is not None and after is not None:
+                    text += f"\n  - {label}: {before:.2f}{unit} -> {after:.2f}{unit}"
+        return text
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"garbage": self.garbage, "before": self.before, "after": self.after, "seconds": self.seconds}
@@ -0,0 +1,395 @@
+"""
+Immutable segments holding the child vectors of the reference index.
+
+Every save that adds child chunks writes them as a new segment: a directory
+under segments/ with their FAISS vectors (vectors.faiss), the chunks
+themselves (children.sqlite) and their BM25 postings (keyword/), in the same
+order. A segment is never changed
+after it is written. Deleting a chunk clears its bit in the live mask of its
+segment (a tombstone) instead, and searches pass the mask to FAISS as an
+IDSelectorBitmap, so tombstoned vectors are skipped during the scan; keyword
+searches skip them through the same masks.
+
+SegmentedStore is the set of segments and live masks of one index version.
+It is immutable too: adding a segment or deleting chunks returns a new store
+that shares every segment and mask the change did not touch, so a change
+costs time proportional to its own size and the store a running search holds
+is never modified.
+
+Merges combine several segments into one new segment without their
+tombstoned chunks (merge_candidates decides which), keeping the number of
+segments a search visits logarithmic in the number of saves.
+"""
+
+import os
+import json
+import sqlite3
+import threading
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_community.vectorstores.faiss import dependable_faiss_import
+
+from .keyword_index import KeywordPostings, KeywordSnapshot
+from .vector_index import index_bytes, reconstruct, search_parameters
+
+SEGMENTS_DIR = "segments"
+VECTORS_FILE = "vectors.faiss"
+CHUNKS_FILE = "children.sqlite"
+KEYWORD_DIR = "keyword"
+# Bytes of a chunk file SQLite maps into memory in read-only mode
+CHUNKS_MMAP_SIZE = 1 << 30
+# Rough in-memory size of a child chunk's Document and metadata, text excluded
+CHUNK_OVERHEAD_BYTES = 1024
+# A segment is merged with the next newer ones once they hold at least this share of its vectors
+MERGE_RATIO = float(os.getenv("RAG_SEGMENT_MERGE_RATIO", "1.0"))
+# Beyond this many segments the smallest neighbours are merged regardless of their sizes
+MAX_SEGMENTS = int(os.getenv("RAG_MAX_SEGMENTS", "16"))
+
+
+class SQLiteChildStore:
+    """
+    The child chunks of a saved segment, by vector position. Read-only indexes
+    look chunks up here on demand instead of loading them into memory.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self._conn.execute(f"PRAGMA mmap_size={CHUNKS_MMAP_SIZE}")
+
+    @staticmethod
+    def write(path: str, ids: Sequence[str], chunks: Sequence[Document]):
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute(
+                "CREATE TABLE children (position INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, "
+                "page_content TEXT NOT NULL, metadata TEXT NOT NULL)"
+            )
+            conn.executemany("INSERT INTO children VALUES (?, ?, ?, ?)", (
+                (position, doc_id, chunk.page_content, json.dumps(chunk.metadata, default=str))
+                for position, (doc_id, chunk) in enumerate(zip(ids, chunks))
+            ))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def ids(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT id FROM children ORDER BY position")]
+
+    def documents(self) -> List[Document]:
+        with self._lock:
+            rows = self._conn.execute("SELECT id, page_content, metadata FROM children ORDER BY position").fetchall()
+        return [Document(page_content=text, metadata=json.loads(metadata), id=doc_id) for doc_id, text, metadata in rows]
+
+    def document(self, position: int) -> Document:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, page_content, metadata FROM children WHERE position = ?", (int(position),)
+            ).fetchone()
+        if row is None:
+            raise KeyError(position)
+        return Document(page_content=row[1], metadata=json.loads(row[2]), id=row[0])
+
+
+class IndexSegment:
+    """Child chunks written by one save or merge: their FAISS vectors, the chunks and their postings, by position."""
+
+    def __init__(self, name: str, index, ids: Sequence[str], chunks, keyword: Optional[KeywordPostings] = None):
+        """
+        Args:
+            name: Directory of the segment under segments/
+            index: FAISS index holding the vectors, position i being chunk i
+            ids: Child chunk ids by position
+            chunks: Documents by position, or a SQLiteChildStore reading them from disk
+            keyword: BM25 postings of the chunks; built from them if omitted
+        """
+        self.name = name
+        self.index = index
+        self.ids = list(ids)
+        self._chunks = chunks
+        if keyword is None:
+            keyword = KeywordPostings.build(chunk.page_content for chunk in self.chunks())
+        self.keyword = keyword
+        self._lock = threading.Lock()
+        self._positions = None
+        self._chunk_bytes = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def chunk(self, position: int) -> Document:
+        if isinstance(self._chunks, SQLiteChildStore):
+            return self._chunks.document(position)
+        return self._chunks[position]
+
+    def chunks(self) -> List[Document]:
+        if isinstance(self._chunks, SQLiteChildStore):
+            return self._chunks.documents()
+        return self._chunks
+
+    def position(self, doc_id: str) -> Optional[int]:
+        """Position of a chunk id in the segment; the lookup table is built on first use."""
+        if self._positions is None:
+            with self._lock:
+                if self._positions is None:
+                    self._positions = {doc_id: position for position, doc_id in enumerate(self.ids)}
+        return self._positions.get(doc_id)
+
+    def memory_bytes(self) -> int:
+        """Vectors, postings and chunks (the whole chunk file if they are read from disk)."""
+        if self._chunk_bytes is None:
+            if isinstance(self._chunks, SQLiteChildStore):
+                self._chunk_bytes = os.path.getsize(self._chunks.path)
+            else:
+                self._chunk_bytes = sum(len(chunk.page_content) + CHUNK_OVERHEAD_BYTES for chunk in self._chunks)
+        return index_bytes(self.index) + self.keyword.memory_bytes() + self._chunk_bytes
+
+    def save(self, path: str):
+        """Write the vectors, chunks and postings to a new directory."""
+        faiss = dependable_faiss_import()
+        os.makedirs(path)
+        faiss.write_index(self.index, os.path.join(path, VECTORS_FILE))
+        SQLiteChildStore.write(os.path.join(path, CHUNKS_FILE), self.ids, self._chunks)
+        self.keyword.save(os.path.join(path, KEYWORD_DIR))
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = False) -> "IndexSegment":
+        """
+        Open a saved segment.
+
+        Args:
+            mmap (bool): Memory-map the vectors and postings and read chunks from disk
+                on demand instead of loading them into memory
+        """
+        faiss = dependable_faiss_import()
+        chunks = SQLiteChildStore(os.path.join(path, CHUNKS_FILE))
+        keyword = KeywordPostings.load(os.path.join(path, KEYWORD_DIR), mmap=mmap)
+        if mmap:
+            # IO_FLAG_MMAP_IFC (newer faiss) maps flat, HNSW and IVF storage; the older
+            # IO_FLAG_MMAP only maps IVF lists. The two cannot be combined.
+            flags = faiss.IO_FLAG_READ_ONLY | getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+            index = faiss.read_index(os.path.join(path, VECTORS_FILE), flags)
+            return cls(os.path.basename(path), index, chunks.ids(), chunks, keyword)
+        index = faiss.read_index(os.path.join(path, VECTORS_FILE))
+        documents = chunks.documents()
+        return cls(os.path.basename(path), index, [document.id for document in documents], documents, keyword)
+
+
+class SegmentedStore:
+    """
+    The segments of one index version and, per segment, a mask of its chunks
+    that are still live. Positions are global: segment i covers the positions
+    from the total length of the segments before it. Never modified: changes
+    return a new store.
+    """
+
+    def __init__(self, segments: Iterable[IndexSegment] = (), live: Optional[Sequence[np.ndarray]] = None,
+                 live_counts: Optional[Sequence[int]] = None):
+        """
+        Args:
+            segments: Segments, oldest first
+            live: Boolean mask per segment; all chunks are live if omitted
+            live_counts: Number of set bits per mask, if the caller already knows them
+        """
+        self.segments = tuple(segments)
+        if live is None:
+            live = [np.ones(len(segment), dtype=bool) for segment in self.segments]
+        self.live = tuple(live)
+        if live_counts is None:
+            live_counts = [int(mask.sum()) for mask in self.live]
+        self.live_counts = tuple(live_counts)
+        self.offsets = np.cumsum([0] + [len(segment) for segment in self.segments])
+        self.keyword = KeywordSnapshot([segment.keyword for segment in self.segments], self.live)
+        # Search parameters restricting each segment to its live chunks, built on first use
+        self._live_params = {}
+
+    def __len__(self) -> int:
+        """Number of live chunks."""
+        return sum(self.live_counts)
+
+    @property
+    def ntotal(self) -> int:
+        """Number of stored vectors, tombstoned ones included."""
+        return int(self.offsets[-1])
+
+    @property
+    def dimension(self) -> int:
+        return self.segments[0].index.d if self.segments else 0
+
+    def names(self) -> List[str]:
+        return [segment.name for segment in self.segments]
+
+    def _locate(self, positions) -> Tuple[np.ndarray, np.ndarray]:
+        """Segment number and position within the segment of global positions."""
+        positions = np.asarray(positions, dtype=np.int64)
+        segments = np.searchsorted(self.offsets, positions, side="right") - 1
+        return segments, positions - self.offsets[segments]
+
+    def doc_id(self, position: int) -> str:
+        segment, local = self._locate([position])
+        return self.segments[segment[0]].ids[int(local[0])]
+
+    def chunk(self, position: int) -> Document:
+        segment, local = self._locate([position])
+        return self.segments[segment[0]].chunk(int(local[0]))
+
+    def position(self, doc_id: str) -> Optional[int]:
+        """Global position of a live chunk, or None."""
+        for number, segment in enumerate(self.segments):
+            local = segment.position(doc_id)
+            if local is not None:
+                return int(self.offsets[number]) + local if self.live[number][local] else None
+        return None
+
+    def chunks(self) -> Iterator[Tuple[str, Document]]:
+        """(id, Document) of every live chunk."""
+        for segment, mask in zip(self.segments, self.live):
+            for doc_id, chunk, live in zip(segment.ids, segment.chunks(), mask):
+                if live:
+                    yield doc_id, chunk
+
+    def stored_ids(self) -> List[str]:
+        """Ids of every stored chunk, tombstoned ones included."""
+        return [doc_id for segment in self.segments for doc_id in segment.ids]
+
+    def reconstruct(self, positions) -> np.ndarray:
+        """Stored vectors at global positions, in the given order."""
+        segments, local = self._locate(positions)
+        vectors = np.zeros((len(local), self.dimension), dtype=np.float32)
+        for number in np.unique(segments):
+            rows = np.flatnonzero(segments == number)
+            vectors[rows] = reconstruct(self.segments[number].index, local[rows])
+        return vectors
+
+    def search(self, matrix: np.ndarray, k: int, allowed_positions: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Global positions of the k nearest live vectors for each query row, nearest
+        first, padded with -1. Each segment is searched once for the whole matrix
+        and the per-segment results are merged by distance.
+
+        Args:
+            allowed_positions: Only consider these global positions (e.g. a metadata filter)
+        """
+        allowed = None
+        if allowed_positions is not None:
+            allowed = np.zeros(self.ntotal, dtype=bool)
+            allowed[allowed_positions] = True
+        distances, positions = [], []
+        for number, segment in enumerate(self.segments):
+            if self.live_counts[number] == 0:
+                continue
+            start = int(self.offsets[number])
+            if allowed is not None:
+                mask = self.live[number] & allowed[start:start + len(segment)]
+                if not mask.any():
+                    continue
+                params = search_parameters(segment.index, mask)
+            else:
+                params = self._segment_params(number)
+            found_distances, found = segment.index.search(matrix, min(k, len(segment)), params=params)
+            distances.append(np.where(found >= 0, found_distances, np.inf))
+            positions.append(np.where(found >= 0, found + start, -1))
+        if not positions:
+            return np.full((len(matrix), k), -1, dtype=np.int64)
+        distances, positions = np.hstack(distances), np.hstack(positions)
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(positions, order, axis=1)
+
+    def _segment_params(self, number: int):
+        """Parameters skipping a segment's tombstones; None if it has none."""
+        if self.live_counts[number] == len(self.segments[number]):
+            return None
+        params = self._live_params.get(number)
+        if params is None:
+            params = self._live_params[number] = search_parameters(self.segments[number].index, self.live[number])
+        return params
+
+    def with_segment(self, segment: IndexSegment) -> "SegmentedStore":
+        """The store with a new segment of live chunks appended."""
+        return SegmentedStore(self.segments + (segment,), self.live + (np.ones(len(segment), dtype=bool),),
+                              self.live_counts + (len(segment),))
+
+    def without(self, ids: Iterable[str]) -> Tuple["SegmentedStore", int]:
+        """
+        The store with the given chunks tombstoned; only the masks of the segments
+        holding them are copied, and segments left without live chunks are dropped.
+
+        Returns:
+            (new store, number of live chunks removed)
+        """
+        ids = list(ids)
+        segments, live, counts = [], [], []
+        removed = 0
+        for segment, mask, count in zip(self.segments, self.live, self.live_counts):
+            positions = [position for position in map(segment.position, ids) if position is not None]
+            if positions:
+                cleared = int(mask[positions].sum())
+                if cleared:
+                    mask = mask.copy()
+                    mask[positions] = False
+                    count -= cleared
+                    removed += cleared
+            if count:
+                segments.append(segment)
+                live.append(mask)
+                counts.append(count)
+        return SegmentedStore(segments, live, counts), removed
+
+    def replace(self, merged: Sequence[IndexSegment], segment: IndexSegment) -> "SegmentedStore":
+        """
+        The store with merged segments replaced by the segment built from their live
+        chunks. Chunks tombstoned since the merge started are tombstoned in it too.
+        """
+        names = {old.name for old in merged}
+        still_live = set()
+        segments, live, counts = [], [], []
+        at = None
+        for old, mask, count in zip(self.segments, self.live, self.live_counts):
+            if old.name in names:
+                still_live.update(doc_id for doc_id, alive in zip(old.ids, mask) if alive)
+                if at is not None:
+                    continue
+                # The merged chunks take the place of the first merged segment
+                at = len(segments)
+            segments.append(old)
+            live.append(mask)
+            counts.append(count)
+        mask = np.fromiter((doc_id in still_live for doc_id in segment.ids), dtype=bool, count=len(segment))
+        segments[at], live[at], counts[at] = segment, mask, int(mask.sum())
+        if not counts[at]:
+            del segments[at], live[at], counts[at]
+        return SegmentedStore(segments, live, counts)
+
+    def memory_bytes(self) -> int:
+        return sum(segment.memory_bytes() + mask.nbytes for segment, mask in zip(self.segments, self.live))
+
+
+def merge_candidates(store: SegmentedStore) -> List[IndexSegment]:
+    """
+    Segments worth merging, newest last; empty if none.
+
+    Segments are kept in decreasing size from the oldest: the newest run of
+    segments is merged into the segment before it once the run holds at least
+    MERGE_RATIO of that segment's live vectors, as in a binary counter, so each
+    vector is rewritten O(log n) times over the life of the index. Segments
+    with many tombstones count only their live vectors.
+    """
+    sizes = list(store.live_counts)
+    segments = list(store.segments)
+    start = len(segments)
+    run = 0
+    for number in range(len(segments) - 1, 0, -1):
+        run += sizes[number]
+        if run >= sizes[number - 1] * MERGE_RATIO:
+            start = number - 1
+    if start < len(segments) - 1:
+        return segments[start:]
+    if len(segments) > MAX_SEGMENTS:
+        # Sizes are out of balance (e.g. after large deletions); merge the smallest neighbours
+        number = min(range(len(segments) - 1), key=lambda i: sizes[i] + sizes[i + 1])
+        return segments[number:number + 2]
+    return []
@@ -0,0 +1,232 @@
+"""
+Persistent BM25 keyword index over the child chunks of the reference index.
+
+Vector similarity tends to miss queries that hinge on exact terms (statute
+names, standard numbers such as "ISO 26000", company names). This index
+scores the same child chunks with BM25 so that ReferenceIndex can fuse both
+rankings with reciprocal rank fusion.
+
+Postings are kept per segment of the vector store (index_segments.py), as
+compressed-sparse-row NumPy arrays (one row of chunk positions and term
+frequencies per term) saved as .npy files in the segment's directory, so a
+query touches only the postings of its own terms and a saved index can be
+opened memory-mapped. Like the segments, postings are never changed once
+built: a save builds postings only for the chunks it adds, deleted chunks are
+skipped through the segments' live masks, and merged segments get postings
+built from their live chunks. KeywordSnapshot searches the postings of all
+the segments of one store with the document counts, document frequencies
+and average length of its live chunks, as if they were one index.
+"""
+
+import os
+import re
+import json
+import math
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were will with".split()
+)
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Rank offset of reciprocal rank fusion; 60 is the value from the original RRF paper
+RRF_K = 60
+
+ARRAY_NAMES = ("doc_lengths", "term_offsets", "postings_docs", "postings_tf")
+VOCAB_FILE = "vocab.json"
+# Rough size of one entry (string key included) of the vocabulary dictionary
+DICT_ENTRY_BYTES = 100
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-cased word tokens without stopwords; numbers such as 26000 are kept."""
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def reciprocal_rank_fusion(rankings: Iterable[List[str]], k: int = RRF_K) -> List[str]:
+    """
+    Fuse several rankings of ids: each id scores sum(1 / (k + rank)) over the
+    rankings it appears in. Ties keep the order in which ids were first seen.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class KeywordPostings:
+    """BM25 postings of the chunks of one segment, by chunk position; never modified once built."""
+
+    def __init__(self, terms: List[str], arrays: Dict[str, np.ndarray]):
+        """
+        Args:
+            terms: The vocabulary, term i being row i of the postings
+            arrays: doc_lengths, term_offsets, postings_docs and postings_tf
+        """
+        self._vocab = {term: term_id for term_id, term in enumerate(terms)}
+        self._arrays = arrays
+
+    @classmethod
+    def build(cls, texts: Iterable[str]) -> "KeywordPostings":
+        """Postings of chunk texts, chunk i being the i-th text."""
+        vocab = {}
+        terms, docs, tfs, lengths = [], [], [], []
+        for position, text in enumerate(texts):
+            tokens = tokenize(text)
+            lengths.append(len(tokens))
+            for term, count in Counter(tokens).items():
+                terms.append(vocab.setdefault(term, len(vocab)))
+                docs.append(position)
+                tfs.append(count)
+        terms = np.array(terms, dtype=np.int32)
+        order = np.argsort(terms, kind="stable")
+        term_offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        term_offsets[1:] = np.cumsum(np.bincount(terms, minlength=len(vocab)))
+        return cls(list(vocab), {
+            "doc_lengths": np.array(lengths, dtype=np.int32),
+            "term_offsets": term_offsets,
+            "postings_docs": np.array(docs, dtype=np.int32)[order],
+            "postings_tf": np.array(tfs, dtype=np.float32)[order]
+        })
+
+    def __len__(self) -> int:
+        return len(self._arrays["doc_lengths"])
+
+    @property
+    def doc_lengths(self) -> np.ndarray:
+        return self._arrays["doc_lengths"]
+
+    def postings(self, term: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """(chunk positions, term frequencies) of a term, or None if no chunk contains it."""
+        term_id = self._vocab.get(term)
+        if term_id is None:
+            return None
+        offsets = self._arrays["term_offsets"]
+        start, end = offsets[term_id], offsets[term_id + 1]
+        return self._arrays["postings_docs"][start:end], self._arrays["postings_tf"][start:end]
+
+    def memory_bytes(self) -> int:
+        """Approximate memory held by the postings (memory-mapped ones included)."""
+        return sum(np.asarray(array).nbytes for array in self._arrays.values()) + len(self._vocab) * DICT_ENTRY_BYTES
+
+    def save(self, path: str):
+        """Write the postings to a new directory."""
+        os.makedirs(path)
+        for name in ARRAY_NAMES:
+            np.save(os.path.join(path, f"{name}.npy"), np.asarray(self._arrays[name]))
+        with open(os.path.join(path, VOCAB_FILE), "w", encoding="utf-8") as f:
+            json.dump(list(self._vocab), f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = False) -> Optional["KeywordPostings"]:
+        """
+        Load saved postings. Returns None if there are none.
+
+        Args:
+            mmap (bool): Memory-map the postings read-only instead of reading them into memory
+        """
+        if not os.path.exists(os.path.join(path, VOCAB_FILE)):
+            return None
+        with open(os.path.join(path, VOCAB_FILE), "r", encoding="utf-8") as f:
+            terms = json.load(f)
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None)
+            for name in ARRAY_NAMES
+        }
+        return cls(terms, arrays)
+
+
+class KeywordSnapshot:
+    """
+    BM25 search over the postings of the segments of one vector store, skipping the
+    chunks their live masks exclude. Positions are global, as in the store.
+    """
+
+    def __init__(self, postings: Sequence[KeywordPostings] = (), live: Sequence[np.ndarray] = ()):
+        """
+        Args:
+            postings: Postings per segment, oldest first
+            live: Boolean mask of the live chunks per segment
+        """
+        self._postings = tuple(postings)
+        self._live = tuple(live)
+        self._offsets = np.cumsum([0] + [len(segment) for segment in self._postings])
+        # (live chunk count, their average length), computed on first use
+        self._stats = None
+
+    def __len__(self) -> int:
+        return self._collection_stats()[0]
+
+    def _collection_stats(self) -> Tuple[int, float]:
+        if self._stats is None:
+            count = sum(int(mask.sum()) for mask in self._live)
+            length = sum(int(postings.doc_lengths[mask].sum()) for postings, mask in zip(self._postings, self._live))
+            self._stats = (count, length / count if count else 1.0)
+        return self._stats
+
+    def search(self, query: str, k: int = 10,
+               allowed_positions: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """
+        Return up to k (chunk position, BM25 score) pairs, best first; chunks that
+        share no term with the query are not returned.
+
+        Args:
+            allowed_positions: Only score the chunks at these positions (e.g. the chunks of
+                files matching a metadata filter)
+        """
+        doc_count, average_length = self._collection_stats()
+        terms = set(tokenize(query))
+        if not terms or doc_count == 0:
+            return []
+        allowed = None
+        if allowed_positions is not None:
+            allowed = np.zeros(int(self._offsets[-1]), dtype=bool)
+            allowed[allowed_positions] = True
+
+        # Live postings of the query terms per segment; document frequencies count every segment
+        matched = []
+        frequencies = Counter()
+        for number, (postings, mask) in enumerate(zip(self._postings, self._live)):
+            found = []
+            for term in terms:
+                entry = postings.postings(term)
+                if entry is None:
+                    continue
+                docs, tf = entry
+                alive = mask[docs]
+                if not alive.all():
+                    docs, tf = docs[alive], tf[alive]
+                if len(docs):
+                    frequencies[term] += len(docs)
+                    found.append((term, docs, tf))
+            if found:
+                matched.append((number, found))
+
+        positions, scores = [], []
+        for number, found in matched:
+            postings = self._postings[number]
+            segment_scores = np.zeros(len(postings), dtype=np.float32)
+            for term, docs, tf in found:
+                df = frequencies[term]
+                idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * postings.doc_lengths[docs] / max(average_length, 1e-9))
+                segment_scores[docs] += (idf * tf * (BM25_K1 + 1) / (tf + norm)).astype(np.float32)
+            start = int(self._offsets[number])
+            if allowed is not None:
+                segment_scores[~allowed[start:start + len(postings)]] = 0
+            top = np.flatnonzero(segment_scores > 0)
+            if len(top) > k:
+                top = top[np.argpartition(-segment_scores[top], k - 1)[:k]]
+            positions.append(top + start)
+            scores.append(segment_scores[top])
+        if not positions:
+            return []
+        positions, scores = np.concatenate(positions), np.concatenate(scores)
+        order = np.lexsort((positions, -scores))[:k]
+        return [(int(positions[i]), float(scores[i])) for i in order]
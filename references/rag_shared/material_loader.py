@@ -0,0 +1,293 @@
+"""
+Parallel document loading for reference and teaching materials.
+
+PDF and PowerPoint parsing is CPU-bound, so files are parsed in a process
+pool. Each worker returns the parsed documents for one file; failures are
+collected into a LoadReport instead of being printed one by one.
+
+Ingestion is streamed in fixed-size windows of files so that peak memory does
+not grow with the size of the corpus.
+"""
+
+import os
+import sqlite3
+import threading
+import multiprocessing
+from pathlib import Path
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Any, Optional, Tuple, Iterable, Iterator, NamedTuple
+
+from langchain_community.document_loaders import (
+    PyPDFLoader,
+    Docx2txtLoader,
+    UnstructuredPowerPointLoader,
+    UnstructuredHTMLLoader,
+    TextLoader
+)
+
+# Registry of the loader used for each supported file extension; extend it with register_loader()
+LOADERS = {
+    ".pdf": PyPDFLoader,
+    ".docx": Docx2txtLoader,
+    ".pptx": UnstructuredPowerPointLoader,
+    ".html": UnstructuredHTMLLoader,
+    ".txt": TextLoader
+}
+
+# Number of loader processes; 0 or unset means one per CPU
+DEFAULT_LOAD_WORKERS = int(os.getenv("RAG_LOAD_WORKERS", "0"))
+
+# Number of files loaded, split and embedded together by the streaming pipeline
+DEFAULT_INGEST_WINDOW = int(os.getenv("RAG_INGEST_WINDOW", "16"))
+
+
+class MaterialFile(NamedTuple):
+    """A file found by discover_materials, with the stat info callers need."""
+    path: str
+    rel_path: str
+    extension: str
+    size: int
+    mtime: float
+
+    @property
+    def loader(self):
+        """Loader class registered for this file's extension, or None if unsupported."""
+        return LOADERS.get(self.extension)
+
+
+def register_loader(extension: str, loader_cls):
+    """
+    Register (or replace) the loader class used for a file extension.
+
+    Loaders must be registered at import time so that worker processes of the
+    loading pool see them too.
+    """
+    extension = extension.lower()
+    if not extension.startswith("."):
+        extension = "." + extension
+    LOADERS[extension] = loader_cls
+
+
+def discover_materials(root: str, extensions: Optional[Iterable[str]] = None) -> List[MaterialFile]:
+    """
+    Walk a materials tree once with os.scandir and return every file with its stat info.
+
+    Args:
+        root: Materials directory
+        extensions: Only return files with these (lower-case, dotted) extensions.
+            Defaults to every file; pass LOADERS to get the indexable ones.
+
+    Returns:
+        MaterialFile entries sorted by relative path
+    """
+    if extensions is not None:
+        extensions = {extension.lower() for extension in extensions}
+
+    files = []
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        continue
+                    if not entry.is_file():
+                        continue
+                    extension = os.path.splitext(entry.name)[1].lower()
+                    if extensions is not None and extension not in extensions:
+                        continue
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append(MaterialFile(
+                    entry.path, os.path.relpath(entry.path, root), extension, stat.st_size, stat.st_mtime
+                ))
+
+    files.sort(key=lambda material: material.rel_path)
+    return files
+
+
+class LoadReport:
+    """
+    Summary of a loading run: how many files and documents were loaded and
+    which files failed.
+    """
+
+    def __init__(self):
+        self.loaded_files = 0
+        self.loaded_documents = 0
+        self.errors = []  # list of (path, error message)
+
+    def add_success(self, path: str, documents: List[Any]):
+        self.loaded_files += 1
+        self.loaded_documents += len(documents)
+
+    def add_error(self, path: str, error: str):
+        self.errors.append((path, error))
+
+    def summary(self) -> str:
+        """Return a human readable summary, listing every failed file."""
+        text = f"Loaded {self.loaded_documents} documents from {self.loaded_files} files"
+        if self.errors:
+            text += f", {len(self.errors)} files failed:"
+            for path, error in self.errors:
+                text += f"\n  - {path}: {error}"
+        return text
+
+
+def load_file(path: str) -> List[Any]:
+    """Load a single file with the loader registered for its extension (plain text otherwise)."""
+    loader_cls = LOADERS.get(Path(path).suffix.lower(), TextLoader)
+    if loader_cls is TextLoader:
+        return loader_cls(path, encoding="utf-8").load()
+    return loader_cls(path).load()
+
+
+def _load_file_safe(path: str) -> Tuple[str, List[Any], Optional[str]]:
+    """Worker entry point: never raises so one bad file cannot break the pool."""
+    try:
+        return path, load_file(path), None
+    except Exception as e:
+        return path, [], f"{type(e).__name__}: {e}"
+
+
+def iter_loaded_files(paths: Iterable[str], max_workers: Optional[int] = None,
+                      window_size: Optional[int] = None) -> Iterator[Tuple[str, List[Any], Optional[str]]]:
+    """
+    Parse files in a process pool and yield (path, documents, error) as each one finishes.
+
+    At most `window_size` files are submitted but not yet consumed, so memory is
+    bounded by the window rather than by the size of the corpus. Workers are
+    spawned, so they import the main module again: a script that loads files
+    must start its work under ``if __name__ == "__main__":``.
+
+    Args:
+        paths: Files to load (may be a lazy iterable)
+        max_workers: Number of worker processes. Defaults to DEFAULT_LOAD_WORKERS,
+            or one per CPU when that is 0. Use 1 to load in the current process.
+        window_size: Maximum number of files in flight. Defaults to DEFAULT_INGEST_WINDOW.
+    """
+    if max_workers is None:
+        max_workers = DEFAULT_LOAD_WORKERS or os.cpu_count() or 1
+    window_size = max(1, window_size or DEFAULT_INGEST_WINDOW)
+    paths = iter(paths)
+
+    executor = None
+    if max_workers > 1:
+        try:
+            # Spawned, not forked: files are loaded from background threads (index warm-up,
+            # materials watcher), and a child forked while another thread holds a lock
+            # (logging, SQLite, the embedding client) can deadlock on it
+            executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+        except Exception as e:
+            # Fall back to serial loading if worker processes cannot be started
+            print(f"Parallel loading unavailable ({e}); loading files serially")
+
+    if executor is None:
+        for path in paths:
+            yield _load_file_safe(path)
+        return
+
+    with executor:
+        pending = {executor.submit(_load_file_safe, path) for path in islice(paths, window_size)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+                next_path = next(paths, None)
+                if next_path is not None:
+                    pending.add(executor.submit(_load_file_safe, next_path))
+
+
+class ExtractedTextCache:
+    """
+    SQLite cache of extracted plain text keyed by (path, size, mtime), so
+    unchanged files are never parsed twice, even across restarts. retain()
+    drops the entries of files that are no longer in the materials folder.
+    """
+
+    def __init__(self, cache_path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False, timeout=30)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS extracted_text ("
+            "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL, text TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, path: str, size: int, mtime: float) -> Optional[str]:
+        """Cached text for the file, or None if it is missing or the file changed."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT text FROM extracted_text WHERE path = ? AND size = ? AND mtime = ?",
+                (os.path.abspath(path), size, mtime)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, path: str, size: int, mtime: float, text: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO extracted_text (path, size, mtime, text) VALUES (?, ?, ?, ?)",
+                (os.path.abspath(path), size, mtime, text)
+            )
+            self._conn.commit()
+
+    def retain(self, paths: Iterable[str]) -> int:
+        """
+        Drop the cached text of every file not among paths, e.g. the latest
+        discover_materials() result, so deleted and renamed files do not stay in
+        the cache forever. Returns the number of entries dropped.
+        """
+        keep = [(os.path.abspath(path),) for path in paths]
+        with self._lock:
+            self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS retained (path TEXT PRIMARY KEY)")
+            self._conn.executemany("INSERT OR IGNORE INTO retained (path) VALUES (?)", keep)
+            removed = self._conn.execute(
+                "DELETE FROM extracted_text WHERE path NOT IN (SELECT path FROM retained)"
+            ).rowcount
+            self._conn.execute("DELETE FROM retained")
+            self._conn.commit()
+        return removed
+
+
+def iter_extracted_texts(files: List[MaterialFile], cache: Optional[ExtractedTextCache] = None,
+                         max_workers: Optional[int] = None, window_size: Optional[int] = None,
+                         report: Optional[LoadReport] = None) -> Iterator[Tuple[str, str]]:
+    """
+    Yield (path, plain text) for each discovered file, using the format-specific loaders.
+
+    Cached texts are yielded first; the remaining files are parsed in the
+    process pool and their text is added to the cache.
+    """
+    stats = {}
+    to_parse = []
+    for material in files:
+        stats[material.path] = material
+        text = cache.get(material.path, material.size, material.mtime) if cache is not None else None
+        if text is None:
+            to_parse.append(material.path)
+        else:
+            if report is not None:
+                report.add_success(material.path, [text])
+            yield material.path, text
+
+    for path, documents, error in iter_loaded_files(to_parse, max_workers, window_size):
+        if error:
+            if report is not None:
+                report.add_error(path, error)
+            continue
+        if report is not None:
+            report.add_success(path, documents)
+        text = "\n\n".join(doc.page_content for doc in documents)
+        if cache is not None:
+            cache.put(path, stats[path].size, stats[path].mtime, text)
+        yield path, text
@@ -0,0 +1,230 @@
+"""
+Background watcher that keeps a reference index in sync with its materials directory.
+
+Files copied into the materials directory directly (e.g. over an SMB share)
+bypass the upload functions. MaterialsWatcher notices them, either from
+filesystem events (inotify on Linux) through the optional watchdog package,
+or, without it, by polling: one os.scandir pass every RAG_WATCH_POLL_INTERVAL
+seconds that compares sizes and mtimes with the index manifest. Network
+shares often do not deliver filesystem events, so "poll" can be forced with
+RAG_WATCH_MODE.
+
+Changes are debounced. Paths are collected until no event has arrived for
+RAG_WATCH_DEBOUNCE seconds (copying a large file produces a burst of events),
+files whose size or mtime still changed in that time are held back for
+another round, and the rest are applied in the background as one batch with
+ReferenceIndex.apply_changes, which saves the index and bumps its version
+once per batch.
+"""
+
+import os
+import time
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+from .material_loader import LOADERS
+
+WATCH_MODES = ("auto", "events", "poll")
+DEFAULT_WATCH_MODE = os.getenv("RAG_WATCH_MODE", "auto").lower()
+DEFAULT_DEBOUNCE = float(os.getenv("RAG_WATCH_DEBOUNCE", "2"))
+DEFAULT_POLL_INTERVAL = float(os.getenv("RAG_WATCH_POLL_INTERVAL", "10"))
+
+
+def watch_default() -> bool:
+    """Whether the materials directory is watched for changes (RAG_WATCH_MATERIALS, off by default)."""
+    return os.getenv("RAG_WATCH_MATERIALS", "0").lower() in ("1", "true", "yes")
+
+
+def _signature(path: str):
+    """(size, mtime) of a file, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+def _is_material(path: str) -> bool:
+    name = os.path.basename(path)
+    # Office lock files (~$report.docx) and hidden or temporary files are never materials
+    if name.startswith(("~$", ".")):
+        return False
+    return os.path.splitext(name)[1].lower() in LOADERS
+
+
+class _EventHandler(FileSystemEventHandler):
+    def __init__(self, watcher: "MaterialsWatcher"):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.event_type in ("opened", "closed_no_write"):
+            return
+        if event.is_directory:
+            # A moved or deleted folder does not report its files one by one
+            if event.event_type in ("moved", "deleted"):
+                self.watcher.request_rescan()
+            return
+        paths = [event.src_path]
+        if getattr(event, "dest_path", ""):
+            paths.append(event.dest_path)
+        self.watcher.notify(paths)
+
+
+class MaterialsWatcher:
+    """Debounces changes under a materials directory and applies them in batches on a daemon thread."""
+
+    def __init__(self, materials_dir: str, apply: Callable[[List[str]], Any],
+                 scan: Callable[[], Iterable[str]], mode: Optional[str] = None,
+                 debounce: Optional[float] = None, poll_interval: Optional[float] = None):
+        """
+        Args:
+            materials_dir (str): Directory to watch, recursively
+            apply: Applies a batch of changed (existing or deleted) paths, e.g. ReferenceIndex.apply_changes
+            scan: Returns the paths that differ from the index, e.g. ReferenceIndex.changed_paths;
+                used when polling, on start-up and after folder moves
+            mode (str, optional): "events" (watchdog), "poll" or "auto" (events if watchdog
+                is installed; defaults to RAG_WATCH_MODE)
+            debounce (float, optional): Seconds without changes before a batch is applied
+                (defaults to RAG_WATCH_DEBOUNCE or 2)
+            poll_interval (float, optional): Seconds between scans in poll mode
+                (defaults to RAG_WATCH_POLL_INTERVAL or 10)
+        """
+        self.materials_dir = materials_dir
+        self.apply = apply
+        self.scan = scan
+        self.mode = (mode or DEFAULT_WATCH_MODE).lower()
+        if self.mode not in WATCH_MODES:
+            raise ValueError(f"Unknown watch mode {self.mode!r}; expected one of {', '.join(WATCH_MODES)}")
+        self.debounce = DEFAULT_DEBOUNCE if debounce is None else debounce
+        self.poll_interval = DEFAULT_POLL_INTERVAL if poll_interval is None else poll_interval
+        self.batches = 0
+        self.last_result = None
+        self.last_error = None
+
+        self._pending = {}  # path -> (size, mtime) when it last changed
+        self._rescan = False
+        self._last_change = 0.0
+        self._changed = threading.Condition()
+        self._stop = threading.Event()
+        self._observer = None
+        self._thread = None
+
+    def start(self):
+        """Start watching; the first scan picks up changes made while the index was loading."""
+        if self._thread is not None:
+            return
+        if self.mode == "events" and Observer is None:
+            print("watchdog is not installed; polling the materials directory instead")
+        if self.mode != "poll" and Observer is not None:
+            self.mode = "events"
+            self._observer = Observer()
+            self._observer.schedule(_EventHandler(self), self.materials_dir, recursive=True)
+            self._observer.start()
+        else:
+            self.mode = "poll"
+        self._stop.clear()
+        self.request_rescan()
+        self._thread = threading.Thread(target=self._run, name="materials-watcher", daemon=True)
+        self._thread.start()
+        print(f"Watching {self.materials_dir} for changes ({self.mode})")
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop watching; changes not applied yet are dropped and found by the next start-up scan."""
+        self._stop.set()
+        with self._changed:
+            self._changed.notify_all()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join(timeout)
+            self._observer = None
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def notify(self, paths: Iterable[str]):
+        """Record changed paths; they are applied once changes have settled."""
+        paths = [path for path in paths if _is_material(path)]
+        if not paths:
+            return
+        signatures = {path: _signature(path) for path in paths}
+        with self._changed:
+            # A rescan reports pending paths again; only a real change restarts the quiet period
+            signatures = {path: signature for path, signature in signatures.items()
+                          if path not in self._pending or self._pending[path] != signature}
+            if not signatures:
+                return
+            self._pending.update(signatures)
+            self._last_change = time.monotonic()
+            self._changed.notify()
+
+    def request_rescan(self):
+        """Compare the whole directory with the index on the next round."""
+        with self._changed:
+            self._rescan = True
+            self._changed.notify()
+
+    def _run(self):
+        next_poll = time.monotonic() + self.poll_interval
+        while not self._stop.is_set():
+            with self._changed:
+                while not self._stop.is_set():
+                    now = time.monotonic()
+                    if self.mode == "poll" and now >= next_poll:
+                        self._rescan = True
+                        next_poll = now + self.poll_interval
+                    if self._rescan or (self._pending and now - self._last_change >= self.debounce):
+                        break
+                    timeouts = []
+                    if self._pending:
+                        timeouts.append(self._last_change + self.debounce - now)
+                    if self.mode == "poll":
+                        timeouts.append(next_poll - now)
+                    self._changed.wait(min(timeouts) if timeouts else None)
+                if self._stop.is_set():
+                    return
+                rescan, self._rescan = self._rescan, False
+                batch = {}
+                if not rescan:
+                    batch, self._pending = self._pending, {}
+
+            if rescan:
+                try:
+                    # Found paths go through the same debounce as events
+                    self.notify(self.scan())
+                except Exception as e:
+                    self.last_error = str(e)
+                    print(f"Error scanning {self.materials_dir}: {e}")
+                continue
+            self._apply(batch)
+
+    def _apply(self, batch: Dict[str, Any]):
+        ready, unsettled = [], {}
+        for path, signature in batch.items():
+            current = _signature(path)
+            if current == signature:
+                ready.append(path)
+            else:
+                # Still being written; wait for another quiet period
+                unsettled[path] = current
+        if unsettled:
+            with self._changed:
+                for path, signature in unsettled.items():
+                    self._pending.setdefault(path, signature)
+                self._last_change = time.monotonic()
+
+        if not ready:
+            return
+        try:
+            self.last_result = self.apply(sorted(ready))
+            self.last_error = None
+            self.batches += 1
+        except Exception as e:
+            self.last_error = str(e)
+            print(f"Error applying changes in {self.materials_dir}: {e}")
@@ -0,0 +1,129 @@
+"""
+Metadata filters for the reference index.
+
+Every indexed file records its file type, source (relative path), folder and
+upload date, both in the metadata of its chunks and in the index manifest.
+MetadataIndex precomputes, from the manifest, which files carry each value
+and which FAISS vector positions belong to each file. A filtered search
+resolves the filter to a set of files and then to a bitmap of allowed vector
+positions, and FAISS skips every other vector during the search itself, so a
+narrow filter neither over-fetches nor post-filters.
+
+Filters are dictionaries; a value may be a string or a list of strings (any
+of them matches) and all given fields must match:
+
+    {"file_type": "pdf"}                        only PDF files
+    {"folder": "acme"}                          files in acme/ and its subfolders
+    {"source": ["acme/brief.docx", "x.pdf"]}    files by relative path or file name
+    {"uploaded_after": "2024-01-01"}            ISO dates or datetimes, inclusive
+    {"uploaded_before": "2024-06-30"}
+"""
+
+import datetime
+from pathlib import PurePath, PurePosixPath
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+import numpy as np
+
+VALUE_FIELDS = ("source", "file_type", "folder")
+DATE_FIELDS = ("uploaded_after", "uploaded_before")
+FILTER_FIELDS = VALUE_FIELDS + DATE_FIELDS
+
+
+def upload_timestamp(timestamp: Optional[float] = None) -> str:
+    """ISO 8601 UTC timestamp (to the second) recorded as a file's upload date."""
+    moment = (datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc) if timestamp is not None
+              else datetime.datetime.now(datetime.timezone.utc))
+    return moment.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def file_metadata(rel_path: str, upload_date: str) -> Dict[str, str]:
+    """Chunk metadata describing the file a chunk came from."""
+    path = PurePosixPath(PurePath(rel_path).as_posix())
+    folder = str(path.parent)
+    return {
+        "file_path": str(path),
+        "file_type": path.suffix.lstrip(".").lower(),
+        "folder": "" if folder == "." else folder,
+        "upload_date": upload_date
+    }
+
+
+def normalize_filters(filters: Optional[Mapping[str, Any]]) -> Tuple:
+    """
+    Validate a filter dictionary and return it as a hashable, order-independent
+    tuple (empty if there is nothing to filter on), usable as a cache key.
+    """
+    if not filters:
+        return ()
+    normalized = []
+    for field, value in filters.items():
+        if field not in FILTER_FIELDS:
+            raise ValueError(f"Unknown filter field {field!r}; expected one of {', '.join(FILTER_FIELDS)}")
+        if value is None:
+            continue
+        if field in DATE_FIELDS:
+            normalized.append((field, str(value)))
+            continue
+        values = [value] if isinstance(value, str) else list(value)
+        if field == "file_type":
+            values = [v.lstrip(".").lower() for v in values]
+        elif field == "folder":
+            values = [PurePath(v).as_posix().strip("/") for v in values]
+        normalized.append((field, tuple(sorted(set(values)))))
+    return tuple(sorted(normalized))
+
+
+class MetadataIndex:
+    """
+    Inverted index from metadata values to files, and from files to the FAISS
+    positions of their child vectors. Built once per index version.
+    """
+
+    def __init__(self, files: Mapping[str, Dict[str, Any]], positions: Mapping[str, int]):
+        """
+        Args:
+            files: Manifest "files" mapping (relative path -> entry with child "ids"
+                and the child ids of its "duplicates")
+            positions: Child vector id -> FAISS position
+        """
+        self._files = {}
+        self._values = {field: {} for field in VALUE_FIELDS}
+        for rel_path, entry in files.items():
+            metadata = file_metadata(rel_path, entry.get("upload_date") or upload_timestamp(entry.get("mtime", 0)))
+            # Chunks the file shares with other files count as the file's own
+            ids = entry.get("ids", []) + [doc_id for child_ids in entry.get("duplicates", {}).values()
+                                          for doc_id in child_ids]
+            self._files[rel_path] = (
+                metadata,
+                np.fromiter((positions[doc_id] for doc_id in ids if doc_id in positions), dtype=np.int64)
+            )
+            self._values["source"].setdefault(metadata["file_path"], set()).add(rel_path)
+            self._values["source"].setdefault(PurePosixPath(metadata["file_path"]).name, set()).add(rel_path)
+            self._values["file_type"].setdefault(metadata["file_type"], set()).add(rel_path)
+            # A folder filter matches the folder itself and everything below it
+            folder = PurePosixPath(metadata["folder"]) if metadata["folder"] else None
+            while folder is not None and str(folder) != ".":
+                self._values["folder"].setdefault(str(folder), set()).add(rel_path)
+                folder = folder.parent
+
+    def select(self, filters: Tuple) -> List[str]:
+        """Relative paths of the files matching normalized filters, in manifest order."""
+        selected = set(self._files)
+        for field, value in filters:
+            if field in VALUE_FIELDS:
+                matching = set()
+                for item in value:
+                    matching |= self._values[field].get(item, set())
+                selected &= matching
+            elif field == "uploaded_after":
+                selected = {path for path in selected if self._files[path][0]["upload_date"] >= value}
+            else:
+                # A bare date includes the whole day
+                bound = value + "T99" if "T" not in value else value
+                selected = {path for path in selected if self._files[path][0]["upload_date"] <= bound}
+        return [path for path in self._files if path in selected]
+
+    def positions(self, rel_paths: Iterable[str]) -> np.ndarray:
+        arrays = [self._files[path][1] for path in rel_paths]
+        return np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int64)
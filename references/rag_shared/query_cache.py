@@ -0,0 +1,81 @@
+"""
+Bounded in-memory caches for repeated retrieval queries.
+
+GUI users regenerate the same topic again and again, and every run embeds
+and searches the same query. LRUCache keeps recent answers with both
+size-based (least recently used) and time-based (TTL) eviction and counts
+hits and misses so the hit rate can be reported.
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+DEFAULT_CACHE_SIZE = int(os.getenv("RAG_QUERY_CACHE_SIZE", "256"))
+DEFAULT_CACHE_TTL = float(os.getenv("RAG_QUERY_CACHE_TTL", "3600"))
+
+
+class LRUCache:
+    """Thread-safe LRU cache whose entries also expire after ttl seconds."""
+
+    def __init__(self, max_size: Optional[int] = None, ttl: Optional[float] = None):
+        """
+        Args:
+            max_size (int, optional): Maximum number of entries; 0 disables the cache
+                (defaults to RAG_QUERY_CACHE_SIZE or 256)
+            ttl (float, optional): Seconds an entry stays valid; 0 means no expiry
+                (defaults to RAG_QUERY_CACHE_TTL or 3600)
+        """
+        self.max_size = DEFAULT_CACHE_SIZE if max_size is None else max_size
+        self.ttl = DEFAULT_CACHE_TTL if ttl is None else ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expiry time, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl and entry[0] < time.monotonic():
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Drop every entry (counters are kept)."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0
+            }
@@ -0,0 +1,1816 @@
+"""
+Persistent two-level (parent/child) FAISS index for the reference materials directory.
+
+Each file is split into parent chunks, which are kept in a disk-backed
+key-value docstore, and small child chunks, which are embedded in FAISS and
+point back to their parent. Searches match precise child chunks and return
+the focused parent chunks they belong to.
+
+The child vectors, the docstore and a manifest describing every indexed file
+(path, size, mtime, sha256 and the vector/parent ids it produced) are stored
+next to the materials directory. On start-up the manifest is compared with
+the files on disk and only files whose content hash changed are loaded and
+re-embedded.
+
+Processes that only serve searches (e.g. several GUI workers on one host) can
+open a saved index read-only: the FAISS vectors are memory-mapped and child
+chunks are read from SQLite on demand, so the workers share the OS page cache
+instead of each holding a private copy of the index. Before every search a
+read-only index checks whether the writer has saved a new manifest and
+reopens the index if so, opening only the segments the writer added: the
+writer deletes the parent chunks of replaced files from the shared docstore,
+which the old vectors still point to.
+
+The child vectors are held in a flat (exact) FAISS index by default; an
+approximate IVF/HNSW/PQ index can be selected instead, see vector_index.py.
+The same child chunks are also kept in a BM25 keyword index (keyword_index.py)
+and searches fuse the vector and keyword rankings.
+
+Chunks carry the file type, source path, folder and upload date of their
+file, and searches can be restricted to matching files (metadata_filter.py);
+the filter is applied inside the vector and keyword searches, not afterwards.
+
+Parent chunks that duplicate, exactly or nearly, a chunk already in the index
+are not stored or embedded again (chunk_dedup.py). The manifest entry of the
+file references the canonical chunk instead, and search results list every
+other file a returned chunk also appears in.
+
+The ranked parent chunks are reordered by maximal marginal relevance over
+the vectors of their best matching child chunks (vector_index.mmr_order), so
+near-identical passages do not fill all k result slots.
+
+Searches run against an immutable IndexSnapshot: the vector store, keyword
+postings and manifest of one index version. Changes (uploads, deletions,
+batches from the materials watcher, rebuilds) build a new vector store that
+shares everything they did not touch, and save() publishes them as a new
+snapshot with one reference swap, so a search, or a graph thread between
+planning and drafting, never sees a half applied change and never waits for
+one. Parent chunks that a change deletes stay in the docstore until no search
+of an older snapshot is still running. Returned parent chunks carry the
+"index_version" they were found in, and every result list (SearchResults)
+carries it too, so an empty result still tells which version was searched.
+
+Saves are incremental. The child vectors live in immutable segments
+(index_segments.py): a save writes the chunks it added as one new segment,
+deletions only tombstone vectors in the segments' live masks, and the
+segments are merged in a background thread, a few small ones at a time, so
+each vector is rewritten O(log n) times rather than on every save. Parent
+chunks are written one file each and their duplicate-detection signatures go
+into the segment of their child chunks. The manifest is a checkpoint plus a
+journal: a save appends one line with the file entries it changed, and the
+checkpoint is only rewritten once the journal has grown as large as it. The
+BM25 keyword postings of the chunks are part of their segment too.
+
+Entries the manifest no longer references are garbage collected by
+compact(), which merges every segment without its tombstoned vectors and
+removes orphaned parents (e.g. those whose deferred deletion was cut short by
+a restart), automatically in the background once they pass
+RAG_COMPACT_THRESHOLD of the index (index_compaction.py). Tombstones are
+counted on every save; orphaned parents are counted by walking the whole
+docstore, so that check runs when the index is loaded and after a change
+that failed half way.
+
+Only one writable ReferenceIndex may have an index directory open at a time,
+in this process or any other (read-only ones are not limited): the first one
+takes an exclusive lock on writer.lock in the directory and holds it until
+close(). A second writer fails with a RuntimeError instead of overwriting the
+first one's changes.
+"""
+
+import os
+import json
+import asyncio
+import hashlib
+import itertools
+import uuid
+import shutil
+import threading
+import time
+import weakref
+from pathlib import Path
+from collections import Counter
+from typing import Dict, List, Any, Optional, Iterable, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: only writers in this process are detected
+    fcntl = None
+from langchain_core.documents import Document
+from langchain_community.vectorstores.faiss import dependable_faiss_import
+from langchain.storage import LocalFileStore
+from langchain.storage._lc_store import create_kv_docstore
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from .material_loader import (
+    DEFAULT_INGEST_WINDOW, LOADERS, LoadReport, MaterialFile, load_file, iter_loaded_files, discover_materials
+)
+from .keyword_index import KeywordSnapshot, reciprocal_rank_fusion
+from .metadata_filter import MetadataIndex, file_metadata, normalize_filters, upload_timestamp
+from .chunk_dedup import SIGNATURES_FILE, DedupReport, DuplicateDetector, dedup_default
+from .query_cache import LRUCache
+from .index_compaction import (
+    DEFAULT_THRESHOLD as DEFAULT_COMPACT_THRESHOLD, LATENCY_PROBES, CompactionReport, directory_bytes
+)
+from .index_segments import MAX_SEGMENTS, SEGMENTS_DIR, IndexSegment, SegmentedStore, merge_candidates
+from .vector_index import (
+    INDEX_TYPES, DEFAULT_INDEX_TYPE, DEFAULT_MMR_LAMBDA, build_index, configure_search, effective_index_type,
+    index_type_of, mmr_order, reconstruct
+)
+
+MANIFEST_VERSION = 3
+MANIFEST_FILE = "manifest.json"
+DOCSTORE_DIR = "docstore"
+# Vector files of indexes saved before segments (manifest version 2), removed when the index is rebuilt
+LEGACY_FILES = ("index.faiss", "index.pkl", "children.sqlite", SIGNATURES_FILE)
+# Keyword postings of indexes saved before the postings moved into the segments, removed by the next checkpoint
+LEGACY_KEYWORD_DIR = "keyword"
+# Held by the one writable ReferenceIndex of an index directory
+WRITER_LOCK_FILE = "writer.lock"
+# Metadata key linking a child chunk to its parent in the docstore
+ID_KEY = "doc_id"
+
+# Resolved index directory -> the writable ReferenceIndex holding its writer lock in this process
+_writers = weakref.WeakValueDictionary()
+_writers_lock = threading.Lock()
+
+
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    """Return the sha256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def default_index_dir(materials_dir: str) -> str:
+    """Index directory stored next to (not inside) the materials directory."""
+    materials_path = Path(materials_dir).resolve()
+    return str(materials_path.parent / f"{materials_path.name}_index")
+
+
+def read_only_default() -> bool:
+    """Whether indexes are opened read-only and memory-mapped (RAG_INDEX_READ_ONLY=1)."""
+    return os.getenv("RAG_INDEX_READ_ONLY", "0").lower() in ("1", "true", "yes")
+
+
+def fetch_k_default() -> Optional[int]:
+    """Candidate child chunks per ranking from RAG_FETCH_K (None: 4 * k)."""
+    return int(os.getenv("RAG_FETCH_K", "0")) or None
+
+
+def hybrid_default() -> bool:
+    """Whether searches fuse BM25 keyword and vector rankings (RAG_HYBRID_SEARCH, on by default)."""
+    return os.getenv("RAG_HYBRID_SEARCH", "1").lower() in ("1", "true", "yes")
+
+
+def read_manifest(index_dir: str) -> Tuple[Optional[Dict[str, Any]], int, int]:
+    """
+    Read the saved manifest of an index directory: the checkpoint in manifest.json
+    with the changes from its journal applied.
+
+    A save appends one JSON line to the journal: the index version, the file
+    entries it changed (null for removed files) and, if they changed, the failed
+    files and the segment list. A line cut short by a crash ends the journal.
+
+    Returns:
+        (manifest or None if there is none or it cannot be read, bytes of the
+        journal that were applied, bytes of the journal that were read); the
+        manifest's "retired" lists the segments that journal lines dropped since
+        the checkpoint
+    """
+    try:
+        with open(os.path.join(index_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None, 0, 0
+    except Exception as e:
+        print(f"Error reading index manifest in {index_dir}: {e}")
+        return None, 0, 0
+    manifest.setdefault("retired", [])
+    journal = manifest.get("journal")
+    if not journal:
+        return manifest, 0, 0
+    try:
+        with open(os.path.join(index_dir, journal), "rb") as f:
+            data = f.read()
+    except OSError as e:
+        # The writer replaced the checkpoint while this one was being read
+        print(f"Error reading index journal {journal} in {index_dir}: {e}")
+        return None, 0, 0
+    lines = data.split(b"\n")
+    applied = 0
+    for line in lines[:-1]:
+        try:
+            change = json.loads(line)
+        except ValueError:
+            break
+        applied += len(line) + 1
+        for rel_path, entry in change.get("files", {}).items():
+            if entry is None:
+                manifest["files"].pop(rel_path, None)
+            else:
+                manifest["files"][rel_path] = entry
+        if "failed" in change:
+            manifest["failed"] = change["failed"]
+        if "segments" in change:
+            manifest["retired"] += [name for name in manifest.get("segments", []) if name not in change["segments"]]
+            manifest["segments"] = change["segments"]
+        manifest["index_version"] = change["index_version"]
+    return manifest, applied, len(data)
+
+
+class SearchResults(list):
+    """
+    The parent chunks found for one query, with the version of the index snapshot
+    that was searched; the version is set even when nothing was found.
+    """
+
+    def __init__(self, parents: Iterable[Document] = (), index_version: Optional[int] = None):
+        super().__init__(parents)
+        self.index_version = index_version
+
+
+class IndexSnapshot:
+    """
+    One published version of a ReferenceIndex, as searched: its vector store, keyword
+    postings and manifest files. Nothing in a snapshot is modified after it is published;
+    the lookup tables derived from it are built on first use.
+    """
+
+    def __init__(self, version: int, vectorstore: Optional[SegmentedStore], files: Dict[str, Dict[str, Any]]):
+        self.version = version
+        self.vectorstore = vectorstore
+        self.keyword = vectorstore.keyword if vectorstore is not None else KeywordSnapshot()
+        self.files = files
+        self._lock = threading.Lock()
+        self._metadata_index = None
+        self._positions = None
+        self._duplicate_sources = None
+
+    def metadata_index(self) -> MetadataIndex:
+        """Metadata -> files -> vector positions."""
+        with self._lock:
+            if self._metadata_index is None:
+                self._metadata_index = MetadataIndex(self.files, self._position_map())
+            return self._metadata_index
+
+    def position_map(self) -> Dict[str, int]:
+        """Child id -> vector position of every live child chunk."""
+        with self._lock:
+            return self._position_map()
+
+    def _position_map(self) -> Dict[str, int]:
+        if self._positions is None:
+            store = self.vectorstore
+            self._positions = {}
+            for number, segment in enumerate(store.segments):
+                offset = int(store.offsets[number])
+                for position in np.flatnonzero(store.live[number]):
+                    self._positions[segment.ids[position]] = offset + int(position)
+        return self._positions
+
+    def duplicate_sources(self) -> Dict[str, List[str]]:
+        """Parent id -> the other files that contain the chunk."""
+        with self._lock:
+            if self._duplicate_sources is None:
+                sources = {}
+                for rel_path, entry in self.files.items():
+                    for parent_id in entry.get("duplicates", {}):
+                        sources.setdefault(parent_id, []).append(rel_path)
+                self._duplicate_sources = sources
+            return self._duplicate_sources
+
+
+class ReferenceIndex:
+    """
+    Parent/child FAISS index over a materials directory that persists between runs.
+    """
+
+    def __init__(self, materials_dir: str, embeddings, index_dir: Optional[str] = None,
+                 load_workers: Optional[int] = None, ingest_window: Optional[int] = None,
+                 parent_splitter=None, child_splitter=None, read_only: Optional[bool] = None,
+                 index_type: Optional[str] = None, nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                 hybrid: Optional[bool] = None, dedup_chunks: Optional[bool] = None,
+                 fetch_k: Optional[int] = None, mmr_lambda: Optional[float] = None,
+                 compact_threshold: Optional[float] = None):
+        """
+        Initialize the reference index.
+
+        Args:
+            materials_dir (str): Directory containing reference materials
+            embeddings: Embeddings object used to embed the documents
+            index_dir (str, optional): Where to persist the index. Defaults to
+                "<materials_dir>_index" next to the materials directory.
+            load_workers (int, optional): Number of processes used to parse files
+            ingest_window (int, optional): Number of files parsed ahead of embedding;
+                bounds peak memory during a build
+            parent_splitter (optional): Splitter for the parent chunks returned by searches
+            child_splitter (optional): Splitter for the child chunks that are embedded
+            read_only (bool, optional): Open the saved index memory-mapped and never
+                modify it (defaults to RAG_INDEX_READ_ONLY). Another process must build it.
+            index_type (str, optional): "flat", "ivf_flat", "hnsw" or "ivf_pq" (defaults to RAG_INDEX_TYPE)
+            nprobe (int, optional): IVF cells visited per query (defaults to RAG_INDEX_NPROBE)
+            ef_search (int, optional): HNSW candidate list size (defaults to RAG_INDEX_EF_SEARCH)
+            hybrid (bool, optional): Fuse BM25 keyword matches with vector matches
+                (defaults to RAG_HYBRID_SEARCH, on)
+            dedup_chunks (bool, optional): Skip parent chunks that duplicate one already
+                indexed (defaults to RAG_DEDUP_CHUNKS, on)
+            fetch_k (int, optional): Child chunks taken from each ranking as candidates
+                (defaults to RAG_FETCH_K, or 4 * k)
+            mmr_lambda (float, optional): Relevance/diversity trade-off of the MMR reranking;
+                1 keeps the relevance order (defaults to RAG_MMR_LAMBDA or 0.7)
+            compact_threshold (float, optional): Share of orphaned entries from which the index
+                is compacted in the background; 0 turns that off (defaults to RAG_COMPACT_THRESHOLD or 0.2)
+        """
+        self.materials_dir = materials_dir
+        self.embeddings = embeddings
+        self.index_dir = index_dir or default_index_dir(materials_dir)
+        self.load_workers = load_workers
+        self.ingest_window = ingest_window
+        self.parent_splitter = parent_splitter or RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200)
+        self.child_splitter = child_splitter or RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
+        self.read_only = read_only_default() if read_only is None else read_only
+        self.index_type = (index_type or DEFAULT_INDEX_TYPE).lower()
+        if self.index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type {self.index_type!r}; expected one of {', '.join(INDEX_TYPES)}")
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.hybrid = hybrid_default() if hybrid is None else hybrid
+        self.dedup_chunks = dedup_default() if dedup_chunks is None else dedup_chunks
+        self.fetch_k = fetch_k or fetch_k_default()
+        self.mmr_lambda = DEFAULT_MMR_LAMBDA if mmr_lambda is None else mmr_lambda
+        self.compact_threshold = DEFAULT_COMPACT_THRESHOLD if compact_threshold is None else compact_threshold
+        self.vectorstore = None
+        # Child chunks added since the last save: (ids, chunks, vectors, new parent ids); save()
+        # writes them as one segment. The vectors cover the chunks embedded so far, in order
+        self._pending = ([], [], [], [])
+        # Parent chunks live on disk, one JSON document per key
+        self.docstore = create_kv_docstore(LocalFileStore(os.path.join(self.index_dir, DOCSTORE_DIR)))
+        # Guards the vector store and manifest against concurrent GUI uploads/deletes
+        self._lock = threading.RLock()
+        self.manifest = {"version": MANIFEST_VERSION, "embedding_model": self._embedding_model(), "files": {}}
+        # Bumped on every save; cached search results are keyed by it
+        self.index_version = 0
+        # Repeated queries skip the embedding call and, until the index changes, the search
+        self.query_embedding_cache = LRUCache()
+        self.result_cache = LRUCache()
+        # What searches see; replaced, never modified, when a change is saved
+        self._snapshot = IndexSnapshot(0, None, {})
+        # Snapshot version -> searches still running on it
+        self._readers = Counter()
+        # Parents deleted by unsaved changes, and (version that deleted them, parent ids)
+        # for parents that searches of older snapshots may still return
+        self._unpublished_deletes = []
+        self._retired_parents = []
+        self._snapshot_lock = threading.Lock()
+        # Exact and MinHash signatures of the parent chunks, checked before a chunk is stored
+        self.duplicate_detector = DuplicateDetector()
+        self.dedup_report = None
+        # Parent id -> child ids, built the first time a duplicate needs them
+        self._parent_children = None
+        # Report of the last compaction, and the thread running one in the background
+        self.last_compaction = None
+        self._compaction_thread = None
+        self._compaction_lock = threading.Lock()
+        # Set when a failed change may have left orphans behind; the next save checks for them
+        self._garbage_suspected = False
+        # Open writer.lock while this index is the directory's writer; close() releases it for good
+        self._writer_lock = None
+        self._closed = False
+        # (mtime, size, inode) of the manifest and journal a read-only index last loaded; changes when the writer saves
+        self._manifest_signature = None
+        # Journal file the manifest's changes are appended to, its size, and the size of the checkpoint
+        self._journal = None
+        self._journal_bytes = 0
+        self._checkpoint_bytes = 0
+        # What the journal line of the next save records: changed file entries, and the failed files and
+        # segment list as last saved. None: the next save writes a checkpoint
+        self._changed_files = None
+        self._saved_failed = {}
+        self._saved_segments = []
+        # Segments dropped since the last checkpoint; their directories are deleted one checkpoint later,
+        # so read-only processes still opening the previous version find them
+        self._retired_segments = []
+        # Segments being written by a merge, and whether signatures were recomputed that no segment holds yet
+        self._merging = set()
+        self._signatures_missing = False
+
+    def _embedding_model(self) -> str:
+        """Name of the embedding model, recorded so a model change forces a rebuild."""
+        return str(getattr(self.embeddings, "model", type(self.embeddings).__name__))
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.index_dir, MANIFEST_FILE)
+
+    def _current_files(self, files: Optional[List[MaterialFile]] = None) -> Dict[str, MaterialFile]:
+        """
+        Relative path -> MaterialFile for the supported files, from the caller's walk of
+        the materials directory if it has one, otherwise from a new one.
+        """
+        if files is None:
+            files = discover_materials(self.materials_dir, LOADERS)
+        return {material.rel_path: material for material in files if material.extension in LOADERS}
+
+    def _load_persisted(self) -> bool:
+        """Load the saved manifest and index. Returns False if they are missing or stale."""
+        # Taken before reading, so a save that lands meanwhile is seen by the next staleness check
+        try:
+            stat = os.stat(self._manifest_path())
+        except OSError:
+            return False
+        manifest, journal_applied, journal_size = read_manifest(self.index_dir)
+        if manifest is None:
+            return False
+
+        if manifest.get("version") != MANIFEST_VERSION or manifest.get("embedding_model") != self._embedding_model():
+            print("Index manifest is from a different version or embedding model. Rebuilding index.")
+            return False
+
+        try:
+            self.vectorstore = self._load_segments(manifest)
+        except Exception as e:
+            print(f"Error loading persisted index from {self.index_dir}: {e}")
+            return False
+        if self.dedup_chunks and not self.read_only:
+            self._load_duplicate_detector(manifest)
+
+        self._retired_segments = manifest.pop("retired")
+        self.manifest = manifest
+        self.index_version = manifest.get("index_version", 0)
+        self.result_cache.clear()
+        self._parent_children = None
+        self._pending = ([], [], [], [])
+        self._journal = manifest.get("journal")
+        self._journal_bytes = journal_applied
+        self._checkpoint_bytes = stat.st_size
+        # A journal whose last line was cut short cannot be appended to; the next save starts a new one
+        self._changed_files = set() if journal_applied == journal_size else None
+        self._saved_failed = dict(manifest.get("failed", {}))
+        self._saved_segments = list(manifest.get("segments", []))
+        self._manifest_signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino, journal_size)
+        self._publish()
+        return True
+
+    def _read_manifest_signature(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(self._manifest_path())
+        except OSError:
+            return None
+        try:
+            journal_size = os.path.getsize(os.path.join(self.index_dir, self._journal)) if self._journal else 0
+        except OSError:
+            journal_size = None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino, journal_size
+
+    def _reload_if_stale(self) -> bool:
+        """
+        Reopen a read-only index if the writer process has saved a new version since it
+        was loaded; two stat calls when nothing changed. Returns True if it was reopened.
+        """
+        if not self.read_only or self._read_manifest_signature() == self._manifest_signature:
+            return False
+        with self._lock:
+            if self._read_manifest_signature() == self._manifest_signature:
+                return False
+            previous = self.index_version
+            if not self._load_persisted():
+                return False
+            print(f"Reopened index {self.index_dir} at version {self.index_version} (was {previous})")
+            return True
+
+    def _load_segments(self, manifest: Dict[str, Any]) -> Optional[SegmentedStore]:
+        """
+        Open the segments the manifest lists (memory-mapped in read-only mode), with
+        every chunk the manifest no longer references tombstoned. Segments this index
+        already has open are reused, since a segment never changes once written, so
+        reopening after a save only reads the segments it added.
+        """
+        live_ids = {doc_id for entry in manifest.get("files", {}).values() for doc_id in entry.get("ids", [])}
+        opened = {}
+        if self.vectorstore is not None:
+            opened = {segment.name: segment for segment in self.vectorstore.segments}
+        segments, live = [], []
+        for name in manifest.get("segments", []):
+            segment = opened.get(name)
+            if segment is None:
+                segment = IndexSegment.load(os.path.join(self.index_dir, SEGMENTS_DIR, name), mmap=self.read_only)
+                configure_search(segment.index, self.nprobe, self.ef_search)
+            mask = np.fromiter((doc_id in live_ids for doc_id in segment.ids), dtype=bool, count=len(segment))
+            if mask.any():
+                segments.append(segment)
+                live.append(mask)
+        return SegmentedStore(segments, live) if segments else None
+
+    def _load_duplicate_detector(self, manifest: Dict[str, Any]):
+        """
+        Load the parent chunk signatures saved with the segments, computing those that
+        are missing (e.g. parents added while deduplication was off).
+        """
+        self.duplicate_detector.reset()
+        for name in manifest.get("segments", []):
+            self.duplicate_detector.load(os.path.join(self.index_dir, SEGMENTS_DIR, name, SIGNATURES_FILE))
+        parent_ids = [parent_id for entry in manifest.get("files", {}).values()
+                      for parent_id in entry.get("parent_ids", [])]
+        # Segments keep the signatures of parents deleted after they were written
+        self.duplicate_detector.remove(self.duplicate_detector.parent_ids() - set(parent_ids))
+        known = self.duplicate_detector.parent_ids()
+        missing = [parent_id for parent_id in parent_ids if parent_id not in known]
+        if not missing:
+            return
+        print(f"Computing duplicate-detection signatures for {len(missing)} parent chunks")
+        for parent_id, parent in zip(missing, self.docstore.mget(missing)):
+            if parent is not None:
+                self.duplicate_detector.add(parent_id, parent.page_content)
+        # Saved by merging the segments, which writes the signatures of all their parents
+        self._signatures_missing = True
+
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError(f"Reference index {self.index_dir} is opened read-only")
+        if self._closed:
+            raise RuntimeError(f"Reference index {self.index_dir} is closed")
+        self._acquire_writer_lock()
+
+    def _acquire_writer_lock(self):
+        """
+        Become the only writer of the index directory. Raises RuntimeError if another
+        ReferenceIndex, in this process or another one, has it open for writing.
+        """
+        if self._writer_lock is not None:
+            return
+        os.makedirs(self.index_dir, exist_ok=True)
+        key = os.path.realpath(self.index_dir)
+        with _writers_lock:
+            if self._writer_lock is not None:
+                return
+            other = _writers.get(key)
+            if other is not None and other is not self:
+                raise RuntimeError(f"Reference index {self.index_dir} is already open for writing in this process")
+            handle = open(os.path.join(self.index_dir, WRITER_LOCK_FILE), "a")
+            if fcntl is not None:
+                try:
+                    # Released by the OS if the process dies, so a crash never leaves it held
+                    fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    handle.close()
+                    raise RuntimeError(f"Reference index {self.index_dir} is open for writing in another process")
+            _writers[key] = self
+            self._writer_lock = handle
+
+    def close(self):
+        """
+        Release the index directory so another ReferenceIndex can write to it, e.g. after
+        the index was unloaded from memory. Searches keep working; changes raise RuntimeError.
+        """
+        thread = self._compaction_thread
+        if thread is not None and thread.is_alive():
+            thread.join()
+        with self._lock:
+            self._closed = True
+            if self._writer_lock is None:
+                return
+            with _writers_lock:
+                key = os.path.realpath(self.index_dir)
+                if _writers.get(key) is self:
+                    del _writers[key]
+                self._writer_lock.close()
+                self._writer_lock = None
+
+    def save(self):
+        """
+        Persist the changes made since the last save, then publish them to searches.
+
+        Parent chunks are written to the docstore as they are added, one file each.
+        The child chunks added since the last save are written as one new segment,
+        with their keyword postings and the duplicate signatures of their parents;
+        deletions only tombstone chunks, which the manifest records. The manifest
+        change is appended to the journal, or the whole manifest is written as a new
+        checkpoint once the journal has grown as large as the last one.
+        """
+        self._check_writable()
+        os.makedirs(self.index_dir, exist_ok=True)
+        self._write_pending_segment()
+        self.index_version += 1
+        self.manifest["index_version"] = self.index_version
+        self.result_cache.clear()
+        # The manifest last, so it never references files that were not written
+        self._write_manifest()
+        self._publish()
+        self._maybe_merge()
+
+    def _segment_name(self) -> str:
+        return f"{self.index_version + 1:08d}-{uuid.uuid4().hex[:8]}"
+
+    def _write_pending_segment(self):
+        """Write the child chunks added since the last save as a new segment of the vector store."""
+        self._embed_pending()
+        ids, chunks, vectors, parent_ids = self._pending
+        if not ids:
+            return
+        index = build_index(np.vstack(vectors), self.index_type, nprobe=self.nprobe, ef_search=self.ef_search)
+        segment = IndexSegment(self._segment_name(), index, ids, chunks)
+        self._write_segment(segment, parent_ids)
+        self._pending = ([], [], [], [])
+        self.vectorstore = (self.vectorstore.with_segment(segment) if self.vectorstore is not None
+                            else SegmentedStore([segment]))
+
+    def _embed_pending(self):
+        """Embed the pending child chunks that have no vector yet, in one embed_documents call."""
+        _, chunks, vectors, _ = self._pending
+        embedded = sum(len(block) for block in vectors)
+        if embedded < len(chunks):
+            texts = [chunk.page_content for chunk in chunks[embedded:]]
+            vectors.append(np.array(self.embeddings.embed_documents(texts), dtype="float32"))
+
+    def _write_segment(self, segment: IndexSegment, parent_ids: Iterable[str]):
+        """Write a segment and the duplicate signatures of its parents to a new directory."""
+        path = os.path.join(self.index_dir, SEGMENTS_DIR, segment.name)
+        # Renamed once complete; a crash leaves a .tmp directory that the next checkpoint removes
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        segment.save(tmp_path)
+        if self.dedup_chunks:
+            self.duplicate_detector.save(os.path.join(tmp_path, SIGNATURES_FILE), parent_ids)
+        os.replace(tmp_path, path)
+
+    def _file_changed(self, rel_path: str):
+        """Record a changed manifest entry for the journal line of the next save."""
+        if self._changed_files is not None:
+            self._changed_files.add(rel_path)
+
+    def _write_manifest(self):
+        """Append the manifest changes since the last save to the journal, or write a checkpoint."""
+        segments = self.vectorstore.names() if self.vectorstore is not None else []
+        self._retired_segments += [name for name in self._saved_segments if name not in segments]
+        self.manifest["segments"] = segments
+        failed = self.manifest.get("failed", {})
+        # Retired segment directories are only deleted by checkpoints, so many of them call for one
+        if (self._changed_files is None or self._journal_bytes >= self._checkpoint_bytes
+                or len(self._retired_segments) >= MAX_SEGMENTS):
+            self._write_checkpoint()
+        else:
+            files = self.manifest.get("files", {})
+            change = {"index_version": self.index_version,
+                      "files": {rel_path: files.get(rel_path) for rel_path in self._changed_files}}
+            if failed != self._saved_failed:
+                change["failed"] = failed
+            if segments != self._saved_segments:
+                change["segments"] = segments
+            line = (json.dumps(change) + "\n").encode("utf-8")
+            with open(os.path.join(self.index_dir, self._journal), "ab") as f:
+                f.write(line)
+            self._journal_bytes += len(line)
+        self._changed_files = set()
+        self._saved_failed = dict(failed)
+        self._saved_segments = segments
+
+    def _write_checkpoint(self):
+        """
+        Write the whole manifest, pointing at a new empty journal, and delete the segments
+        and journals that neither this version nor the previous checkpoint's use.
+        """
+        journal = f"journal-{uuid.uuid4().hex[:12]}.jsonl"
+        # Created first: a reader that sees the new manifest must find its journal
+        open(os.path.join(self.index_dir, journal), "wb").close()
+        self.manifest["journal"] = journal
+        tmp_path = self._manifest_path() + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self._manifest_path())
+        previous_journal, self._journal = self._journal, journal
+        self._journal_bytes = 0
+        self._checkpoint_bytes = os.path.getsize(self._manifest_path())
+
+        keep = set(self.manifest["segments"]) | set(self._retired_segments) | self._merging
+        self._retired_segments = []
+        segments_dir = os.path.join(self.index_dir, SEGMENTS_DIR)
+        for name in os.listdir(segments_dir) if os.path.isdir(segments_dir) else []:
+            if name not in keep and name.removesuffix(".tmp") not in self._merging:
+                shutil.rmtree(os.path.join(segments_dir, name), ignore_errors=True)
+        for name in os.listdir(self.index_dir):
+            if name.startswith("journal-") and name not in (journal, previous_journal):
+                os.remove(os.path.join(self.index_dir, name))
+        shutil.rmtree(os.path.join(self.index_dir, LEGACY_KEYWORD_DIR), ignore_errors=True)
+
+    def snapshot(self) -> IndexSnapshot:
+        """The snapshot new searches use; its version is the index_version they report."""
+        return self._snapshot
+
+    def _publish(self):
+        """Swap in a snapshot of the current state for new searches (caller holds the index lock)."""
+        # Manifest entries are replaced, never modified, so the snapshot can share them
+        snapshot = IndexSnapshot(self.index_version, self.vectorstore, dict(self.manifest.get("files", {})))
+        with self._snapshot_lock:
+            self._snapshot = snapshot
+            if self._unpublished_deletes:
+                self._retired_parents.append((snapshot.version, self._unpublished_deletes))
+                self._unpublished_deletes = []
+            purge = self._collect_retired()
+        if purge:
+            self.docstore.mdelete(purge)
+        if self._garbage_suspected:
+            self._garbage_suspected = False
+            self._maybe_compact()
+
+    def _acquire_snapshot(self) -> IndexSnapshot:
+        with self._snapshot_lock:
+            snapshot = self._snapshot
+            self._readers[snapshot.version] += 1
+            return snapshot
+
+    def _release_snapshot(self, snapshot: IndexSnapshot):
+        with self._snapshot_lock:
+            self._readers[snapshot.version] -= 1
+            if self._readers[snapshot.version] <= 0:
+                del self._readers[snapshot.version]
+            purge = self._collect_retired()
+        if purge:
+            self.docstore.mdelete(purge)
+
+    def _collect_retired(self) -> List[str]:
+        """
+        Take the retired parents no running search can return any more: those deleted
+        by a version newer than every snapshot still in use (caller holds _snapshot_lock).
+        """
+        oldest = min(self._readers, default=None)
+        purge, waiting = [], []
+        for version, parent_ids in self._retired_parents:
+            if oldest is None or oldest >= version:
+                purge.extend(parent_ids)
+            else:
+                waiting.append((version, parent_ids))
+        self._retired_parents = waiting
+        return purge
+
+    def _delete_entries(self, entries: List[Dict[str, Any]],
+                        live_files: Optional[Dict[str, Dict[str, Any]]] = None) -> int:
+        """
+        Remove the child vectors and parent chunks of several files at once.
+
+        A parent chunk that one of the remaining files (live_files) duplicates is
+        handed over to that file, with its child vectors, instead of being deleted.
+
+        Returns:
+            int: Number of child vectors removed
+        """
+        removed_parents = {parent_id for entry in entries for parent_id in entry.get("parent_ids", [])}
+        kept_ids = set()
+        new_owners = {}
+        replaced = {}
+        for rel_path, entry in (live_files or {}).items():
+            shared = [parent_id for parent_id in entry.get("duplicates", {}) if parent_id in removed_parents]
+            if not shared:
+                continue
+            # Entries are replaced, never modified: published snapshots share them
+            entry = dict(entry, ids=list(entry["ids"]), parent_ids=list(entry["parent_ids"]),
+                         duplicates=dict(entry["duplicates"]))
+            for parent_id in shared:
+                child_ids = entry["duplicates"].pop(parent_id)
+                entry["parent_ids"].append(parent_id)
+                entry["ids"].extend(child_ids)
+                removed_parents.discard(parent_id)
+                kept_ids.update(child_ids)
+                new_owners[parent_id] = (rel_path, entry)
+            replaced[rel_path] = entry
+        for rel_path, entry in replaced.items():
+            live_files[rel_path] = entry
+            self._file_changed(rel_path)
+        if new_owners:
+            # Handed-over parents now describe their new file
+            handed_over = []
+            for parent_id, parent in zip(new_owners, self.docstore.mget(list(new_owners))):
+                if parent is None:
+                    continue
+                rel_path, entry = new_owners[parent_id]
+                parent.metadata.update(file_metadata(rel_path, entry.get("upload_date", "")),
+                                       source=os.path.join(self.materials_dir, rel_path))
+                handed_over.append((parent_id, parent))
+            self.docstore.mset(handed_over)
+
+        ids = [doc_id for entry in entries for doc_id in entry.get("ids", []) if doc_id not in kept_ids]
+        self._delete_vectors(ids)
+        parent_ids = [parent_id for entry in entries for parent_id in entry.get("parent_ids", [])
+                      if parent_id in removed_parents]
+        # Searches of the current snapshot may still return these; they are deleted
+        # once no search of a snapshot older than the next save is running
+        self._unpublished_deletes.extend(parent_ids)
+        self.duplicate_detector.remove(parent_ids)
+        if self._parent_children is not None:
+            for parent_id in parent_ids:
+                self._parent_children.pop(parent_id, None)
+        return len(ids)
+
+    def _delete_vectors(self, ids: List[str]):
+        """Drop child chunks that are not saved yet and tombstone the saved ones."""
+        if not ids:
+            return
+        ids = set(ids)
+        pending_ids, chunks, vectors, parent_ids = self._pending
+        if any(doc_id in ids for doc_id in pending_ids):
+            keep = [i for i, doc_id in enumerate(pending_ids) if doc_id not in ids]
+            # Chunks not embedded yet have no row
+            embedded = np.vstack(vectors) if vectors else None
+            rows = [i for i in keep if embedded is not None and i < len(embedded)]
+            self._pending = ([pending_ids[i] for i in keep], [chunks[i] for i in keep],
+                             [embedded[rows]] if embedded is not None else [], parent_ids)
+        if self.vectorstore is not None:
+            store, _ = self.vectorstore.without(ids)
+            self.vectorstore = store if len(store) else None
+
+    def _merge_segments(self, segments: List[IndexSegment]) -> bool:
+        """
+        Replace segments of the vector store with one segment holding their live
+        chunks, and save. The new segment is built and written
+        without holding the index lock, so changes and searches go on meanwhile;
+        chunks those changes delete are tombstoned in it when it is swapped in.
+
+        Returns:
+            bool: False if the segments were replaced by another merge meanwhile
+        """
+        with self._lock:
+            store = self.vectorstore
+            if store is None:
+                return False
+            masks = {segment.name: mask for segment, mask in zip(store.segments, store.live)}
+            name = self._segment_name()
+            # Kept by checkpoints written while the segment is being built
+            self._merging.add(name)
+        try:
+            merged = self._build_merged_segment(name, segments, [masks[segment.name] for segment in segments])
+            if merged is not None:
+                parent_ids = dict.fromkeys(chunk.metadata.get(ID_KEY) for chunk in merged.chunks())
+                self._write_segment(merged, parent_ids)
+            with self._lock:
+                store = self.vectorstore
+                if store is None or any(segment not in store.segments for segment in segments):
+                    return False
+                if merged is None:
+                    store, _ = store.without(doc_id for segment in segments for doc_id in segment.ids)
+                else:
+                    store = store.replace(segments, merged)
+                self.vectorstore = store if len(store) else None
+                self.save()
+                return True
+        finally:
+            with self._lock:
+                self._merging.discard(name)
+
+    def _build_merged_segment(self, name: str, segments: List[IndexSegment],
+                              masks: List[np.ndarray]) -> Optional[IndexSegment]:
+        """
+        Build one segment, of the configured index type, from the live chunks of several.
+
+        Vectors are read back from the segments rather than embedded again, and an
+        IVF index that keeps its type and size reuses its trained cells. Only leaving
+        IVF-PQ, which stores compressed vectors, embeds the chunks again (served by
+        the embedding cache).
+        """
+        ids, chunks, parts = [], [], []
+        wanted = effective_index_type(sum(int(mask.sum()) for mask in masks), self.index_type)
+        for segment, mask in zip(segments, masks):
+            positions = [int(position) for position in np.flatnonzero(mask)]
+            if not positions:
+                continue
+            segment_chunks = [segment.chunk(position) for position in positions]
+            ids += [segment.ids[position] for position in positions]
+            chunks += segment_chunks
+            if index_type_of(segment.index) == "ivf_pq" and wanted != "ivf_pq":
+                parts.append(np.array(self.embeddings.embed_documents([chunk.page_content for chunk in segment_chunks]),
+                                      dtype="float32"))
+            else:
+                parts.append(reconstruct(segment.index, positions))
+        if not ids:
+            return None
+
+        vectors = np.ascontiguousarray(np.vstack(parts), dtype="float32")
+        largest = max(segments, key=len)
+        if index_type_of(largest.index) == wanted and wanted in ("ivf_flat", "ivf_pq") and len(ids) <= 2 * len(largest):
+            # Same cells and codebooks, refilled with the kept vectors; no k-means run
+            faiss = dependable_faiss_import()
+            index = faiss.clone_index(largest.index)
+            faiss.extract_index_ivf(index).set_direct_map_type(faiss.DirectMap.NoMap)
+            index.reset()
+            index.add(vectors)
+            configure_search(index, self.nprobe, self.ef_search)
+        else:
+            index = build_index(vectors, self.index_type, nprobe=self.nprobe, ef_search=self.ef_search)
+        return IndexSegment(name, index, ids, chunks)
+
+    def _ensure_index_type(self) -> bool:
+        """
+        Merge the segments into one of the configured index type if the largest one
+        was built as another type. Returns True if they were merged.
+        """
+        if self.vectorstore is None:
+            return False
+        largest = max(self.vectorstore.segments, key=len)
+        wanted = effective_index_type(len(largest), self.index_type)
+        if index_type_of(largest.index) == wanted:
+            return False
+        print(f"Building {effective_index_type(len(self.vectorstore), self.index_type)} index "
+              f"over {len(self.vectorstore)} child vectors")
+        return self._merge_segments(list(self.vectorstore.segments))
+
+    def _reset_storage(self):
+        """Drop a stale index so parents and vectors from an older format are not left behind."""
+        self.vectorstore = None
+        self._pending = ([], [], [], [])
+        self.duplicate_detector.reset()
+        self._parent_children = None
+        self._changed_files = None
+        self._saved_segments = []
+        self._retired_segments = []
+        shutil.rmtree(os.path.join(self.index_dir, DOCSTORE_DIR), ignore_errors=True)
+        shutil.rmtree(os.path.join(self.index_dir, SEGMENTS_DIR), ignore_errors=True)
+        for name in LEGACY_FILES:
+            if os.path.exists(os.path.join(self.index_dir, name)):
+                os.remove(os.path.join(self.index_dir, name))
+
+    def _index_documents(self, documents: List[Any], rel_path: str, upload_date: str,
+                         report: Optional[DedupReport] = None, embed: bool = True) -> Dict[str, Any]:
+        """
+        Split documents into parent and child chunks, store the parents in the
+        docstore and embed the children.
+
+        Parent chunks that duplicate one already in the index are skipped and
+        recorded as references to the canonical chunk.
+
+        Args:
+            documents: Documents loaded from one file
+            rel_path: Path of the file relative to the materials directory
+            upload_date: Recorded in the chunk metadata (see metadata_filter.file_metadata)
+            report: Collects the duplicates that were skipped
+            embed: Embed the children now; otherwise they wait for _embed_pending(), so
+                the children of several files are embedded in one call
+
+        Returns:
+            dict with the child vector "ids" and the "parent_ids" that were created and,
+            if any parents were skipped, "duplicates": canonical parent id -> its child ids
+        """
+        metadata = file_metadata(rel_path, upload_date)
+        for document in documents:
+            document.metadata.update(metadata)
+        parents = self.parent_splitter.split_documents(documents)
+
+        new_parents = {}
+        duplicates = {}
+        counts = {"exact": 0, "near": 0}
+        repeats = 0
+        for parent in parents:
+            parent_id = str(uuid.uuid4())
+            if self.dedup_chunks:
+                canonical, kind, digest, signature = self.duplicate_detector.find(parent.page_content)
+                if canonical is not None:
+                    counts[kind] += 1
+                    if canonical in new_parents:
+                        # A repeat within this same file needs no reference; the file owns the chunk
+                        repeats += 1
+                    elif canonical not in duplicates:
+                        duplicates[canonical] = self._children_of(canonical)
+                    continue
+                self.duplicate_detector.add(parent_id, parent.page_content, digest, signature)
+            new_parents[parent_id] = parent
+
+        if report is not None:
+            canonical_files = [
+                parent.metadata.get("file_path") or Path(parent.metadata.get("source", "unknown")).name
+                for parent in self.docstore.mget(list(duplicates)) if parent is not None
+            ]
+            if repeats:
+                canonical_files.append(rel_path)
+            report.add_file(rel_path, len(parents), counts["exact"], counts["near"], canonical_files)
+
+        result = {"ids": [], "parent_ids": list(new_parents)}
+        if duplicates:
+            result["duplicates"] = duplicates
+        if not new_parents:
+            return result
+
+        children = []
+        for parent_id, parent in new_parents.items():
+            for child in self.child_splitter.split_documents([parent]):
+                child.metadata[ID_KEY] = parent_id
+                children.append(child)
+
+        self.docstore.mset(list(new_parents.items()))
+
+        ids = [str(uuid.uuid4()) for _ in children]
+        for doc_id, child in zip(ids, children):
+            child.id = doc_id
+        # Written as one new segment by the next save
+        pending_ids, pending_chunks, _, pending_parents = self._pending
+        pending_ids.extend(ids)
+        pending_chunks.extend(children)
+        pending_parents.extend(new_parents)
+        if embed:
+            self._embed_pending()
+        if self._parent_children is not None:
+            for doc_id, child in zip(ids, children):
+                self._parent_children.setdefault(child.metadata[ID_KEY], []).append(doc_id)
+        result["ids"] = ids
+        return result
+
+    def _children_of(self, parent_id: str) -> List[str]:
+        """Child vector ids of a parent chunk."""
+        if self._parent_children is None:
+            self._parent_children = {}
+            saved = self.vectorstore.chunks() if self.vectorstore is not None else ()
+            pending = zip(self._pending[0], self._pending[1])
+            for doc_id, child in itertools.chain(saved, pending):
+                self._parent_children.setdefault(child.metadata.get(ID_KEY), []).append(doc_id)
+        return list(self._parent_children.get(parent_id, []))
+
+    def load_or_build(self, files: Optional[List[MaterialFile]] = None):
+        """
+        Load the persisted index and bring it up to date with the materials directory.
+
+        Unchanged files (same size and mtime, or same sha256) are reused as-is;
+        new and modified files are loaded and embedded; vectors of removed files
+        are deleted.
+
+        Args:
+            files: Result of discover_materials() for the materials directory, if the
+                caller already walked it; otherwise the directory is walked here
+
+        Returns:
+            The SegmentedStore of child vectors, or None if there are no documents to index
+        """
+        with self._lock:
+            vectorstore = self._load_or_build(files)
+        # Orphans come from interrupted runs and failed changes; finding them walks the
+        # whole docstore, so it is done once per load rather than after every save
+        self._maybe_compact()
+        return vectorstore
+
+    def _load_or_build(self, files: Optional[List[MaterialFile]] = None):
+        if self.read_only:
+            # Serve whatever the writer process saved last; never rebuild here
+            if not self._load_persisted():
+                print(f"No usable index in {self.index_dir}; it must be built by a writable process first")
+                return None
+            print(f"Opened index with {len(self.manifest.get('files', {}))} files read-only from {self.index_dir}")
+            return self.vectorstore
+
+        self._check_writable()
+        if not self._load_persisted():
+            self._reset_storage()
+
+        old_files = self.manifest.get("files", {})
+        old_failed = self.manifest.get("failed", {})
+        current_files = self._current_files(files)
+        new_manifest_files = {}
+        failed = {}
+        to_index = {}
+        stale_entries = []
+
+        for rel_path, material in current_files.items():
+            entry = old_files.get(rel_path)
+
+            # Files that failed to load are not parsed again until they change; an
+            # earlier version that did load stays indexed
+            if self._known_failure(old_failed.get(rel_path), material.size, material.mtime):
+                failed[rel_path] = old_failed[rel_path]
+                if entry:
+                    new_manifest_files[rel_path] = entry
+                continue
+
+            # Fast path: size and mtime unchanged means the file was not touched
+            if entry and entry["size"] == material.size and entry["mtime"] == material.mtime:
+                new_manifest_files[rel_path] = entry
+                continue
+
+            digest = file_sha256(material.path)
+            if entry and entry["sha256"] == digest:
+                new_manifest_files[rel_path] = dict(entry, size=material.size, mtime=material.mtime)
+                continue
+
+            if entry:
+                stale_entries.append(entry)
+            to_index[rel_path] = {"path": material.path, "size": material.size, "mtime": material.mtime, "sha256": digest}
+
+        removed = [rel_path for rel_path in old_files if rel_path not in current_files]
+        for rel_path in removed:
+            stale_entries.append(old_files[rel_path])
+
+        if not to_index and not removed and new_manifest_files == old_files and failed == old_failed:
+            if not new_manifest_files:
+                return None
+            print(f"Loaded persisted index with {len(new_manifest_files)} files from {self.index_dir}")
+            if not self._ensure_index_type():
+                self._maybe_merge()
+            return self.vectorstore
+
+        print(f"Index update: {len(to_index)} new or changed files, {len(removed)} removed, "
+              f"{len(new_manifest_files)} unchanged, {len(failed)} skipped after failing to load")
+
+        self._delete_entries(stale_entries, new_manifest_files)
+
+        # Streaming pipeline: files are parsed in parallel a window at a time and each
+        # file is split and released as soon as it is parsed; the child chunks of a
+        # window of files are embedded together in one call
+        report = LoadReport()
+        self.dedup_report = DedupReport()
+        rel_paths = {info["path"]: rel_path for rel_path, info in to_index.items()}
+        window = max(1, self.ingest_window or DEFAULT_INGEST_WINDOW)
+        unembedded = 0
+        for path, documents, error in iter_loaded_files(rel_paths, self.load_workers, self.ingest_window):
+            if error:
+                report.add_error(path, error)
+                info = to_index[rel_paths[path]]
+                failed[rel_paths[path]] = {"size": info["size"], "mtime": info["mtime"], "error": error}
+                continue
+            report.add_success(path, documents)
+            rel_path = rel_paths[path]
+            info = to_index[rel_path]
+            upload_date = upload_timestamp()
+            new_manifest_files[rel_path] = dict({
+                "size": info["size"],
+                "mtime": info["mtime"],
+                "sha256": info["sha256"],
+                "upload_date": upload_date
+            }, **self._index_documents(documents, rel_path, upload_date, self.dedup_report, embed=False))
+            unembedded += 1
+            if unembedded >= window:
+                self._embed_pending()
+                unembedded = 0
+        self._embed_pending()
+        print(report.summary())
+        if self.dedup_chunks:
+            print(self.dedup_report.summary())
+
+        self.manifest = {
+            "version": MANIFEST_VERSION,
+            "embedding_model": self._embedding_model(),
+            "files": new_manifest_files,
+            "failed": failed
+        }
+        # Written whole, as a new checkpoint
+        self._changed_files = None
+
+        if not any(entry["ids"] for entry in new_manifest_files.values()):
+            self.vectorstore = None
+            self._pending = ([], [], [], [])
+
+        self.save()
+        self._ensure_index_type()
+        return self.vectorstore
+
+    def _rel_path(self, path: str) -> str:
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.materials_dir))
+
+    def add_file(self, path: str) -> int:
+        """
+        Index a single new or modified file without touching the rest of the corpus.
+
+        Args:
+            path (str): Path of the file inside the materials directory
+
+        Returns:
+            int: Number of vectors added for the file (0 if unsupported or unchanged)
+        """
+        self._check_writable()
+        if Path(path).suffix.lower() not in LOADERS:
+            return 0
+
+        with self._lock:
+            try:
+                added = self._add_file(path)
+            except Exception:
+                # Parents stored before the failure are orphans now
+                self._garbage_suspected = True
+                raise
+            self.save()
+            return added or 0
+
+    def _add_file(self, path: str) -> Optional[int]:
+        """Index a file without saving; returns None if its content is unchanged."""
+        rel_path = self._rel_path(path)
+        stat = os.stat(path)
+        digest = file_sha256(path)
+
+        files = self.manifest.setdefault("files", {})
+        entry = files.get(rel_path)
+        self._file_changed(rel_path)
+        if entry and entry["sha256"] == digest:
+            files[rel_path] = dict(entry, size=stat.st_size, mtime=stat.st_mtime)
+            return None
+
+        documents = load_file(path)
+        if entry:
+            # Dropped from the manifest first, so a failure below leaves the file unindexed, not stale
+            del files[rel_path]
+            self._delete_entries([entry], files)
+        upload_date = upload_timestamp()
+        self.dedup_report = DedupReport()
+        files[rel_path] = dict({
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha256": digest,
+            "upload_date": upload_date
+        }, **self._index_documents(documents, rel_path, upload_date, self.dedup_report))
+        self.manifest.get("failed", {}).pop(rel_path, None)
+        if self.dedup_report.files:
+            print(self.dedup_report.summary())
+        return len(files[rel_path]["ids"])
+
+    def remove_file(self, path: str) -> int:
+        """
+        Remove the vectors and parent chunks of a single file from the index.
+
+        Args:
+            path (str): Path of the (possibly already deleted) file inside the materials directory
+
+        Returns:
+            int: Number of vectors removed
+        """
+        self._check_writable()
+        with self._lock:
+            removed = self._remove_file(self._rel_path(path))
+            if removed is None:
+                return 0
+            self.save()
+            return removed
+
+    def _remove_file(self, rel_path: str) -> Optional[int]:
+        """Remove a file's entries without saving; returns None if it was not indexed."""
+        entry = self.manifest.get("files", {}).pop(rel_path, None)
+        if not entry:
+            return None
+        self._file_changed(rel_path)
+        return self._delete_entries([entry], self.manifest["files"])
+
+    def changed_paths(self, files: Optional[List[MaterialFile]] = None) -> List[str]:
+        """
+        Paths of the materials whose size or mtime differ from the manifest, including
+        indexed files that no longer exist; one os.scandir pass, no hashing. Files that
+        failed to load are left out until their size or mtime change.
+
+        Args:
+            files: Result of discover_materials() for the materials directory, if the
+                caller already walked it; otherwise the directory is walked here
+        """
+        current = self._current_files(files)
+        with self._lock:
+            indexed = self.manifest.get("files", {})
+            failed = self.manifest.get("failed", {})
+            changed = []
+            for rel_path, material in current.items():
+                if self._known_failure(failed.get(rel_path), material.size, material.mtime):
+                    continue
+                entry = indexed.get(rel_path)
+                if entry is None or (entry["size"], entry["mtime"]) != (material.size, material.mtime):
+                    changed.append(material.path)
+            changed += [os.path.join(self.materials_dir, rel_path) for rel_path in indexed if rel_path not in current]
+        return changed
+
+    def apply_changes(self, paths: Iterable[str]) -> Dict[str, int]:
+        """
+        Bring a batch of paths up to date: existing files are indexed (if new or their
+        content changed) and missing ones are removed. The batch is applied under the
+        index lock and saved once, so searches see either none or all of it and the
+        index version is bumped once per batch.
+
+        Args:
+            paths: Paths inside the materials directory, e.g. from a filesystem watcher
+
+        Returns:
+            Counts of "indexed", "removed", "unchanged" and "failed" files and of
+            "vectors_added" and "vectors_removed"; a file that failed before and has
+            not changed since is counted as unchanged and not parsed again
+        """
+        self._check_writable()
+        result = dict.fromkeys(("indexed", "removed", "unchanged", "failed", "vectors_added", "vectors_removed"), 0)
+        with self._lock:
+            mtimes_before = {rel_path: entry["mtime"] for rel_path, entry in self.manifest.get("files", {}).items()}
+            failed = self.manifest.setdefault("failed", {})
+            failed_before = dict(failed)
+            for path in dict.fromkeys(paths):
+                if Path(path).suffix.lower() not in LOADERS:
+                    continue
+                rel_path = self._rel_path(path)
+                try:
+                    if os.path.isfile(path):
+                        stat = os.stat(path)
+                        if self._known_failure(failed.get(rel_path), stat.st_size, stat.st_mtime):
+                            result["unchanged"] += 1
+                            continue
+                        added = self._add_file(path)
+                        if added is None:
+                            result["unchanged"] += 1
+                        else:
+                            result["indexed"] += 1
+                            result["vectors_added"] += added
+                    else:
+                        failed.pop(rel_path, None)
+                        removed = self._remove_file(rel_path)
+                        if removed is not None:
+                            result["removed"] += 1
+                            result["vectors_removed"] += removed
+                except Exception as e:
+                    result["failed"] += 1
+                    self._garbage_suspected = True
+                    print(f"Error updating the index for {path}: {e}")
+                    if os.path.isfile(path):
+                        # Recorded with the size and mtime it failed at; skipped until they change
+                        stat = os.stat(path)
+                        failed[rel_path] = {"size": stat.st_size, "mtime": stat.st_mtime,
+                                            "error": f"{type(e).__name__}: {e}"}
+
+            mtimes_after = {rel_path: entry["mtime"] for rel_path, entry in self.manifest.get("files", {}).items()}
+            if mtimes_after != mtimes_before or failed != failed_before or result["indexed"] or result["removed"]:
+                self.save()
+        if result["indexed"] or result["removed"] or result["failed"]:
+            print(f"Index update: {result['indexed']} files indexed ({result['vectors_added']} vectors), "
+                  f"{result['removed']} removed ({result['vectors_removed']} vectors), "
+                  f"{result['unchanged']} unchanged, {result['failed']} failed")
+        return result
+
+    @staticmethod
+    def _known_failure(failure: Optional[Dict[str, Any]], size: int, mtime: float) -> bool:
+        """True if a file failed to load before and its size and mtime have not changed since."""
+        return failure is not None and (failure["size"], failure["mtime"]) == (size, mtime)
+
+    def _find_garbage(self) -> Dict[str, set]:
+        """
+        Stored entries the manifest no longer references: "parents" in the docstore,
+        child "vectors" (with their keyword postings) and duplicate "signatures". Parents already
+        waiting for older searches to finish are not garbage.
+        """
+        with self._lock:
+            files = self.manifest.get("files", {})
+            live_parents = {parent_id for entry in files.values() for parent_id in entry.get("parent_ids", [])}
+            live_children = {doc_id for entry in files.values() for doc_id in entry.get("ids", [])}
+            with self._snapshot_lock:
+                scheduled = set(self._unpublished_deletes)
+                scheduled.update(parent_id for _, parent_ids in self._retired_parents for parent_id in parent_ids)
+            vector_ids = set(self.vectorstore.stored_ids()) if self.vectorstore is not None else set()
+            vector_ids.update(self._pending[0])
+            return {
+                "parents": set(self.docstore.yield_keys()) - live_parents - scheduled,
+                "vectors": vector_ids - live_children,
+                "signatures": self.duplicate_detector.parent_ids() - live_parents
+            }
+
+    def garbage_stats(self) -> Dict[str, Any]:
+        """
+        Orphaned entry counts and the tombstone ratio: orphaned parent chunks and
+        child vectors as a share of all the parent chunks and child vectors stored.
+        """
+        with self._lock:
+            garbage = self._find_garbage()
+            stored = self.parent_count() + self.document_count() + len(garbage["parents"]) + len(garbage["vectors"])
+        tombstones = len(garbage["parents"]) + len(garbage["vectors"])
+        return {
+            "orphan_parents": len(garbage["parents"]),
+            "orphan_vectors": len(garbage["vectors"]),
+            "orphan_signatures": len(garbage["signatures"]),
+            "tombstone_ratio": tombstones / stored if stored else 0.0
+        }
+
+    def compact(self) -> CompactionReport:
+        """
+        Merge every segment of the vector store into one without its tombstoned or
+        orphaned vectors and their keyword postings, drop orphaned signatures, and publish
+        the result as a new snapshot; searches keep using the previous snapshot
+        meanwhile, and changes only wait while the orphans are tombstoned and the
+        merged segment is swapped in. Orphaned parent chunks are deleted from disk
+        once no search of an older snapshot is running.
+
+        Returns:
+            CompactionReport with the removed entries and the docstore size, memory
+            and probe search latency before and after
+        """
+        self._check_writable()
+        started = time.perf_counter()
+        with self._lock:
+            garbage = self._find_garbage()
+            report = CompactionReport(self.garbage_stats(), self._compaction_metrics())
+            if report.removed:
+                self._delete_vectors(list(garbage["vectors"]))
+                self.duplicate_detector.remove(garbage["signatures"])
+                self._unpublished_deletes.extend(garbage["parents"])
+                self._parent_children = None
+        if report.removed:
+            merged = False
+            # A merge started by another save may replace the segments first; then merge what it left
+            for _ in range(3):
+                with self._lock:
+                    store = self.vectorstore
+                    segments = list(store.segments) if store is not None and store.ntotal > len(store) else []
+                if not segments:
+                    break
+                merged = self._merge_segments(segments)
+                if merged:
+                    break
+            with self._lock:
+                if not merged:
+                    self.save()
+                report.after = self._compaction_metrics()
+        report.seconds = time.perf_counter() - started
+        self.last_compaction = report
+        if report.removed:
+            print(report.summary())
+        return report
+
+    def compact_in_background(self) -> threading.Thread:
+        """Run compact() on a daemon thread; returns it, or the thread of a compaction already running."""
+        with self._compaction_lock:
+            if self._compaction_thread is None or not self._compaction_thread.is_alive():
+                self._compaction_thread = threading.Thread(target=self._run_compaction, name="index-compaction",
+                                                           daemon=True)
+                self._compaction_thread.start()
+            return self._compaction_thread
+
+    def _run_compaction(self):
+        try:
+            self.compact()
+        except Exception as e:
+            print(f"Error compacting the index in {self.index_dir}: {e}")
+
+    def _maybe_merge(self):
+        """
+        After a save: compact in the background once tombstoned vectors reach the
+        compaction threshold of the stored ones, otherwise merge the segments
+        merge_candidates picks in the background.
+        """
+        store = self.vectorstore
+        if store is None:
+            return
+        # The share of garbage_stats()' tombstone ratio that is known without walking the docstore
+        tombstones = store.ntotal - len(store)
+        if self.compact_threshold > 0 and tombstones >= self.compact_threshold * (store.ntotal + self.parent_count()):
+            self.compact_in_background()
+        elif self._signatures_missing or merge_candidates(store):
+            with self._compaction_lock:
+                if self._compaction_thread is None or not self._compaction_thread.is_alive():
+                    self._compaction_thread = threading.Thread(target=self._run_merges, name="index-merge",
+                                                               daemon=True)
+                    self._compaction_thread.start()
+
+    def _run_merges(self):
+        """Merge segments until merge_candidates finds none (all of them if signatures are missing)."""
+        try:
+            while True:
+                with self._lock:
+                    store = self.vectorstore
+                    if store is None or self._closed:
+                        return
+                    missing = self._signatures_missing
+                    segments = list(store.segments) if missing else merge_candidates(store)
+                if not segments:
+                    return
+                if self._merge_segments(segments) and missing:
+                    self._signatures_missing = False
+        except Exception as e:
+            print(f"Error merging index segments in {self.index_dir}: {e}")
+
+    def _maybe_compact(self):
+        """Start a background compaction once the tombstone ratio reaches the threshold."""
+        if self.compact_threshold <= 0 or self.read_only:
+            return
+        with self._compaction_lock:
+            if self._compaction_thread is not None and self._compaction_thread.is_alive():
+                return
+        ratio = self.garbage_stats()["tombstone_ratio"]
+        if ratio >= self.compact_threshold:
+            print(f"{ratio:.0%} of the index entries are orphaned; compacting in the background")
+            self.compact_in_background()
+
+    def _compaction_metrics(self) -> Dict[str, Optional[float]]:
+        """Docstore size on disk, estimated memory and probe search latency of the current snapshot."""
+        return {
+            "docstore_mb": directory_bytes(os.path.join(self.index_dir, DOCSTORE_DIR)) / (1 << 20),
+            "memory_mb": self.memory_bytes() / (1 << 20),
+            "search_ms": self._probe_search_ms(self._snapshot)
+        }
+
+    def _probe_search_ms(self, snapshot: IndexSnapshot) -> Optional[float]:
+        """
+        Median milliseconds of a vector search, keyword search and parent read on a
+        snapshot, with random query vectors and words of stored chunks (no embedding calls).
+        """
+        vectorstore = snapshot.vectorstore
+        if vectorstore is None or len(vectorstore) == 0:
+            return None
+        rng = np.random.default_rng(0)
+        vectors = rng.standard_normal((LATENCY_PROBES, vectorstore.dimension)).astype(np.float32)
+        positions = np.flatnonzero(np.concatenate(vectorstore.live))
+        sample = rng.choice(positions, LATENCY_PROBES)
+        texts = [" ".join(vectorstore.chunk(int(i)).page_content.split()[:8]) for i in sample]
+        fetch_k = self.fetch_k or 4 * 3
+        timings = []
+        for vector, text in zip(vectors, texts):
+            started = time.perf_counter()
+            matches = self._vector_search(vectorstore, [vector], fetch_k)[0]
+            if self.hybrid:
+                snapshot.keyword.search(text, fetch_k)
+            self.docstore.mget(list({child.metadata[ID_KEY] for child, _ in matches if child.metadata.get(ID_KEY)}))
+            timings.append((time.perf_counter() - started) * 1000)
+        return float(np.median(timings))
+
+    def search(self, query: str, k: int = 3, fetch_k: Optional[int] = None,
+               filters: Optional[Dict[str, Any]] = None, mmr_lambda: Optional[float] = None) -> SearchResults:
+        """
+        Return the k parent chunks whose child chunks best match the query.
+
+        In hybrid mode the vector ranking and the BM25 keyword ranking of the
+        child chunks are fused with reciprocal rank fusion, so exact terms such
+        as standard numbers or company names are found even when the embedding
+        does not capture them. The ranked parents are then reordered by maximal
+        marginal relevance, trading relevance against similarity to the parents
+        already chosen.
+
+        Args:
+            query: Text to search for
+            k: Number of parent chunks to return
+            fetch_k: Number of child chunks taken from each ranking (defaults to the
+                index's fetch_k, or 4 * k)
+            filters: Only search files matching these metadata filters, e.g.
+                {"file_type": "pdf", "folder": "acme"} (see metadata_filter.py)
+            mmr_lambda: Overrides the index's MMR trade-off; 1 disables diversification
+        """
+        return self.search_many([query], k=k, fetch_k=fetch_k, filters=filters, mmr_lambda=mmr_lambda)[0]
+
+    def search_many(self, queries: List[str], k: int = 3, fetch_k: Optional[int] = None,
+                    dedup: bool = False, filters: Optional[Dict[str, Any]] = None,
+                    mmr_lambda: Optional[float] = None) -> List[SearchResults]:
+        """
+        Search several queries at once: the queries are embedded in one batch and
+        the vector index is searched once with the whole query matrix.
+
+        Args:
+            queries: Texts to search for
+            k: Number of parent chunks to return per query
+            fetch_k: Number of child chunks taken from each ranking (defaults to the
+                index's fetch_k, or 4 * k)
+            dedup: Return each parent chunk only for the first query that finds it;
+                later queries fall back to their next best parents instead
+            filters: Metadata filters applied to every query
+            mmr_lambda: Overrides the index's MMR trade-off; 1 disables diversification
+
+        Returns:
+            One SearchResults list of parent chunks per query, in query order
+        """
+        self._reload_if_stale()
+        results, parents_missing = self._search_many(queries, k, fetch_k, dedup, filters, mmr_lambda)
+        # The writer deleted parents between the version check and the docstore read
+        if parents_missing and self._reload_if_stale():
+            results, _ = self._search_many(queries, k, fetch_k, dedup, filters, mmr_lambda)
+        return results
+
+    def _search_many(self, queries: List[str], k: int, fetch_k: Optional[int], dedup: bool,
+                     filters: Optional[Dict[str, Any]], mmr_lambda: Optional[float]) -> tuple:
+        """search_many on the current snapshot; also returns whether a found parent was missing from the docstore."""
+        snapshot = self._acquire_snapshot()
+        try:
+            plan = self._plan_search(snapshot, queries, fetch_k or self.fetch_k or 4 * k, filters, mmr_lambda)
+            if plan is None:
+                return [SearchResults([], snapshot.version) for _ in queries], False
+            vectors = self._embed_queries([queries[i] for i in plan["missing"]]) if plan["missing"] else []
+            results = self._finish_search(plan, vectors, k, dedup)
+            return results, plan["parents_missing"]
+        finally:
+            self._release_snapshot(snapshot)
+
+    async def asearch(self, query: str, k: int = 3, fetch_k: Optional[int] = None,
+                      filters: Optional[Dict[str, Any]] = None,
+                      mmr_lambda: Optional[float] = None) -> SearchResults:
+        """Async search(): see asearch_many."""
+        return (await self.asearch_many([query], k=k, fetch_k=fetch_k, filters=filters, mmr_lambda=mmr_lambda))[0]
+
+    async def asearch_many(self, queries: List[str], k: int = 3, fetch_k: Optional[int] = None,
+                           dedup: bool = False, filters: Optional[Dict[str, Any]] = None,
+                           mmr_lambda: Optional[float] = None) -> List[SearchResults]:
+        """
+        Async search_many(): query embeddings are awaited with the embeddings' async
+        API and the index search runs in a worker thread, so the event loop is never blocked.
+        """
+        if self.read_only:
+            await asyncio.to_thread(self._reload_if_stale)
+        results, parents_missing = await self._asearch_many(queries, k, fetch_k, dedup, filters, mmr_lambda)
+        if parents_missing and await asyncio.to_thread(self._reload_if_stale):
+            results, _ = await self._asearch_many(queries, k, fetch_k, dedup, filters, mmr_lambda)
+        return results
+
+    async def _asearch_many(self, queries: List[str], k: int, fetch_k: Optional[int], dedup: bool,
+                            filters: Optional[Dict[str, Any]], mmr_lambda: Optional[float]) -> tuple:
+        snapshot = self._acquire_snapshot()
+        try:
+            plan = await asyncio.to_thread(self._plan_search, snapshot, queries, fetch_k or self.fetch_k or 4 * k,
+                                           filters, mmr_lambda)
+            if plan is None:
+                return [SearchResults([], snapshot.version) for _ in queries], False
+            vectors = await self._aembed_queries([queries[i] for i in plan["missing"]]) if plan["missing"] else []
+            results = await asyncio.to_thread(self._finish_search, plan, vectors, k, dedup)
+            return results, plan["parents_missing"]
+        finally:
+            # Releasing may delete retired parent chunks from disk
+            await asyncio.to_thread(self._release_snapshot, snapshot)
+
+    def _plan_search(self, snapshot: IndexSnapshot, queries: List[str], fetch_k: int,
+                     filters: Optional[Dict[str, Any]] = None,
+                     mmr_lambda: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """
+        Resolve the metadata filters and look the queries up in the result cache;
+        returns None if there is no index or no file matches the filters.
+        """
+        filters = normalize_filters(filters)
+        mmr_lambda = self.mmr_lambda if mmr_lambda is None else mmr_lambda
+        if snapshot.vectorstore is None:
+            return None
+        positions = None
+        if filters:
+            metadata_index = snapshot.metadata_index()
+            rel_paths = metadata_index.select(filters)
+            if not rel_paths:
+                return None
+            positions = metadata_index.positions(rel_paths)
+
+        # Ranked parent ids per query; k only selects from them, so it is not part of the key
+        cache_keys = [(query, fetch_k, self.hybrid, filters, mmr_lambda, snapshot.version) for query in queries]
+        candidates = [self.result_cache.get(key) for key in cache_keys]
+        return {
+            "snapshot": snapshot,
+            "queries": queries,
+            "fetch_k": fetch_k,
+            "mmr_lambda": mmr_lambda,
+            "positions": positions,
+            "cache_keys": cache_keys,
+            "candidates": candidates,
+            "missing": [i for i, ranked in enumerate(candidates) if ranked is None]
+        }
+
+    def _finish_search(self, plan: Dict[str, Any], vectors: List[List[float]], k: int,
+                       dedup: bool) -> List[List[Any]]:
+        """Search the queries that missed the cache, then pick k parents per query."""
+        snapshot, queries, fetch_k = plan["snapshot"], plan["queries"], plan["fetch_k"]
+        candidates = plan["candidates"]
+        if plan["missing"]:
+            children_per_query = self._vector_search(snapshot.vectorstore, vectors, fetch_k, plan["positions"])
+            for i, vector, children in zip(plan["missing"], vectors, children_per_query):
+                ranked = self._rank_parents(snapshot, queries[i], children, fetch_k, plan["positions"])
+                if plan["mmr_lambda"] < 1 and len(ranked) > 1:
+                    ranked = self._diversify(snapshot, vector, ranked, plan["mmr_lambda"])
+                candidates[i] = [parent_id for parent_id, _ in ranked]
+                self.result_cache.put(plan["cache_keys"][i], candidates[i])
+
+        selected = []
+        seen = set()
+        for ranked in candidates:
+            chosen = []
+            for parent_id in ranked:
+                if len(chosen) >= k:
+                    break
+                if not (dedup and parent_id in seen):
+                    chosen.append(parent_id)
+            seen.update(chosen)
+            selected.append(chosen)
+
+        # One docstore read for the parents of every query
+        unique_ids = list(dict.fromkeys(parent_id for chosen in selected for parent_id in chosen))
+        parents = dict(zip(unique_ids, self.docstore.mget(unique_ids)))
+        plan["parents_missing"] = any(parent is None for parent in parents.values())
+        duplicate_sources = snapshot.duplicate_sources()
+        for parent_id, parent in parents.items():
+            if parent is None:
+                continue
+            parent.metadata["index_version"] = snapshot.version
+            if parent_id in duplicate_sources:
+                parent.metadata["also_in"] = duplicate_sources[parent_id]
+        return [SearchResults((parents[parent_id] for parent_id in chosen if parents[parent_id] is not None),
+                              snapshot.version)
+                for chosen in selected]
+
+    def _vector_search(self, vectorstore: SegmentedStore, vectors: List[List[float]], fetch_k: int,
+                       allowed_positions: Optional[np.ndarray] = None) -> List[List[tuple]]:
+        """
+        Search the segments once for a matrix of query vectors; returns (child chunk,
+        vector position) pairs per query. With allowed_positions, every other vector
+        is skipped during the search.
+        """
+        matrix = np.array(vectors, dtype=np.float32)
+        positions = vectorstore.search(matrix, fetch_k, allowed_positions)
+        return [[(vectorstore.chunk(int(position)), int(position)) for position in row if position != -1]
+                for row in positions]
+
+    def _rank_parents(self, snapshot: IndexSnapshot, query: str, children: List[tuple], fetch_k: int,
+                      allowed_positions: Optional[np.ndarray] = None) -> List[tuple]:
+        """
+        Parent ids in the order of their best matching child, after fusing in keyword
+        matches, as (parent id, vector position of that child) pairs.
+        """
+        if self.hybrid:
+            store = snapshot.vectorstore
+            children_by_id = {child.id: (child, position) for child, position in children}
+            keyword_positions = {store.doc_id(position): position
+                                 for position, _ in snapshot.keyword.search(query, fetch_k, allowed_positions)}
+            fused_ids = reciprocal_rank_fusion([list(children_by_id), list(keyword_positions)])
+            children = []
+            for doc_id in fused_ids:
+                match = children_by_id.get(doc_id)
+                if match is None:
+                    # Keyword-only match
+                    position = keyword_positions[doc_id]
+                    match = (store.chunk(position), position)
+                children.append(match)
+
+        ranked = {}
+        for child, position in children:
+            parent_id = child.metadata.get(ID_KEY)
+            if parent_id and parent_id not in ranked:
+                ranked[parent_id] = position
+        return list(ranked.items())
+
+    def _diversify(self, snapshot: IndexSnapshot, query_vector: List[float], ranked: List[tuple],
+                   mmr_lambda: float) -> List[tuple]:
+        """
+        Reorder ranked (parent id, child position) pairs by maximal marginal relevance
+        over the stored vectors of the children. Falls back to the relevance order if
+        the vectors cannot be read.
+        """
+        try:
+            vectors = snapshot.vectorstore.reconstruct([position for _, position in ranked])
+        except Exception as e:
+            print(f"MMR reranking skipped, stored vectors unavailable: {e}")
+            return ranked
+
+        relevance = None
+        if self.hybrid:
+            # Keep the fused order as the relevance order: the i-th ranked parent gets
+            # the i-th highest cosine similarity, so keyword matches are not demoted
+            query = np.asarray(query_vector, dtype=np.float32)
+            similarities = (vectors @ query) / np.maximum(
+                np.linalg.norm(vectors, axis=1) * np.linalg.norm(query), 1e-12)
+            relevance = np.sort(similarities)[::-1]
+        order = mmr_order(query_vector, vectors, mmr_lambda, relevance=relevance)
+        return [ranked[i] for i in order]
+
+    def _embed_queries(self, queries: List[str]) -> List[List[float]]:
+        """Query embeddings, from the cache where possible and otherwise in a single batch."""
+        embeddings, missing = self._cached_query_embeddings(queries)
+        if not missing:
+            return embeddings
+        if len(missing) == 1:
+            computed = [self.embeddings.embed_query(missing[0])]
+        else:
+            computed = self.embeddings.embed_documents(missing)
+        return self._merge_query_embeddings(queries, embeddings, missing, computed)
+
+    async def _aembed_queries(self, queries: List[str]) -> List[List[float]]:
+        embeddings, missing = self._cached_query_embeddings(queries)
+        if not missing:
+            return embeddings
+        if len(missing) == 1:
+            computed = [await self.embeddings.aembed_query(missing[0])]
+        else:
+            computed = await self.embeddings.aembed_documents(missing)
+        return self._merge_query_embeddings(queries, embeddings, missing, computed)
+
+    def _cached_query_embeddings(self, queries: List[str]):
+        """Cached embedding (or None) per query, and the distinct queries that still need embedding."""
+        embeddings = [self.query_embedding_cache.get(query) for query in queries]
+        missing = list(dict.fromkeys(query for query, embedding in zip(queries, embeddings) if embedding is None))
+        return embeddings, missing
+
+    def _merge_query_embeddings(self, queries, embeddings, missing, computed) -> List[List[float]]:
+        computed = dict(zip(missing, computed))
+        for query, embedding in computed.items():
+            self.query_embedding_cache.put(query, embedding)
+        return [embedding if embedding is not None else computed[query]
+                for query, embedding in zip(queries, embeddings)]
+
+    def cache_stats(self) -> Dict[str, dict]:
+        """Hit/miss counters of the query embedding and search result caches."""
+        return {
+            "query_embeddings": self.query_embedding_cache.stats(),
+            "results": self.result_cache.stats()
+        }
+
+    def cache_stats_summary(self) -> str:
+        stats = self.cache_stats()
+        return (f"Query cache: {stats['results']['hit_rate']:.0%} of searches and "
+                f"{stats['query_embeddings']['hit_rate']:.0%} of query embeddings served from cache")
+
+    def memory_bytes(self) -> int:
+        """
+        Approximate memory held by the loaded index: vectors, child chunks and their
+        keyword postings, duplicate signatures and cached query embeddings. Parent chunks
+        stay on disk and are not counted; memory-mapped files count in full.
+        """
+        with self._lock:
+            vectorstore = self.vectorstore
+            size = self.duplicate_detector.memory_bytes()
+            if vectorstore is None:
+                return size
+            return size + vectorstore.memory_bytes() + len(self.query_embedding_cache) * vectorstore.dimension * 4
+
+    def document_count(self) -> int:
+        """Number of child vectors currently in the index."""
+        return sum(len(entry.get("ids", [])) for entry in self.manifest.get("files", {}).values())
+
+    def parent_count(self) -> int:
+        """Number of parent chunks currently in the docstore."""
+        return sum(len(entry.get("parent_ids", [])) for entry in self.manifest.get("files", {}).values())
@@ -0,0 +1,255 @@
+"""
+FAISS index types for the reference retriever.
+
+The default "flat" index is exact but its query time and memory grow linearly
+with the number of chunks. For large corpora an approximate index can be
+selected instead:
+
+    flat      exact search (IndexFlatL2)
+    ivf_flat  inverted file over k-means cells, full vectors; tune with nprobe
+    hnsw      HNSW graph over full vectors; tune with efSearch
+    ivf_pq    inverted file with product-quantized vectors; smallest memory
+
+Settings come from the environment (RAG_INDEX_TYPE, RAG_INDEX_NLIST,
+RAG_INDEX_NPROBE, RAG_INDEX_HNSW_M, RAG_INDEX_EF_SEARCH, RAG_INDEX_PQ_M) so
+they can be changed per deployment. Use index_benchmark.py to measure recall
+and latency against the flat baseline before switching.
+"""
+
+import os
+import math
+import threading
+from typing import Optional
+
+import numpy as np
+from langchain_community.vectorstores.faiss import dependable_faiss_import
+
+INDEX_TYPES = ("flat", "ivf_flat", "hnsw", "ivf_pq")
+
+DEFAULT_INDEX_TYPE = os.getenv("RAG_INDEX_TYPE", "flat").lower()
+# Number of IVF cells; 0 means 4 * sqrt(number of vectors)
+DEFAULT_NLIST = int(os.getenv("RAG_INDEX_NLIST", "0"))
+# IVF cells visited per query
+DEFAULT_NPROBE = int(os.getenv("RAG_INDEX_NPROBE", "8"))
+# Graph neighbours per HNSW node
+DEFAULT_HNSW_M = int(os.getenv("RAG_INDEX_HNSW_M", "32"))
+# HNSW candidate list size per query
+DEFAULT_EF_SEARCH = int(os.getenv("RAG_INDEX_EF_SEARCH", "64"))
+# PQ sub-quantizers; 0 means one per 16 dimensions
+DEFAULT_PQ_M = int(os.getenv("RAG_INDEX_PQ_M", "0"))
+PQ_NBITS = 8
+# k-means needs roughly this many training points per centroid
+MIN_POINTS_PER_CENTROID = 39
+# Relevance/diversity trade-off of maximal marginal relevance; 1 keeps the relevance order
+DEFAULT_MMR_LAMBDA = float(os.getenv("RAG_MMR_LAMBDA", "0.7"))
+
+_direct_map_lock = threading.Lock()
+
+
+def index_type_of(index) -> str:
+    """Name of the INDEX_TYPES entry a FAISS index corresponds to."""
+    faiss = dependable_faiss_import()
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+
+def _nlist_for(count: int, nlist: Optional[int]) -> int:
+    nlist = nlist or DEFAULT_NLIST or int(4 * math.sqrt(count))
+    # Never ask for more cells than the vectors can train
+    return min(nlist, count // MIN_POINTS_PER_CENTROID)
+
+
+def _pq_m_for(dimension: int, pq_m: Optional[int]) -> int:
+    pq_m = pq_m or DEFAULT_PQ_M
+    if pq_m and dimension % pq_m == 0:
+        return pq_m
+    # Largest divisor of the dimension with at least 16 dimensions per sub-quantizer
+    target = max(1, dimension // 16)
+    return max(m for m in range(1, target + 1) if dimension % m == 0)
+
+
+def effective_index_type(count: int, index_type: str, nlist: Optional[int] = None) -> str:
+    """
+    Index type build_index() produces for `count` vectors.
+
+    Corpora too small to train the requested index fall back to a simpler one:
+    IVF-PQ needs at least 2^8 training vectors and IVF needs a few dozen per cell.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type!r}; expected one of {', '.join(INDEX_TYPES)}")
+    if index_type == "ivf_pq" and count < (1 << PQ_NBITS):
+        index_type = "ivf_flat"
+    if index_type in ("ivf_flat", "ivf_pq") and _nlist_for(count, nlist) < 2:
+        index_type = "flat"
+    return index_type
+
+
+def build_index(vectors: np.ndarray, index_type: Optional[str] = None, nlist: Optional[int] = None,
+                hnsw_m: Optional[int] = None, pq_m: Optional[int] = None,
+                nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    """
+    Build (and train, if needed) a FAISS index over the vectors, in their order.
+
+    Vector positions are the same as in a flat index: position i holds vectors[i].
+
+    Args:
+        vectors: float32 array of shape (n, dimension)
+        index_type: One of INDEX_TYPES (defaults to RAG_INDEX_TYPE)
+        nlist: Number of IVF cells
+        hnsw_m: Graph neighbours per HNSW node
+        pq_m: Number of PQ sub-quantizers (must divide the dimension)
+        nprobe, ef_search: Query-time settings, see configure_search()
+
+    Returns:
+        The populated FAISS index
+    """
+    faiss = dependable_faiss_import()
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    count, dimension = vectors.shape
+    index_type = effective_index_type(count, index_type or DEFAULT_INDEX_TYPE, nlist)
+
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(dimension)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, hnsw_m or DEFAULT_HNSW_M)
+    else:
+        quantizer = faiss.IndexFlatL2(dimension)
+        cells = _nlist_for(count, nlist)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dimension, cells)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dimension, cells, _pq_m_for(dimension, pq_m), PQ_NBITS)
+        index.train(vectors)
+
+    if count:
+        index.add(vectors)
+    configure_search(index, nprobe, ef_search)
+    return index
+
+
+def configure_search(index, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    """Apply the query-time accuracy/speed settings (nprobe for IVF, efSearch for HNSW)."""
+    faiss = dependable_faiss_import()
+    index_type = index_type_of(index)
+    if index_type in ("ivf_flat", "ivf_pq"):
+        faiss.extract_index_ivf(index).nprobe = nprobe or DEFAULT_NPROBE
+    elif index_type == "hnsw":
+        index.hnsw.efSearch = ef_search or DEFAULT_EF_SEARCH
+
+
+def search_parameters(index, mask: np.ndarray):
+    """
+    Search parameters that restrict a search to the vector positions set in a
+    boolean mask of length index.ntotal.
+
+    The mask is packed into a bitmap that FAISS checks while it scans.
+    Approximate indexes only look at part of the vectors, so nprobe/efSearch
+    are scaled up by the inverse of the filter's selectivity: a filter keeping
+    10% of the vectors visits 10x as many cells or graph candidates, which
+    finds about as many allowed vectors as an unfiltered search would.
+    """
+    faiss = dependable_faiss_import()
+    bitmap = np.packbits(mask, bitorder="little")
+    selector = faiss.IDSelectorBitmap(index.ntotal, faiss.swig_ptr(bitmap))
+    scale = index.ntotal / max(int(mask.sum()), 1)
+
+    index_type = index_type_of(index)
+    if index_type in ("ivf_flat", "ivf_pq"):
+        ivf = faiss.extract_index_ivf(index)
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=min(ivf.nlist, math.ceil(ivf.nprobe * scale)))
+    elif index_type == "hnsw":
+        params = faiss.SearchParametersHNSW(sel=selector,
+                                            efSearch=min(index.ntotal, math.ceil(index.hnsw.efSearch * scale)))
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    # The selector only points into the bitmap; keep both alive as long as the parameters
+    params.referenced_objects = [selector, bitmap]
+    return params
+
+
+def reconstruct(index, positions) -> np.ndarray:
+    """
+    Stored vectors at the given positions. IVF indexes get a direct map on first
+    use; IVF-PQ returns the decoded (approximate) vectors.
+    """
+    faiss = dependable_faiss_import()
+    if index_type_of(index) in ("ivf_flat", "ivf_pq"):
+        ivf = faiss.extract_index_ivf(index)
+        with _direct_map_lock:
+            if ivf.direct_map.type == faiss.DirectMap.NoMap:
+                ivf.make_direct_map()
+    return index.reconstruct_batch(np.asarray(positions, dtype=np.int64))
+
+
+def mmr_order(query: np.ndarray, candidates: np.ndarray, lambda_mult: Optional[float] = None,
+              k: Optional[int] = None, relevance: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Greedy maximal marginal relevance: each step picks the candidate maximising
+    lambda * sim(query, c) - (1 - lambda) * max sim(c, already picked), with
+    cosine similarities.
+
+    All similarities come from two matrix products up front and each step is a
+    handful of vector operations, so reranking 50 candidates takes well under
+    a millisecond. The greedy order is prefix-consistent: the first k entries
+    of the full order are the MMR selection for k.
+
+    Args:
+        query: Query vector, shape (d,)
+        candidates: Candidate vectors, shape (n, d), in relevance order
+        lambda_mult: 1 ranks by relevance only, 0 by diversity only (defaults to RAG_MMR_LAMBDA or 0.7)
+        k: Number of candidates to order (defaults to all)
+        relevance: Relevance score per candidate, used instead of the cosine similarity to the query
+
+    Returns:
+        Candidate indices in MMR order
+    """
+    lambda_mult = DEFAULT_MMR_LAMBDA if lambda_mult is None else lambda_mult
+    candidates = np.asarray(candidates, dtype=np.float32)
+    count = len(candidates)
+    k = count if k is None else min(k, count)
+    if count == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    candidates = candidates / np.maximum(np.linalg.norm(candidates, axis=1, keepdims=True), 1e-12)
+    if relevance is None:
+        query = np.asarray(query, dtype=np.float32)
+        relevance = candidates @ (query / max(float(np.linalg.norm(query)), 1e-12))
+    relevance = lambda_mult * np.asarray(relevance, dtype=np.float32)
+    similarity = (1 - lambda_mult) * (candidates @ candidates.T)
+
+    order = np.empty(k, dtype=np.int64)
+    redundancy = np.zeros(count, dtype=np.float32)
+    picked = np.zeros(count, dtype=bool)
+    for step in range(k):
+        scores = relevance - redundancy
+        scores[picked] = -np.inf
+        chosen = int(np.argmax(scores))
+        order[step] = chosen
+        picked[chosen] = True
+        np.maximum(redundancy, similarity[chosen], out=redundancy)
+    return order
+
+
+def index_bytes(index) -> int:
+    """
+    Approximate memory held by a FAISS index: stored vectors or codes, ids,
+    IVF centroids and HNSW graph links.
+    """
+    faiss = dependable_faiss_import()
+    index_type = index_type_of(index)
+    if index_type == "hnsw":
+        graph = index.hnsw
+        return (index.ntotal * index.d * 4 + graph.neighbors.size() * 4
+                + graph.levels.size() * 4 + graph.offsets.size() * 8)
+    if index_type in ("ivf_flat", "ivf_pq"):
+        ivf = faiss.extract_index_ivf(index)
+        size = index.ntotal * (ivf.code_size + 8) + ivf.nlist * index.d * 4
+        if index_type == "ivf_pq":
+            size += faiss.downcast_index(ivf).pq.centroids.size() * 4
+        return size
+    return index.ntotal * index.d * 4
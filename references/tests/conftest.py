@@ -0,0 +1,51 @@
+"""
+Shared fixtures: a materials directory of small text files and reference indexes
+over it embedded with HashingEmbeddings, so no test needs an API key or a model.
+"""
+
+import os
+import sys
+
+import pytest
+
+# The RAG modules shared by CaseStrategy and CourseDesigner live in references/rag_shared
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rag_shared.embedding_backends import HashingEmbeddings
+from rag_shared.reference_index import ReferenceIndex
+
+
+@pytest.fixture
+def materials(tmp_path):
+    """Materials directory; write(rel_path, text) adds a file and returns its absolute path."""
+    root = tmp_path / "materials"
+    root.mkdir()
+
+    class Materials:
+        path = str(root)
+
+        @staticmethod
+        def write(rel_path: str, text: str) -> str:
+            path = root / rel_path
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(text, encoding="utf-8")
+            return str(path)
+
+    return Materials()
+
+
+@pytest.fixture
+def open_index(materials):
+    """Factory opening a loaded ReferenceIndex over the materials; every index is closed afterwards."""
+    opened = []
+
+    def factory(embeddings=None, **kwargs):
+        kwargs.setdefault("load_workers", 1)
+        kwargs.setdefault("compact_threshold", 0)
+        index = ReferenceIndex(materials.path, embeddings or HashingEmbeddings(), **kwargs)
+        index.load_or_build()
+        opened.append(index)
+        return index
+
+    yield factory
+    for index in opened:
+        index.close()
@@ -0,0 +1,119 @@
+"""
+Tests for duplicate detection: rag_shared.chunk_dedup.DuplicateDetector on its
+own, and how ReferenceIndex records duplicates as references to the canonical
+chunk and hands that chunk over to another file when its owner is removed.
+
+Run from the repository root:
+    python -m pytest -q references/tests
+"""
+
+import os
+import random
+
+from rag_shared.chunk_dedup import DuplicateDetector
+
+WORDS = ("carbon governance board audit supply chain water risk climate ethics labour disclosure "
+         "materiality stakeholder emissions scope target transition finance biodiversity").split()
+
+
+def passage(seed: int, words: int = 150) -> str:
+    """A deterministic paragraph short enough to be a single parent chunk."""
+    rng = random.Random(seed)
+    return " ".join(rng.choice(WORDS) for _ in range(words)) + "."
+
+
+def edited(text: str) -> str:
+    """The text with one word in the middle replaced."""
+    words = text.split()
+    words[len(words) // 2] = "photosynthesis"
+    return " ".join(words)
+
+
+def test_detector_finds_exact_and_near_duplicates():
+    detector = DuplicateDetector()
+    text = passage(1)
+    detector.add("p1", text)
+
+    canonical, kind, _, _ = detector.find("  " + text.upper().replace(" ", "\n"))
+    assert (canonical, kind) == ("p1", "exact")
+    canonical, kind, _, _ = detector.find(edited(text))
+    assert (canonical, kind) == ("p1", "near")
+    assert detector.find(passage(2))[:2] == (None, None)
+
+    detector.remove(["p1"])
+    assert detector.find(text)[:2] == (None, None)
+    assert len(detector) == 0
+
+
+def test_detector_signatures_round_trip(tmp_path):
+    detector = DuplicateDetector()
+    detector.add("p1", passage(1))
+    detector.add("p2", passage(2))
+    path = str(tmp_path / "dedup.npz")
+    detector.save(path, ["p2"])
+
+    loaded = DuplicateDetector()
+    assert loaded.load(path)
+    assert loaded.parent_ids() == {"p2"}
+    assert loaded.find(edited(passage(2)))[:2] == ("p2", "near")
+
+
+def test_copies_are_stored_once_and_listed_in_also_in(materials, open_index):
+    text = passage(1)
+    materials.write("a.txt", text)
+    materials.write("b.txt", text)
+    materials.write("c.txt", edited(text))
+    index = open_index()
+
+    files = index.manifest["files"]
+    owner = "a.txt" if files["a.txt"]["parent_ids"] else "b.txt"
+    assert sum(len(entry["parent_ids"]) for entry in files.values()) == 1
+    copies = {"a.txt", "b.txt", "c.txt"} - {owner}
+    assert {rel_path for rel_path, entry in files.items() if entry.get("duplicates")} == copies
+    assert index.dedup_report.exact == 1 and index.dedup_report.near == 1
+    assert index.document_count() == len(files[owner]["ids"])
+
+    (result,) = index.search(text[:80], k=1)
+    assert result.metadata["file_path"] == owner
+    assert sorted(result.metadata["also_in"]) == sorted(copies)
+
+
+def test_removing_the_owner_hands_the_chunk_over(materials, open_index):
+    text = passage(3)
+    materials.write("a.txt", text)
+    index = open_index()
+    materials.write("b.txt", text)
+    index.add_file(os.path.join(materials.path, "b.txt"))
+    child_ids = list(index.manifest["files"]["a.txt"]["ids"])
+    parent_ids = list(index.manifest["files"]["a.txt"]["parent_ids"])
+    assert index.manifest["files"]["b.txt"]["duplicates"] == {parent_ids[0]: child_ids}
+
+    # The chunk's vectors are kept: only the file entry changes hands
+    assert index.remove_file(os.path.join(materials.path, "a.txt")) == 0
+    os.remove(os.path.join(materials.path, "a.txt"))
+    entry = index.manifest["files"]["b.txt"]
+    assert entry["parent_ids"] == parent_ids and entry["ids"] == child_ids and not entry.get("duplicates")
+    assert index.document_count() == len(child_ids)
+
+    (result,) = index.search(text[:80], k=1)
+    assert result.metadata["file_path"] == "b.txt"
+    assert "also_in" not in result.metadata
+
+    # The handover is persisted: a restart reloads it instead of re-indexing b.txt
+    index.close()
+    reopened = open_index()
+    assert reopened.manifest["files"]["b.txt"]["ids"] == child_ids
+    assert reopened.search(text[:80], k=1)[0].metadata["file_path"] == "b.txt"
+    # Removing the last file with the chunk deletes it
+    assert reopened.remove_file(os.path.join(materials.path, "b.txt")) == len(child_ids)
+    assert reopened.document_count() == 0
+
+
+def test_dedup_off_embeds_every_copy(materials, open_index):
+    text = passage(4)
+    materials.write("a.txt", text)
+    materials.write("b.txt", text)
+    index = open_index(dedup_chunks=False)
+    files = index.manifest["files"]
+    assert all(entry["parent_ids"] and not entry.get("duplicates") for entry in files.values())
+    assert index.document_count() == len(files["a.txt"]["ids"]) + len(files["b.txt"]["ids"])
@@ -0,0 +1,176 @@
+"""
+Tests for rag_shared.embedding_scheduler.ScheduledEmbeddings against a fake
+provider that answers with 429s. Sleeping goes through a fake clock, so the
+tests never wait for real backoff delays or the token bucket.
+
+Run from the repository root:
+    python -m pytest -q references/tests
+"""
+
+import os
+import sys
+import time
+import random
+import threading
+
+import pytest
+
+# The RAG modules shared by CaseStrategy and CourseDesigner live in references/rag_shared
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rag_shared import embedding_scheduler
+from rag_shared.embedding_scheduler import ScheduledEmbeddings
+
+
+class RateLimitError(Exception):
+    """Stands in for the provider's HTTP 429 error."""
+    status_code = 429
+
+
+class FakeProvider:
+    """Embeds "<n> ..." as [n]; the first `rate_limited` requests fail with a 429."""
+
+    model = "fake-embedding"
+
+    def __init__(self, rate_limited: int = 0, clock=None):
+        self.rate_limited = rate_limited
+        self.clock = clock
+        self.requests = []  # (time, texts) of every request, including rejected ones
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        with self._lock:
+            self.requests.append((self.clock.now if self.clock else None, list(texts)))
+            if self.rate_limited:
+                self.rate_limited -= 1
+                raise RateLimitError("429 Too Many Requests")
+        return [[float(text.split()[0])] for text in texts]
+
+
+class FakeClock:
+    """time.monotonic / time.sleep replacement; sleeping only advances the clock."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+        self._lock = threading.Lock()
+
+    def monotonic(self):
+        with self._lock:
+            return self.now
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.sleeps.append(seconds)
+            self.now += max(0.0, seconds)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(embedding_scheduler.time, "monotonic", fake.monotonic)
+    monkeypatch.setattr(embedding_scheduler.time, "sleep", fake.sleep)
+    return fake
+
+
+def make_texts(count: int, tokens: int = 10):
+    """Texts numbered in order; without tiktoken each is `tokens` tokens (4 characters per token)."""
+    texts = []
+    for i in range(count):
+        prefix = f"{i} "
+        texts.append(prefix + "x" * (tokens * 4 - len(prefix)))
+    return texts
+
+
+def make_scheduler(provider, **kwargs):
+    scheduler = ScheduledEmbeddings(provider, **kwargs)
+    # Count tokens the same way whether or not tiktoken is installed
+    scheduler._encoding = None
+    return scheduler
+
+
+def test_batches_respect_token_and_size_limits(clock):
+    provider = FakeProvider(clock=clock)
+    scheduler = make_scheduler(provider, max_batch_tokens=50, max_batch_size=3, max_concurrency=1,
+                               tokens_per_minute=10 ** 9)
+    texts = make_texts(10, tokens=20)
+
+    scheduler.embed_documents(texts)
+
+    # 20-token texts: two fit in the 50-token budget, so the size limit of 3 is never reached
+    assert [len(batch) for _, batch in provider.requests] == [2, 2, 2, 2, 2]
+    assert [text for _, batch in provider.requests for text in batch] == texts
+
+    small = make_texts(7, tokens=5)
+    assert [len(batch) for _, batch, _ in scheduler.make_batches(small)] == [3, 3, 1]
+    for _, batch, tokens in scheduler.make_batches(small):
+        assert tokens == 5 * len(batch) <= 50
+
+
+def test_vectors_keep_input_order_with_concurrent_batches(monkeypatch):
+    provider = FakeProvider()
+    embed = provider.embed_documents
+    rng = random.Random(7)
+
+    def slow_embed(texts):
+        # Batches finish in a different order than they were submitted
+        time.sleep(rng.uniform(0, 0.01))
+        return embed(texts)
+
+    monkeypatch.setattr(provider, "embed_documents", slow_embed)
+    scheduler = make_scheduler(provider, max_batch_tokens=30, max_batch_size=3, max_concurrency=4,
+                               tokens_per_minute=10 ** 9)
+    texts = make_texts(40)
+
+    vectors = scheduler.embed_documents(texts)
+
+    assert len(provider.requests) == 14
+    assert vectors == [[float(i)] for i in range(40)]
+
+
+def test_rate_limited_batches_retry_with_jittered_backoff(clock, monkeypatch):
+    bounds = []
+
+    def uniform(low, high):
+        bounds.append((low, high))
+        return high / 2
+
+    monkeypatch.setattr(embedding_scheduler.random, "uniform", uniform)
+    provider = FakeProvider(rate_limited=3, clock=clock)
+    scheduler = make_scheduler(provider, max_batch_tokens=1000, max_concurrency=1, tokens_per_minute=10 ** 9,
+                               max_retries=5)
+    texts = make_texts(4)
+
+    vectors = scheduler.embed_documents(texts)
+
+    assert vectors == [[float(i)] for i in range(4)]
+    assert scheduler.retries == 3
+    assert len(provider.requests) == 4
+    # Full jitter: each delay is drawn from [0, 2 ** attempt]
+    assert bounds == [(0, 1), (0, 2), (0, 4)]
+    assert clock.sleeps == [0.5, 1.0, 2.0]
+
+
+def test_rate_limit_errors_are_raised_after_max_retries(clock):
+    provider = FakeProvider(rate_limited=10, clock=clock)
+    scheduler = make_scheduler(provider, max_concurrency=1, tokens_per_minute=10 ** 9, max_retries=2)
+
+    with pytest.raises(RateLimitError):
+        scheduler.embed_documents(make_texts(2))
+    assert len(provider.requests) == 3
+
+
+def test_token_bucket_caps_the_request_rate(clock):
+    # 600 tokens per minute: a full bucket of 600 tokens, then 10 tokens per second
+    provider = FakeProvider(clock=clock)
+    scheduler = make_scheduler(provider, max_batch_tokens=100, max_concurrency=1, tokens_per_minute=600)
+    texts = make_texts(180)  # 1800 tokens in 18 batches of 100
+
+    scheduler.embed_documents(texts)
+
+    assert len(provider.requests) == 18
+    # The first 600 tokens go out at once, the remaining 1200 at the refill rate
+    assert clock.now == pytest.approx(120.0)
+    sent = 0
+    for started, batch in provider.requests:
+        sent += 10 * len(batch)
+        assert sent <= 600 + 10 * started + 1e-6
@@ -0,0 +1,100 @@
+"""
+Tests for ReferenceIndex.compact(): tombstoned vectors and orphaned parent
+chunks and signatures are garbage collected, searches return the same
+results afterwards, the report carries before/after metrics, and compaction
+starts by itself once the tombstone ratio reaches the threshold.
+
+Run from the repository root:
+    python -m pytest -q references/tests
+"""
+
+import os
+import time
+
+from langchain_core.documents import Document
+
+TOPICS = ("carbon pricing", "water stewardship", "supplier audits", "board diversity",
+          "biodiversity offsets", "labour rights")
+
+
+def write_topics(materials):
+    for topic in TOPICS:
+        materials.write(f"{topic.replace(' ', '_')}.txt", f"Our policy on {topic} and how {topic} is reported. " * 8)
+
+
+def remove_topics(index, materials, topics):
+    for topic in topics:
+        path = os.path.join(materials.path, f"{topic.replace(' ', '_')}.txt")
+        assert index.remove_file(path) > 0
+        os.remove(path)
+
+
+def test_compaction_drops_tombstoned_vectors(materials, open_index):
+    write_topics(materials)
+    index = open_index()
+    remove_topics(index, materials, TOPICS[:3])
+    store = index.vectorstore
+    tombstoned = store.ntotal - len(store)
+    assert tombstoned > 0
+    assert index.garbage_stats()["orphan_vectors"] == tombstoned
+    expected = [document.page_content for document in index.search("board diversity reporting", k=3)]
+    version = index.index_version
+
+    report = index.compact()
+    assert report.garbage["orphan_vectors"] == tombstoned and report.removed == tombstoned
+    store = index.vectorstore
+    assert store.ntotal == len(store) == index.document_count()
+    assert len(store.segments) == 1
+    assert index.index_version > version
+    assert [document.page_content for document in index.search("board diversity reporting", k=3)] == expected
+    for metrics in (report.before, report.after):
+        assert {"docstore_mb", "memory_mb", "search_ms"} <= set(metrics)
+    assert report.after["memory_mb"] <= report.before["memory_mb"]
+
+
+def test_orphaned_parents_and_signatures_are_collected(materials, open_index):
+    write_topics(materials)
+    index = open_index()
+    # Left behind, e.g. by a file whose embedding failed after its parents were written
+    index.docstore.mset([("orphan-parent", Document(page_content="Orphaned parent chunk."))])
+    index.duplicate_detector.add("orphan-parent", "Orphaned parent chunk. " * 20)
+    stats = index.garbage_stats()
+    assert (stats["orphan_parents"], stats["orphan_vectors"], stats["orphan_signatures"]) == (1, 0, 1)
+    assert stats["tombstone_ratio"] > 0
+
+    report = index.compact()
+    assert report.removed == 2
+    assert index.docstore.mget(["orphan-parent"]) == [None]
+    assert index.garbage_stats() == {"orphan_parents": 0, "orphan_vectors": 0, "orphan_signatures": 0,
+                                     "tombstone_ratio": 0.0}
+
+    # The compacted index is what a restart loads
+    index.close()
+    reopened = open_index()
+    assert reopened.garbage_stats()["orphan_signatures"] == 0
+    assert reopened.document_count() == index.document_count()
+    assert reopened.search("supplier audits", k=1)[0].metadata["file_path"] == "supplier_audits.txt"
+
+
+def test_clean_index_is_left_alone(materials, open_index):
+    write_topics(materials)
+    index = open_index()
+    version = index.index_version
+    report = index.compact()
+    assert report.removed == 0 and report.after is None
+    assert index.index_version == version
+
+
+def test_compaction_starts_at_the_threshold(materials, open_index):
+    write_topics(materials)
+    index = open_index(compact_threshold=0.4)
+    remove_topics(index, materials, TOPICS[:1])
+    assert index.last_compaction is None
+
+    remove_topics(index, materials, TOPICS[1:4])
+    deadline = time.monotonic() + 10
+    while index.last_compaction is None and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert index.last_compaction is not None and index.last_compaction.removed > 0
+    store = index.vectorstore
+    assert store.ntotal == len(store)
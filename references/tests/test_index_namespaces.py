@@ -0,0 +1,153 @@
+"""
+Tests for CaseStrategy.index_namespaces.IndexNamespaces: each client namespace
+searches only its own materials, names that map to the same directory are
+rejected, and least recently used indexes are unloaded (closed outside the
+namespaces lock) unless they are in use.
+
+Run from the repository root:
+    python -m pytest -q references/tests
+"""
+
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "CaseStrategy"))
+from index_namespaces import IndexNamespaces, namespace_slug
+from rag_shared.embedding_backends import HashingEmbeddings
+from rag_shared.reference_index import ReferenceIndex
+
+
+class BlockingIndex(ReferenceIndex):
+    """ReferenceIndex whose close() waits until the test lets it finish."""
+
+    release_close = None
+
+    def close(self):
+        if self.release_close is not None:
+            self.closing.set()
+            self.release_close.wait(10)
+        super().close()
+
+
+@pytest.fixture
+def namespaces(tmp_path):
+    created = []
+
+    def factory(materials_dir, index_dir):
+        index = BlockingIndex(materials_dir, HashingEmbeddings(), index_dir=index_dir,
+                              load_workers=1, compact_threshold=0)
+        created.append(index)
+        return index
+
+    def make(**kwargs):
+        return IndexNamespaces(factory, str(tmp_path / "clients"), **kwargs)
+
+    yield make
+    for index in created:
+        index.release_close = None
+        index.close()
+
+
+def add_client(namespaces, name, text):
+    """Create a namespace holding one file and return its index."""
+    with namespaces.use(name, create=True) as index:
+        path = os.path.join(namespaces.materials_dir(name), "brief.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        index.add_file(path)
+        return index
+
+
+def test_namespaces_only_search_their_own_materials(namespaces):
+    clients = namespaces()
+    add_client(clients, "Acme Corp", "Acme steel decarbonisation roadmap with hydrogen furnaces. " * 10)
+    add_client(clients, "Globex", "Globex water stewardship for bottling plants in arid regions. " * 10)
+
+    with clients.use("Acme Corp") as index:
+        results = index.search("water stewardship bottling", k=5)
+        assert results and all("Acme" in document.page_content for document in results)
+    with clients.use("Globex") as index:
+        assert all("Globex" in document.page_content for document in index.search("steel hydrogen", k=5))
+    with pytest.raises(KeyError):
+        clients.get("Initech")
+
+
+def test_names_sharing_a_directory_are_rejected(namespaces):
+    clients = namespaces()
+    acme = add_client(clients, "Acme Corp", "Acme annual sustainability report. " * 10)
+    assert namespace_slug("acme-corp") == namespace_slug("Acme Corp")
+
+    # Case and whitespace do not make a different name
+    assert clients.get("  ACME   corp ") is acme
+    for other in ("acme-corp", "ACME/Corp"):
+        assert not clients.exists(other)
+        with pytest.raises(ValueError):
+            clients.check(other)
+        with pytest.raises(ValueError):
+            clients.get(other, create=True)
+    # The owner is recorded on disk, so a new process rejects the other names too
+    with pytest.raises(ValueError):
+        namespaces().get("acme-corp")
+
+
+def test_least_recently_used_index_is_closed_on_eviction(namespaces):
+    clients = namespaces(max_loaded=1)
+    acme = add_client(clients, "Acme", "Acme brief. " * 20)
+    globex = add_client(clients, "Globex", "Globex brief. " * 20)
+    assert clients.loaded() == ["globex"]
+    assert acme._closed and not globex._closed
+    assert clients.stats()["evictions"] == 1
+
+    # Reloaded from disk as the directory's only writer
+    reloaded = clients.get("Acme")
+    assert reloaded is not acme
+    assert reloaded.add_file(os.path.join(clients.materials_dir("Acme"), "brief.txt")) == 0
+    assert clients.loaded() == ["acme"]
+
+
+def test_indexes_in_use_are_not_evicted_until_released(namespaces):
+    clients = namespaces(max_loaded=1)
+    for name in ("Acme", "Globex", "Initech"):
+        os.makedirs(clients.materials_dir(name))
+
+    with clients.use("Acme") as acme:
+        clients.get("Globex")
+        clients.get("Initech")
+        # Globex went instead of the older Acme, which is still being searched
+        assert clients.loaded() == ["acme", "initech"]
+        assert not acme._closed
+        assert clients.evict("Acme") is False
+    assert clients.loaded() == ["initech"]
+    assert acme._closed
+
+
+def test_evicted_index_is_closed_outside_the_namespaces_lock(namespaces):
+    clients = namespaces(max_loaded=1)
+    for name in ("Acme", "Globex"):
+        os.makedirs(clients.materials_dir(name))
+    acme = clients.get("Acme")
+    acme.release_close = threading.Event()
+    acme.closing = threading.Event()
+
+    loader = threading.Thread(target=clients.get, args=("Globex",))
+    loader.start()
+    assert acme.closing.wait(10)
+    # While Acme closes, other namespaces stay usable
+    assert clients.loaded() == ["globex"]
+    assert clients.get("Globex") is not None
+
+    # Loading Acme again waits until its previous index is closed
+    reloaded = []
+    reloader = threading.Thread(target=lambda: reloaded.append(clients.get("Acme")))
+    reloader.start()
+    reloader.join(0.2)
+    assert reloader.is_alive() and not reloaded
+
+    acme.release_close.set()
+    loader.join(10)
+    reloader.join(10)
+    assert acme._closed
+    assert reloaded and reloaded[0] is not acme
@@ -0,0 +1,97 @@
+"""
+Tests for the copy-on-write snapshots of ReferenceIndex: a search runs on the
+snapshot it started with while uploads and deletions publish new versions,
+writers never wait for it, and deleted parent chunks stay readable until no
+search of an older version is running.
+
+Run from the repository root:
+    python -m pytest -q references/tests
+"""
+
+import os
+import threading
+
+from rag_shared.embedding_backends import HashingEmbeddings
+
+EMISSIONS = "Scope 3 emissions of purchased steel and cement for the new plant. " * 5
+WATER = "Water stewardship plan for the bottling sites in dry regions. " * 5
+
+
+class PausingEmbeddings(HashingEmbeddings):
+    """Embeds the query "pause ..." only once the test sets resume."""
+
+    def __init__(self):
+        super().__init__()
+        self.paused = threading.Event()
+        self.resume = threading.Event()
+
+    def embed_query(self, text):
+        if text.startswith("pause"):
+            self.paused.set()
+            self.resume.wait(10)
+        return super().embed_query(text)
+
+
+def test_snapshot_is_not_changed_by_later_saves(materials, open_index):
+    materials.write("emissions.txt", EMISSIONS)
+    index = open_index()
+    before = index.snapshot()
+    files = dict(before.files)
+    live = [mask.copy() for mask in before.vectorstore.live]
+
+    index.add_file(materials.write("water.txt", WATER))
+    index.remove_file(os.path.join(materials.path, "emissions.txt"))
+    after = index.snapshot()
+
+    assert after.version == before.version + 2 == index.index_version
+    assert before.files == files and set(after.files) == {"water.txt"}
+    # Deletions tombstone vectors in a new store; the old live masks are untouched
+    assert after.vectorstore is not before.vectorstore
+    assert all((mask == copy).all() for mask, copy in zip(before.vectorstore.live, live))
+    assert sum(before.vectorstore.live_counts) == len(files["emissions.txt"]["ids"])
+    assert sum(after.vectorstore.live_counts) == len(after.files["water.txt"]["ids"])
+
+
+def test_search_keeps_its_snapshot_while_the_index_changes(materials, open_index):
+    materials.write("emissions.txt", EMISSIONS)
+    embeddings = PausingEmbeddings()
+    index = open_index(embeddings=embeddings)
+    version = index.index_version
+    parent_ids = list(index.manifest["files"]["emissions.txt"]["parent_ids"])
+
+    results = []
+    search = threading.Thread(target=lambda: results.append(index.search("pause scope 3 emissions steel", k=2)))
+    search.start()
+    assert embeddings.paused.wait(10)
+
+    # Writers do not wait for the running search
+    writer = threading.Thread(target=lambda: (
+        index.remove_file(os.path.join(materials.path, "emissions.txt")),
+        index.add_file(materials.write("water.txt", WATER))))
+    writer.start()
+    writer.join(10)
+    assert not writer.is_alive()
+    assert index.index_version == version + 2
+    # The deleted parents are still there for the search of the older version
+    assert all(index.docstore.mget(parent_ids))
+
+    embeddings.resume.set()
+    search.join(10)
+    (found,) = results
+    assert found.index_version == version
+    assert found and all(document.metadata["file_path"] == "emissions.txt" for document in found)
+    assert all(document.metadata["index_version"] == version for document in found)
+
+    # Once no search of that version is running, its deleted parents are purged
+    assert not any(index.docstore.mget(parent_ids))
+    latest = index.search("scope 3 emissions steel", k=2)
+    assert latest.index_version == version + 2
+    assert {document.metadata["file_path"] for document in latest} == {"water.txt"}
+
+
+def test_deleted_parents_are_purged_at_once_without_searches(materials, open_index):
+    materials.write("emissions.txt", EMISSIONS)
+    index = open_index()
+    parent_ids = list(index.manifest["files"]["emissions.txt"]["parent_ids"])
+    index.remove_file(os.path.join(materials.path, "emissions.txt"))
+    assert not any(index.docstore.mget(parent_ids))
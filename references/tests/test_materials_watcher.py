@@ -0,0 +1,138 @@
+"""
+Tests for rag_shared.materials_watcher.MaterialsWatcher and the index side of
+it: bursts of changes are debounced into one batch, files still being written
+are held back, each batch bumps the index version once, and files that failed
+to load are not parsed again until they change.
+
+Run from the repository root:
+    python -m pytest -q references/tests
+"""
+
+import os
+import threading
+import time
+
+import pytest
+
+from rag_shared.materials_watcher import MaterialsWatcher
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+class Recorder:
+    """Stands in for ReferenceIndex.apply_changes and changed_paths."""
+
+    def __init__(self):
+        self.batches = []
+        self.applied = threading.Event()
+
+    def apply(self, paths):
+        self.batches.append(list(paths))
+        self.applied.set()
+        return {"indexed": len(paths)}
+
+    @staticmethod
+    def scan():
+        return []
+
+
+@pytest.fixture
+def watch():
+    """Factory starting a MaterialsWatcher in poll mode; every watcher is stopped afterwards."""
+    started = []
+
+    def factory(materials_dir, apply, scan, **kwargs):
+        kwargs.setdefault("poll_interval", 60)
+        watcher = MaterialsWatcher(materials_dir, apply, scan, mode="poll", **kwargs)
+        watcher.start()
+        started.append(watcher)
+        return watcher
+
+    yield factory
+    for watcher in started:
+        watcher.stop(timeout=10)
+
+
+def test_burst_of_changes_is_applied_as_one_batch(materials, watch):
+    recorder = Recorder()
+    watcher = watch(materials.path, recorder.apply, recorder.scan, debounce=0.3)
+    paths = []
+    for i in range(5):
+        paths.append(materials.write(f"brief{i}.txt", f"Brief {i} on supplier audits."))
+        watcher.notify([paths[-1]])
+        time.sleep(0.05)
+    # Lock files and unsupported types are never materials
+    watcher.notify([materials.write("~$brief.docx", "lock"), materials.write("notes.xyz", "x")])
+
+    assert recorder.applied.wait(10)
+    time.sleep(0.5)
+    assert recorder.batches == [sorted(paths)]
+    assert watcher.batches == 1 and watcher.last_result == {"indexed": 5}
+
+
+def test_file_still_being_written_is_held_back(materials, watch):
+    recorder = Recorder()
+    watcher = watch(materials.path, recorder.apply, recorder.scan, debounce=0.3)
+    done = materials.write("done.txt", "Finished report.")
+    copying = materials.write("copying.txt", "First part")
+    watcher.notify([done, copying])
+    # The copy grows after its last event, before the quiet period ends
+    with open(copying, "a", encoding="utf-8") as f:
+        f.write(" and the rest of the report.")
+
+    assert wait_for(lambda: len(recorder.batches) == 2)
+    assert recorder.batches == [[done], [copying]]
+
+
+def test_watcher_applies_each_batch_with_one_version_bump(materials, open_index, watch):
+    materials.write("a.txt", "Scope 1 emissions from company vehicles. " * 5)
+    index = open_index()
+    version = index.index_version
+    watcher = watch(materials.path, index.apply_changes, index.changed_paths, debounce=0.2, poll_interval=0.2)
+
+    # Copied in directly, without upload: found by polling
+    materials.write("b.txt", "Water withdrawal in stressed basins. " * 5)
+    materials.write("c.txt", "Board diversity and executive pay. " * 5)
+    os.remove(os.path.join(materials.path, "a.txt"))
+    assert wait_for(lambda: set(index.manifest["files"]) == {"b.txt", "c.txt"})
+    assert wait_for(lambda: watcher.batches >= 1)
+    assert index.index_version == version + watcher.batches
+    assert index.search("water withdrawal", k=1)[0].metadata["file_path"] == "b.txt"
+
+
+def test_failed_file_is_skipped_until_it_changes(materials, open_index):
+    materials.write("a.txt", "Human rights due diligence in the supply chain. " * 5)
+    broken = materials.write("broken.pdf", "not a pdf")
+    index = open_index()
+    failure = index.manifest["failed"]["broken.pdf"]
+    assert "error" in failure and set(index.manifest["files"]) == {"a.txt"}
+
+    # Not parsed again while its size and mtime are the ones it failed at
+    version = index.index_version
+    assert index.changed_paths() == []
+    result = index.apply_changes([broken])
+    assert (result["unchanged"], result["failed"]) == (1, 0)
+    assert index.index_version == version
+
+    # Skipped by the next start-up as well
+    index.close()
+    index = open_index()
+    assert index.manifest["failed"]["broken.pdf"] == failure
+
+    # Replaced by another copy: tried again
+    with open(broken, "w", encoding="utf-8") as f:
+        f.write("still not a pdf, but a different one")
+    assert index.changed_paths() == [broken]
+    assert index.apply_changes([broken])["failed"] == 1
+
+    # Deleted: forgotten
+    os.remove(broken)
+    index.apply_changes([broken])
+    assert "broken.pdf" not in index.manifest["failed"]
@@ -0,0 +1,82 @@
+"""
+Tests for metadata-filtered search: the filters of rag_shared.metadata_filter
+must restrict both the vector and the BM25 keyword search, across segments
+and after deletions.
+
+Run from the repository root:
+    python -m pytest -q references/tests
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from rag_shared.keyword_index import KeywordPostings, KeywordSnapshot
+
+ACME = "Acme Corp reports scope 3 emissions under ISO 14064 for its steel plants. " * 6
+GLOBEX = "Globex publishes a water stewardship plan for its bottling sites. " * 6
+SHARED = "Board oversight of climate risk follows the TCFD recommendations. "
+
+
+def folders(results):
+    return {document.metadata["folder"] for document in results}
+
+
+@pytest.fixture
+def index(materials, open_index):
+    materials.write("acme/emissions.txt", ACME + SHARED * 4)
+    materials.write("globex/water.txt", GLOBEX + SHARED * 4)
+    materials.write("notes.txt", "General notes on stakeholder engagement and materiality. " * 6)
+    return open_index()
+
+
+def test_folder_filter_restricts_vector_and_keyword_matches(index):
+    assert folders(index.search("climate risk board oversight", k=5, filters={"folder": "acme"})) == {"acme"}
+    # "ISO 14064" only appears in acme; filtered to globex, no keyword match may leak through
+    results = index.search("ISO 14064", k=5, filters={"folder": "globex"})
+    assert folders(results) <= {"globex"}
+    assert all("14064" not in document.page_content for document in results)
+
+
+def test_source_and_file_type_filters(index):
+    results = index.search("water stewardship", k=5, filters={"source": "water.txt"})
+    assert {document.metadata["file_path"] for document in results} == {"globex/water.txt"}
+    assert len(index.search("water stewardship", k=5, filters={"file_type": "pdf"})) == 0
+    assert len(index.search("water stewardship", k=5, filters={"file_type": "txt"})) > 0
+
+
+def test_filter_matching_no_file_returns_nothing(index):
+    results = index.search("emissions", k=3, filters={"uploaded_after": "2999-01-01"})
+    assert len(results) == 0
+    assert results.index_version == index.index_version
+
+
+def test_unknown_filter_field_is_rejected(index):
+    with pytest.raises(ValueError):
+        index.search("emissions", filters={"author": "someone"})
+
+
+def test_filter_spans_segments_and_skips_deleted_files(index, materials):
+    # A second save writes a second segment
+    index.add_file(materials.write("acme/water.txt", "Acme water permits for the Ohio steel plant. " * 6))
+    assert len(index.vectorstore.segments) >= 2
+    paths = {document.metadata["file_path"] for document in
+             index.search("water", k=5, filters={"folder": "acme"}, mmr_lambda=1)}
+    assert "acme/water.txt" in paths and not any(path.startswith("globex/") for path in paths)
+
+    assert index.remove_file(os.path.join(materials.path, "acme", "emissions.txt")) > 0
+    results = index.search("ISO 14064 emissions", k=5, filters={"folder": "acme"})
+    assert {document.metadata["file_path"] for document in results} <= {"acme/water.txt"}
+
+
+def test_keyword_snapshot_scores_only_allowed_live_positions():
+    texts = ["carbon tax", "carbon border adjustment", "water risk", "carbon credits"]
+    postings = [KeywordPostings.build(texts[:2]), KeywordPostings.build(texts[2:])]
+    live = [np.array([True, True]), np.array([True, False])]
+    snapshot = KeywordSnapshot(postings, live)
+    assert len(snapshot) == 3
+    # Position 3 is tombstoned
+    assert {position for position, _ in snapshot.search("carbon", k=10)} == {0, 1}
+    assert [position for position, _ in snapshot.search("carbon", k=10, allowed_positions=np.array([1, 2]))] == [1]
+    assert snapshot.search("carbon", k=10, allowed_positions=np.array([2], dtype=np.int64)) == []